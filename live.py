@@ -478,8 +478,17 @@ import datetime
 from logging.config import dictConfig
 from functools import lru_cache
 from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+import atexit
 import collections
+import contextlib
+import contextvars
+import copy
+import heapq
+import itertools
+import queue
 import json
+import gzip
 import sqlite3
 
 import requests
@@ -496,6 +505,16 @@ try:
     _has_faiss = True
 except Exception:
     _has_faiss = False
+try:
+    import ccxt.pro as ccxt_pro
+    _has_ccxtpro = True
+except Exception:
+    _has_ccxtpro = False
+try:
+    import aiohttp
+    _has_aiohttp = True
+except Exception:
+    _has_aiohttp = False
 from tenacity import retry, wait_exponential, stop_after_attempt
 import plotly.graph_objects as go
 from dash import Dash, dcc, html, dash_table
@@ -986,6 +1005,71 @@ class Settings:
         self.chart_limit          = 80
         self.chart_refresh_ms     = 10000
 
+        # candle cache: max number of (symbol, timeframe) series kept in memory
+        self.candle_cache_max_series = 256
+        # identical exchange reads within this window (seconds) share one request
+        self.coalesce_window      = 2.0
+
+        # exchange I/O: 'live' talks to Binance, 'record' also logs every call to record_dir,
+        # 'replay' answers from a recording offline on an accelerated clock
+        self.exchange_mode        = 'live'
+        self.record_dir           = 'recordings'
+        self.replay_path          = None        # recording file or directory (None = newest in record_dir)
+        self.replay_speed         = 60.0        # exchange seconds per wall second during replay
+        self.replay_latency       = True        # re-apply recorded call durations (scaled by replay_speed)
+        self.replay_lookahead     = 5.0         # exchange seconds a recorded response may lie ahead of the clock
+
+        # shared request-weight budget for every exchange client (Binance futures allows 2400 / minute;
+        # keep headroom for calls made outside this process). reserve = share of the bucket a class may not use
+        self.rate_budget_weight   = 2000
+        self.rate_budget_window   = 60.0
+        self.rate_budget_reserve  = {'order': 0.0, 'trading': 0.0, 'ui': 0.10, 'selector': 0.35}
+        # market metadata cache (load_markets result + filtered universe), refreshed after ttl seconds
+        self.market_cache_path    = 'markets_cache.json.gz'
+        self.market_cache_ttl     = 6 * 3600
+        # sync clients for Dash/threaded callers (one ccxt client must not be shared between threads)
+        self.sync_pool_size       = 4
+        self.sync_pool_timeout    = 30.0
+
+        # market data ingestion: 'rest' polls fetch_ohlcv, 'stream' consumes pushed kline/trade events
+        self.data_mode            = 'rest'
+        self.stream_transport     = 'ccxtpro'   # 'ccxtpro' or 'replay'
+        self.stream_replay_path   = None        # JSONL(.gz) event file for the replay transport
+        self.stream_replay_speed  = 0.0         # 0 = as fast as possible, 1.0 = real time
+        self.stream_stale_s       = 90          # stream-fed series silent for longer fall back to REST
+        self.stream_min_interval  = 1.0         # min seconds between stream-driven run_live ticks
+        self.stream_wake_move     = 0.002       # stream events wake run_live only on a bar close or a close move this large
+
+        # incremental indicator state per (symbol, timeframe), snapshotted for warm restarts
+        self.indicator_state_dir  = 'indicator_state'
+        self.indicator_snapshot_interval = 60
+
+        # order books: 'rest' fetches a book per check, 'local' keeps L2 books from depth diffs
+        # for the active and standby symbols and only uses REST for (re)sync snapshots
+        self.book_mode            = 'rest'
+        self.book_transport       = 'binance'   # 'binance' (raw diff-depth websocket) or 'replay'
+        self.book_ws_url          = 'wss://fstream.binance.com/stream'
+        self.book_ws_speed        = '100ms'
+        self.book_snapshot_limit  = 1000
+        self.book_max_levels      = 1000
+        self.book_stale_s         = 5.0         # a local book without diffs for longer falls back to REST
+
+        # build higher timeframes from one base-resolution series instead of fetching each one
+        self.derive_timeframes    = True
+        self.base_timeframe       = '5m'
+
+        # on-disk candle archive (append-only, memory-mapped columns per symbol/timeframe)
+        self.archive_enabled      = False       # opt-in: every fetched series (incl. selector probes) is written to disk
+        self.archive_dir          = 'candles'
+        self.matcher_history_bars = 0           # archived bars fed to the latent index (0 = fetched window only)
+        self.matcher_max_windows  = 0           # oldest windows evicted past this many (0 = size of the initial build)
+        self.matcher_backend      = 'exact'     # latent search: exact | numpy | ivf | hnsw (ivf/hnsw need FAISS)
+        self.matcher_ivf_nlist    = 0           # IVF cells (0 = ~4·sqrt(capacity))
+        self.matcher_ivf_nprobe   = 8           # IVF cells visited per query
+        self.matcher_hnsw_m       = 32          # HNSW graph degree
+        self.matcher_hnsw_ef      = 64          # HNSW search beam width
+        self.train_history_bars   = 0           # archived bars used for AE retraining (0 = fetched window only)
+
         # volatility / feature windows
         self.vol_window           = 60
         self.adx_window           = 14      # standard ADX window
@@ -996,6 +1080,8 @@ class Settings:
         self.base_usd             = 10000
         # account for expected slippage (0.1%)
         self.slippage_pct         = 0.001
+        # cap order size so the book-walk fill VWAP stays within this fraction of mid
+        self.max_slippage_pct     = 0.002
 
         # stops / trailing
         # slightly tighter stop by default (1.5%)
@@ -1018,6 +1104,7 @@ class Settings:
         self.live_train_interval  = 300
         self.dash_train_interval  = 600
         self.er_hist_size         = 1500
+        self.sketch_save_interval = 60      # seconds between persisting the vol/liq/ER quantile sketches
         self.open_softness_factor = 0.5
         self.exit_softness_factor = 1.2
         self.exit_prob_thr        = 0.85
@@ -1040,6 +1127,7 @@ class Settings:
 
         # Liquidity / market-cap settings
         self.liq_depth_pct       = 0.005
+        self.liq_profile_bands   = (0.001, 0.0025, 0.005, 0.01, 0.02)   # depth bands reported by compute_liquidity_profile
         self.liq_hist_size       = 500
         self.liq_min_usd         = 5000
         self.liq_max_usd         = 200000
@@ -1047,16 +1135,35 @@ class Settings:
         self.liquidity_weight    = 0.6
         self.coingecko_enabled   = True
         self.coingecko_ttl       = 300
+        self.coingecko_batch     = 250        # ids per /coins/markets request
+        self.marketcap_provider  = 'coingecko'  # 'coingecko' or 'stub' (offline values from marketcap_stub_path)
+        self.marketcap_stub_path = None
+        self.marketcap_cache_path = 'marketcap_cache.json.gz'
+        self.marketcap_max_stale = 7 * 86400  # serve cached caps this long while the provider is unreachable
 
         # Selector / scanning - enforce Binance + USDT only, and safer defaults
         self.selector_interval     = 60 * 5
         self.selector_top_k        = 8
         self.selector_enabled      = True
         self.selector_orderbook_depth = 200
-        self.selector_concurrency  = 6
+        self.selector_concurrency  = 6          # initial probe concurrency; AIMD moves it within min..max
+        self.selector_concurrency_min = 2
+        self.selector_concurrency_max = 32
+        self.selector_target_latency = 1.5      # seconds per symbol probe before concurrency is cut
         self.selector_min_liq_usd  = 10000
         self.selector_switch_margin = 0.05
         self.selector_max_idle_minutes = 5
+        # two-stage scan: rank the whole universe from bulk tickers, probe only the top finalists
+        self.selector_finalists    = 24
+        self.selector_min_quote_volume = 1e6    # 24h quote volume (USDT) below this never becomes a finalist
+        self.selector_max_spread   = 0.002      # relative bid/ask spread above this never becomes a finalist
+        # per-symbol score table: rescan after min_age..max_age seconds depending on volatility / closeness to cutoff
+        self.selector_score_min_age = 60
+        self.selector_score_max_age = 3600
+        self.selector_score_ref_vol = 0.15      # |24h change| or |6h momentum| that warrants rescans at min_age
+        # keep the selector's top_k candidates warm (candles, matcher, wallet) so switching is cheap
+        self.standby_enabled       = True
+        self.standby_interval      = 60
 
         # scanning constraints (new flags)
         self.scan_binance_only     = True
@@ -1094,7 +1201,8 @@ def _simple_calibrate(score):
     except Exception:
         return 0.5
 
-def compute_ev_and_decide_local(sym, wallet, side, proposed_size, price, score, df=None):
+def compute_ev_and_decide_local(sym, wallet, side, proposed_size, price, score, df=None, book=None):
+    """EV gate for an open; with `book` (ccxt dict, BookArrays or L2Book) costs use the book-walk slippage."""
     try:
         p_win = _simple_calibrate(score)
         avg_win = 1.0
@@ -1124,8 +1232,18 @@ def compute_ev_and_decide_local(sym, wallet, side, proposed_size, price, score,
             if fee_bps is None:
                 fee_bps = getattr(settings, 'taker_fee', 0.0007)
             fee_frac = fee_bps/10000.0 if fee_bps>1 else fee_bps
-            spread_bps = getattr(settings, 'est_spread_bps', 0.0005)
-            slippage = getattr(settings, 'est_slippage_bps', max(0.0002, spread_bps/2))
+            slippage = None
+            if book is not None:
+                try:
+                    _, slip = book_walk(book, side, [proposed_size], ref_price=price)
+                    if not np.isfinite(slip[0]):
+                        return (False, proposed_size, 'book_too_thin', p_win, 0.0)
+                    slippage = max(0.0, float(slip[0]))
+                except Exception:
+                    slippage = None
+            if slippage is None:
+                spread_bps = getattr(settings, 'est_spread_bps', 0.0005)
+                slippage = getattr(settings, 'est_slippage_bps', max(0.0002, spread_bps/2))
             total_bps = fee_frac + slippage
             costs = price * float(proposed_size) * total_bps
         except Exception:
@@ -1136,9 +1254,9 @@ def compute_ev_and_decide_local(sym, wallet, side, proposed_size, price, score,
     except Exception:
         return (True, proposed_size, 'error', 0.5, 0.0)
 
-def decide_and_open(sym, wallet, side, amt, price, score, df=None, extra=None, dry=True):
+def decide_and_open(sym, wallet, side, amt, price, score, df=None, extra=None, dry=True, book=None):
     try:
-        ok, size, reason, p_win, ev = compute_ev_and_decide_local(sym, wallet, side, amt, price, score, df=df)
+        ok, size, reason, p_win, ev = compute_ev_and_decide_local(sym, wallet, side, amt, price, score, df=df, book=book)
         try:
             log.debug("DecideOpen %s side=%s price=%.6f score=%.4f p=%.3f ev=%.4f reason=%s size=%s", sym, side, price, score, p_win, ev, reason, size)
         except Exception:
@@ -1167,7 +1285,670 @@ log.info(f"AE initial lr: {settings.ae_lr}")
 async_ex = ccxt_async.binance({'enableRateLimit': True, 'options': {'defaultType': 'future'}})
 sync_ex  = ccxt.binance({'enableRateLimit': True, 'options': {'defaultType': 'future'}})
 
-# ==================== 3b. Active state & locks ====================
+# ==================== 3a. Record / replay ====================
+# Every call listed in RECORDED_METHODS goes through the wrappers below. In 'record' mode
+# it is appended to a gzip JSONL file, one line per call:
+#   {"t": wall_s, "client": "async"|"sync", "method": ..., "args": [...], "kwargs": {...},
+#    "dur": seconds, "result": ...}   (or "error": {"type": ..., "msg": ...})
+# In 'replay' mode, ReplayExchange serves those lines back on a virtual clock that runs
+# settings.replay_speed times faster than wall time. No network is used.
+RECORDED_METHODS = frozenset({
+    'fetch_ohlcv', 'fetch_order_book', 'fetch_ticker', 'fetch_tickers', 'fetch_bids_asks', 'fetch_trades',
+    'load_markets', 'fetch_markets', 'create_order', 'market_buy', 'market_sell',
+})
+_REPLAY_LOOSE_PARAMS = ('timeframe',)
+
+class ReplayMiss(Exception):
+    """The recording has no response for a replayed call."""
+
+class ExchangeClock:
+    """Wall clock in live/record mode; accelerated virtual clock (starting at the recording's start) in replay."""
+    def __init__(self):
+        self.speed = 1.0
+        self._origin = None
+
+    def start(self, origin, speed):
+        self.speed = max(float(speed or 1.0), 1e-6)
+        self._origin = (float(origin), time.monotonic())
+
+    def time(self):
+        if self._origin is None:
+            return time.time()
+        t0, m0 = self._origin
+        return t0 + (time.monotonic() - m0) * self.speed
+
+    def scale(self, seconds):
+        """Wall seconds corresponding to `seconds` of exchange time."""
+        return max(0.0, float(seconds)) / self.speed
+
+exchange_clock = ExchangeClock()
+
+async def loop_sleep(seconds):
+    """asyncio.sleep measured in exchange time (shortened by replay_speed during replay)."""
+    await asyncio.sleep(exchange_clock.scale(seconds))
+
+def _jsonable(obj):
+    return json.loads(json.dumps(obj, default=str))
+
+class CallRecorder:
+    """Appends exchange calls to record_dir/exchange-<start>.jsonl.gz (thread-safe, flushed about once a second)."""
+    def __init__(self, root=None):
+        root = Path(root or settings.record_dir)
+        root.mkdir(parents=True, exist_ok=True)
+        self.path = root / f"exchange-{time.strftime('%Y%m%d-%H%M%S')}.jsonl.gz"
+        self._fh = gzip.open(self.path, 'at', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self.count = 0
+        atexit.register(self.close)
+        log.info(f"Recording exchange calls to {self.path}")
+
+    def write(self, client, method, args, kwargs, t, dur, result=None, error=None):
+        rec = {'t': t, 'client': client, 'method': method, 'args': list(args), 'kwargs': kwargs, 'dur': round(dur, 6)}
+        if error is not None:
+            rec['error'] = {'type': type(error).__name__, 'msg': str(error)}
+        else:
+            rec['result'] = result
+        line = json.dumps(rec, default=str, separators=(',', ':'))
+        with self._lock:
+            if self._fh is None:
+                return
+            self._fh.write(line + '\n')
+            self.count += 1
+            if time.monotonic() - self._last_flush > 1.0:
+                self._fh.flush()
+                self._last_flush = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+class RecordingExchange:
+    """Transparent proxy around a ccxt client that records RECORDED_METHODS calls."""
+    def __init__(self, inner, recorder, client):
+        self._inner = inner
+        self._recorder = recorder
+        self._client = client
+        self._wrapped = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self._inner, name)
+        if name not in RECORDED_METHODS or not callable(attr):
+            return attr
+        fn = self._wrapped.get(name)
+        if fn is None:
+            fn = self._wrapped[name] = self._wrap(name, attr)
+        return fn
+
+    def _wrap(self, name, attr):
+        recorder, client = self._recorder, self._client
+        if asyncio.iscoroutinefunction(attr):
+            async def call(*args, **kwargs):
+                t, m0 = time.time(), time.monotonic()
+                try:
+                    res = await attr(*args, **kwargs)
+                except Exception as e:
+                    recorder.write(client, name, args, kwargs, t, time.monotonic() - m0, error=e)
+                    raise
+                recorder.write(client, name, args, kwargs, t, time.monotonic() - m0, result=res)
+                return res
+        else:
+            def call(*args, **kwargs):
+                t, m0 = time.time(), time.monotonic()
+                try:
+                    res = attr(*args, **kwargs)
+                except Exception as e:
+                    recorder.write(client, name, args, kwargs, t, time.monotonic() - m0, error=e)
+                    raise
+                recorder.write(client, name, args, kwargs, t, time.monotonic() - m0, result=res)
+                return res
+        call.__name__ = name
+        return call
+
+def _replay_keys(method, args, kwargs):
+    symbol = args[0] if args else kwargs.get('symbol')
+    exact = {k: v for k, v in kwargs.items() if k not in ('since', 'symbol')}
+    loose = {k: kwargs[k] for k in _REPLAY_LOOSE_PARAMS if k in kwargs}
+    return ((method, symbol, json.dumps(exact, sort_keys=True, default=str)),
+            (method, symbol, json.dumps(loose, sort_keys=True, default=str)))
+
+class Recording:
+    """Calls loaded from one recording file (or every *.jsonl.gz in a directory), indexed for replay.
+
+    Lookups ignore `since` (it depends on when the call was made) and return the latest
+    response recorded at or before the virtual time, falling back to a match on
+    (method, symbol, timeframe) when the exact parameters never occurred. A call made
+    before anything matching was recorded is a ReplayMiss, except within `lookahead`
+    seconds of the first record (calls made just after the clock starts).
+    """
+    def __init__(self, path):
+        path = Path(path)
+        files = sorted(path.glob('*.jsonl.gz')) if path.is_dir() else [path]
+        self.exact, self.loose = {}, {}
+        self.t0 = None
+        n = 0
+        for fp in files:
+            try:
+                with gzip.open(fp, 'rt', encoding='utf-8') as fh:
+                    for line in fh:
+                        try:
+                            rec = json.loads(line)
+                        except Exception:
+                            continue
+                        n += self._add(rec)
+            except (EOFError, OSError) as e:
+                log.warning(f"Recording {fp} truncated: {e}")  # recorder was killed mid-write
+        for idx in (self.exact, self.loose):
+            for key, recs in idx.items():
+                recs.sort(key=lambda r: r['t'])
+                idx[key] = ([r['t'] for r in recs], recs)
+        self.count = n
+        log.info(f"Loaded {n} recorded exchange calls from {path}")
+
+    def _add(self, rec):
+        exact, loose = _replay_keys(rec['method'], rec.get('args', []), rec.get('kwargs', {}))
+        self.exact.setdefault(exact, []).append(rec)
+        self.loose.setdefault(loose, []).append(rec)
+        self.t0 = rec['t'] if self.t0 is None else min(self.t0, rec['t'])
+        return 1
+
+    def lookup(self, method, args, kwargs, now, lookahead=0.0):
+        exact, loose = _replay_keys(method, args, kwargs)
+        for hit in (self.exact.get(exact), self.loose.get(loose)):
+            if not hit:
+                continue
+            ts, recs = hit
+            i = _bisect.bisect_right(ts, now) - 1
+            if i >= 0:
+                return recs[i]
+            if ts[0] <= now + lookahead:
+                return recs[0]
+        raise ReplayMiss(f"no recorded {method} for {args} {kwargs} at or before {now:.3f}")
+
+class ReplayExchange:
+    """Offline stand-in for a ccxt client that answers RECORDED_METHODS from a Recording.
+
+    Other attributes come from an unconnected ccxt instance (markets, parse helpers).
+    Orders that were never recorded get a synthetic filled response.
+    """
+    def __init__(self, inner, recording, client, latency=True):
+        self._inner = inner
+        self._recording = recording
+        self._client = client
+        self._latency = latency
+        self._wrapped = {}
+        self._order_seq = 0
+
+    def __getattr__(self, name):
+        if name not in RECORDED_METHODS:
+            return getattr(self._inner, name)
+        fn = self._wrapped.get(name)
+        if fn is None:
+            fn = self._wrapped[name] = self._wrap(name)
+        return fn
+
+    def _answer(self, name, args, kwargs):
+        try:
+            rec = self._recording.lookup(name, args, kwargs, exchange_clock.time(), settings.replay_lookahead)
+        except ReplayMiss:
+            if name in ('create_order', 'market_buy', 'market_sell'):
+                return self._synthetic_order(name, args, kwargs), 0.0
+            raise
+        dur = rec.get('dur', 0.0) if self._latency else 0.0
+        if 'error' in rec:
+            err = rec['error']
+            cls = getattr(ccxt, err.get('type', ''), None)
+            if not (isinstance(cls, type) and issubclass(cls, Exception)):
+                cls = ReplayMiss
+            return cls(err.get('msg', '')), dur
+        res = rec.get('result')
+        if name == 'fetch_ohlcv' and isinstance(res, list):
+            since, limit = kwargs.get('since'), kwargs.get('limit')
+            if since is not None:
+                res = [r for r in res if r[0] >= since] or res[-1:]
+            if limit:
+                res = res[-int(limit):]
+        elif name == 'load_markets' and isinstance(res, dict):
+            try:
+                self._inner.set_markets(list(res.values()))
+            except Exception:
+                pass
+        return res, dur
+
+    def _synthetic_order(self, name, args, kwargs):
+        self._order_seq += 1
+        sym = args[0] if args else kwargs.get('symbol')
+        side = args[2] if name == 'create_order' and len(args) > 2 else ('buy' if name == 'market_buy' else 'sell')
+        amount = args[3] if name == 'create_order' and len(args) > 3 else (args[1] if len(args) > 1 else kwargs.get('amount'))
+        return {'id': f"replay-{self._order_seq}", 'symbol': sym, 'type': 'market', 'side': side,
+                'amount': amount, 'filled': amount, 'status': 'closed',
+                'timestamp': int(exchange_clock.time() * 1000), 'info': {'replay': True}}
+
+    def _wrap(self, name):
+        if self._client == 'async':
+            async def call(*args, **kwargs):
+                res, dur = self._answer(name, args, kwargs)
+                if dur:
+                    await asyncio.sleep(exchange_clock.scale(dur))
+                if isinstance(res, Exception):
+                    raise res
+                return copy.deepcopy(res)
+        else:
+            def call(*args, **kwargs):
+                res, dur = self._answer(name, args, kwargs)
+                if dur:
+                    time.sleep(exchange_clock.scale(dur))
+                if isinstance(res, Exception):
+                    raise res
+                return copy.deepcopy(res)
+        call.__name__ = name
+        return call
+
+def _latest_recording(root):
+    files = sorted(Path(root).glob('exchange-*.jsonl.gz'))
+    if not files:
+        raise FileNotFoundError(f"no recordings in {root}")
+    return files[-1]
+
+def install_exchange_mode(mode=None, replay_path=None):
+    """(Re)bind async_ex / sync_ex for settings.exchange_mode: 'live', 'record' or 'replay'."""
+    global async_ex, sync_ex
+    mode = mode or settings.exchange_mode
+    live_async, live_sync = getattr(async_ex, '_inner', async_ex), getattr(sync_ex, '_inner', sync_ex)
+    if mode == 'record':
+        recorder = CallRecorder()
+        async_ex = RecordingExchange(live_async, recorder, 'async')
+        sync_ex = RecordingExchange(live_sync, recorder, 'sync')
+    elif mode == 'replay':
+        recording = Recording(replay_path or settings.replay_path or _latest_recording(settings.record_dir))
+        exchange_clock.start(recording.t0 or time.time(), settings.replay_speed)
+        async_ex = ReplayExchange(live_async, recording, 'async', latency=settings.replay_latency)
+        sync_ex = ReplayExchange(live_sync, recording, 'sync', latency=settings.replay_latency)
+    else:
+        async_ex, sync_ex = live_async, live_sync
+    settings.exchange_mode = mode
+    if globals().get('sync_pool') is not None:
+        sync_pool.reset(sync_ex)
+
+if settings.exchange_mode != 'live':
+    install_exchange_mode()
+
+# ==================== 3b. Request coalescing ====================
+class CoalescedCallCancelled(Exception):
+    """Published to followers when the leader of a shared request got cancelled; they re-issue it."""
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+class SingleFlight:
+    """Share one in-flight exchange read between concurrent callers.
+
+    Callers asking for the same key (method, symbol, params) while a request is running,
+    or within `window` seconds after it finished, get that request's result instead of
+    issuing their own. Results are published through concurrent.futures.Future objects,
+    so followers can wait from the asyncio loop thread or from Dash worker threads.
+    Failed requests are never cached. If the leader is cancelled (e.g. a selector probe
+    timing out) its followers don't inherit the cancellation: the first of them to notice
+    re-issues the call as the new leader and the rest attach to it.
+
+    `rank` is the caller's exchange priority (lower = more urgent). A caller never waits on
+    an in-flight request of a lower class, which may be queued behind that class's rate
+    budget reserve; it issues its own and takes over the key, so later callers of any class
+    share the more urgent request. Finished results are shared regardless of class.
+    """
+    def __init__(self, window=2.0, max_entries=2048, wait_timeout=30.0):
+        self.window = window
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.stats = {'leader': 0, 'shared': 0}
+
+    def _claim(self, key, rank=0):
+        now = time.monotonic()
+        with self._lock:
+            ent = self._entries.get(key)
+            if ent is not None:
+                fut = ent['fut']
+                if (not fut.done() and ent['rank'] <= rank) or \
+                        (fut.done() and now - ent['ts'] <= self.window and fut.exception() is None):
+                    self.stats['shared'] += 1
+                    return fut, False
+            if len(self._entries) >= self.max_entries:
+                for k in [k for k, e in self._entries.items() if e['fut'].done() and now - e['ts'] > self.window]:
+                    self._entries.pop(k, None)
+            fut = concurrent.futures.Future()
+            self._entries[key] = {'fut': fut, 'ts': now, 'rank': rank}
+            self.stats['leader'] += 1
+            return fut, True
+
+    def _finish(self, key, fut, result=None, error=None):
+        with self._lock:
+            ent = self._entries.get(key)
+            if ent is not None and ent['fut'] is fut:
+                if error is not None:
+                    self._entries.pop(key, None)
+                else:
+                    ent['ts'] = time.monotonic()
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+
+    def call_sync(self, key, fn, *args, rank=0, **kwargs):
+        fut, leader = self._claim(key, rank)
+        while not leader:
+            # never block the event loop thread on a request the loop itself has to finish
+            if not fut.done() and _in_event_loop():
+                return fn(*args, **kwargs)
+            try:
+                return fut.result(timeout=self.wait_timeout)
+            except CoalescedCallCancelled:
+                fut, leader = self._claim(key, rank)
+        try:
+            res = fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, fut, error=e if isinstance(e, Exception) else CoalescedCallCancelled(str(e)))
+            raise
+        self._finish(key, fut, result=res)
+        return res
+
+    async def call_async(self, key, fn, *args, rank=0, **kwargs):
+        fut, leader = self._claim(key, rank)
+        while not leader:
+            try:
+                # shield: a cancelled follower must not cancel the future the others share
+                return await asyncio.shield(asyncio.wrap_future(fut))
+            except CoalescedCallCancelled:
+                fut, leader = self._claim(key, rank)
+        try:
+            res = await fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, fut, error=e if isinstance(e, Exception) else CoalescedCallCancelled(str(e)))
+            raise
+        self._finish(key, fut, result=res)
+        return res
+
+exchange_flight = SingleFlight(window=settings.coalesce_window)
+
+def _flight_key(method, symbol, params):
+    return (method, symbol, repr(sorted(params.items())))
+
+# ==================== 3c. Rate-limit budget ====================
+# Binance USD-M futures meters REQUEST_WEIGHT per IP (2400 / minute). Every client in
+# this process (async loop, Dash threads, backfill) draws from the one RateBudget below.
+# The caller's class comes from the exchange_priority ContextVar: run_live sets
+# 'trading', selector_task_loop sets 'selector', order placement passes 'order', and
+# anything unset (Dash callbacks) counts as 'ui'.
+EXCHANGE_PRIORITIES = ('order', 'trading', 'ui', 'selector')
+exchange_priority = contextvars.ContextVar('exchange_priority', default='ui')
+
+def endpoint_weight(method, symbol=None, params=None):
+    """Binance futures request weight of one ccxt call."""
+    limit = (params or {}).get('limit')
+    if method == 'fetch_ohlcv':
+        limit = limit or 500
+        return 1 if limit < 100 else 2 if limit < 500 else 5 if limit <= 1000 else 10
+    if method == 'fetch_order_book':
+        limit = limit or 500
+        return 2 if limit <= 50 else 5 if limit <= 100 else 10 if limit <= 500 else 20
+    if method == 'fetch_tickers':
+        return 1 if symbol else 40
+    if method == 'fetch_bids_asks':
+        return 2 if symbol else 5
+    if method in ('load_markets', 'fetch_markets'):
+        return 25   # spot + linear + inverse exchangeInfo
+    if method == 'fetch_trades':
+        return 5
+    return 1        # fetch_ticker, orders, everything else
+
+def priority_rank(priority=None):
+    """Position of an exchange priority class in EXCHANGE_PRIORITIES (unknown classes rank last)."""
+    priority = priority or exchange_priority.get()
+    return EXCHANGE_PRIORITIES.index(priority) if priority in EXCHANGE_PRIORITIES else len(EXCHANGE_PRIORITIES)
+
+class RateBudget:
+    """Token bucket over request weight with strict priority between waiters.
+
+    A call is granted when no waiter of the same or a higher class is queued and the
+    bucket keeps the caller's reserve (a fraction of capacity that lower classes may not
+    touch), so a selector sweep can never drain the weight the trading loop needs.
+    Waits are computed from the refill rate rather than polled in a tight loop. Sync
+    callers on the event-loop thread are never blocked; they take the weight as debt.
+    """
+    def __init__(self, capacity=2000, window=60.0, reserve=None):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / float(window)
+        self.reserve = dict(reserve or {})
+        self.tokens = self.capacity
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._seq = itertools.count()
+        self.stats = {p: {'calls': 0, 'weight': 0, 'waited': 0, 'wait_s': 0.0} for p in EXCHANGE_PRIORITIES}
+
+    def _ticket(self, priority):
+        return (priority_rank(priority), next(self._seq))
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._ts) * self.rate)
+        self._ts = now
+
+    def _try(self, ticket, weight, priority, queued):
+        """Take `weight` for `ticket` if it is its turn; otherwise queue it and return seconds to wait."""
+        with self._lock:
+            self._refill(time.monotonic())
+            floor = self.reserve.get(priority, 0.0) * self.capacity
+            need = min(weight, self.capacity - floor) + floor
+            head = self._waiters[0] if self._waiters else None
+            turn = head is None or head >= ticket
+            if turn and self.tokens >= need:
+                self.tokens -= weight
+                if queued:
+                    heapq.heappop(self._waiters)
+                return 0.0
+            if not queued:
+                heapq.heappush(self._waiters, ticket)
+            deficit = max(need - self.tokens, 0.0) / self.rate
+            return max(deficit, 0.005) if turn else max(deficit, 0.02)
+
+    def _drop(self, ticket):
+        with self._lock:
+            try:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+            except ValueError:
+                pass
+
+    def _account(self, priority, weight, waited):
+        with self._lock:
+            st = self.stats.get(priority) or self.stats.setdefault(priority, {'calls': 0, 'weight': 0, 'waited': 0, 'wait_s': 0.0})
+            st['calls'] += 1
+            st['weight'] += weight
+            if waited > 0:
+                st['waited'] += 1
+                st['wait_s'] += waited
+
+    async def acquire_async(self, weight, priority=None):
+        priority = priority or exchange_priority.get()
+        ticket = self._ticket(priority)
+        t0 = time.monotonic()
+        queued = False
+        try:
+            while True:
+                wait = self._try(ticket, weight, priority, queued)
+                if wait <= 0:
+                    queued = False
+                    break
+                queued = True
+                await asyncio.sleep(wait)
+        finally:
+            if queued:
+                self._drop(ticket)
+        self._account(priority, weight, time.monotonic() - t0)
+
+    def acquire_sync(self, weight, priority=None):
+        priority = priority or exchange_priority.get()
+        if _in_event_loop():
+            with self._lock:
+                self._refill(time.monotonic())
+                self.tokens -= weight
+            self._account(priority, weight, 0.0)
+            return
+        ticket = self._ticket(priority)
+        t0 = time.monotonic()
+        queued = False
+        try:
+            while True:
+                wait = self._try(ticket, weight, priority, queued)
+                if wait <= 0:
+                    queued = False
+                    break
+                queued = True
+                time.sleep(wait)
+        finally:
+            if queued:
+                self._drop(ticket)
+        self._account(priority, weight, time.monotonic() - t0)
+
+    def observe(self, client):
+        """Clamp the bucket to the exchange's own count (X-MBX-USED-WEIGHT-1M) after a response."""
+        try:
+            headers = getattr(client, 'last_response_headers', None) or {}
+            used = headers.get('x-mbx-used-weight-1m') or headers.get('X-MBX-USED-WEIGHT-1M')
+            if used is None:
+                return
+            with self._lock:
+                self.tokens = min(self.tokens, self.capacity - float(used))
+        except Exception:
+            pass
+
+rate_budget = RateBudget(capacity=settings.rate_budget_weight, window=settings.rate_budget_window,
+                         reserve=settings.rate_budget_reserve)
+
+def exchange_call_sync(method, symbol=None, **params):
+    """Coalesced, budgeted read through a pooled sync client: exchange_call_sync('fetch_order_book', sym, limit=200)."""
+    args = (symbol,) if symbol is not None else ()
+    weight = endpoint_weight(method, symbol, params)
+    def call():
+        rate_budget.acquire_sync(weight)
+        with sync_pool.client() as client:
+            try:
+                return getattr(client, method)(*args, **params)
+            finally:
+                rate_budget.observe(client)
+    return exchange_flight.call_sync(_flight_key(method, symbol, params), call, rank=priority_rank())
+
+async def exchange_call_async(method, symbol=None, **params):
+    """Coalesced, budgeted read through the async client; shares results with exchange_call_sync."""
+    args = (symbol,) if symbol is not None else ()
+    client = async_ex
+    weight = endpoint_weight(method, symbol, params)
+    async def call():
+        await rate_budget.acquire_async(weight)
+        try:
+            return await getattr(client, method)(*args, **params)
+        finally:
+            rate_budget.observe(client)
+    return await exchange_flight.call_async(_flight_key(method, symbol, params), call, rank=priority_rank())
+
+# ==================== 3d. Sync client pool ====================
+def _new_sync_client():
+    """Fresh sync client bound like sync_ex (recording proxy / shared replay client / plain ccxt)."""
+    if isinstance(sync_ex, ReplayExchange):
+        return sync_ex
+    ex = ccxt.binance({'enableRateLimit': True, 'options': {'defaultType': 'future'}})
+    if isinstance(sync_ex, RecordingExchange):
+        return RecordingExchange(ex, sync_ex._recorder, 'sync')
+    return ex
+
+class SyncExchangePool:
+    """Bounded pool of ccxt sync clients for threaded callers (Dash workers, CLI, selector switch).
+
+    A ccxt client keeps one requests.Session and its own throttle state, so it must not be
+    used by two threads at once. Each checkout gets an exclusive client; idle clients are
+    reused LIFO, which keeps their keep-alive connections warm. Markets loaded by one client
+    are handed to the others with set_markets, so only one of them ever calls exchangeInfo.
+    Threads wait up to `timeout` for a free client; the event-loop thread never waits and
+    gets a temporary overflow client instead.
+    """
+    def __init__(self, seed, size=4, timeout=30.0):
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.reset(seed)
+
+    def reset(self, seed):
+        with self._lock:
+            self._idle = queue.LifoQueue()
+            self._idle.put(seed)
+            self._created = 1
+            self._markets = None
+            self.stats = {'checkouts': 0, 'waits': 0, 'overflow': 0}
+
+    def set_markets(self, markets):
+        """Markets every pooled client gets on its next checkout (e.g. from the market cache)."""
+        with self._lock:
+            self._markets = (markets, None)
+        for ex in list(self._idle.queue):
+            try:
+                ex.set_markets(list(markets.values()))
+            except Exception:
+                pass
+
+    def _share_markets(self, ex):
+        try:
+            markets = getattr(ex, 'markets', None)
+            if markets:
+                if self._markets is None:
+                    self._markets = (markets, getattr(ex, 'currencies', None))
+            elif self._markets is not None:
+                ex.set_markets(list(self._markets[0].values()), self._markets[1])
+        except Exception as e:
+            log.debug(f"sync pool: set_markets failed: {e}")
+
+    def _checkout(self):
+        with self._lock:
+            self.stats['checkouts'] += 1
+        try:
+            return self._idle.get_nowait(), False
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return _new_sync_client(), False
+        if _in_event_loop():
+            with self._lock:
+                self.stats['overflow'] += 1
+            return _new_sync_client(), True
+        with self._lock:
+            self.stats['waits'] += 1
+        try:
+            return self._idle.get(timeout=self.timeout), False
+        except queue.Empty:
+            raise TimeoutError(f"no sync exchange client free within {self.timeout}s")
+
+    @contextlib.contextmanager
+    def client(self):
+        ex, overflow = self._checkout()
+        self._share_markets(ex)
+        try:
+            yield ex
+        finally:
+            self._share_markets(ex)
+            if not overflow:
+                self._idle.put(ex)
+
+sync_pool = SyncExchangePool(sync_ex, size=settings.sync_pool_size, timeout=settings.sync_pool_timeout)
+
+# ==================== 3e. Active state & locks ====================
 active_state = {
     'active_symbol': settings.symbol,
     'wallets': {},          # per-symbol wallets: symbol -> {position, trades}
@@ -1176,7 +1957,7 @@ active_state = {
 }
 state_lock = threading.Lock()  # for synchronous threads (Dash callbacks) access safety
 
-# ==================== 3c. SQLite persistence ====================
+# ==================== 3f. SQLite persistence ====================
 _db_path = "trades.db"
 
 def init_db():
@@ -1272,21 +2053,1361 @@ def load_trades_from_db(symbol):
         return {'position': 0.0, 'trades': []}
 
 # ==================== 4. DATA LOADER ====================
+class Candles:
+    """Array-backed OHLCV series: int64 epoch-ms `ts` plus contiguous float64 o/h/l/c/v columns.
+
+    This is the internal candle format. Columns are read as attributes or by name
+    (`candles.c`, `candles['c']`) and slicing returns views. Time-zone conversion and
+    DataFrame construction only happen in to_frame(), at the display/export edges.
+    """
+    COLUMNS = ('ts', 'o', 'h', 'l', 'c', 'v')
+    __slots__ = COLUMNS
+
+    def __init__(self, ts, o, h, l, c, v):
+        self.ts = np.asarray(ts, dtype=np.int64)
+        self.o = np.asarray(o, dtype=np.float64)
+        self.h = np.asarray(h, dtype=np.float64)
+        self.l = np.asarray(l, dtype=np.float64)
+        self.c = np.asarray(c, dtype=np.float64)
+        self.v = np.asarray(v, dtype=np.float64)
+
+    @classmethod
+    def empty(cls):
+        return cls(*([],) * 6)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build from ccxt's [[ts, o, h, l, c, v], ...] in one conversion (ms timestamps are exact in float64)."""
+        if not len(rows):
+            return cls.empty()
+        arr = np.asarray(rows, dtype=np.float64).reshape(-1, 6)
+        return cls(arr[:, 0].astype(np.int64), *(np.ascontiguousarray(arr[:, i]) for i in range(1, 6)))
+
+    @classmethod
+    def from_columns(cls, cols):
+        """Wrap a column dict (e.g. CandleArchive.read()) without copying."""
+        return cls(*(cols[col] for col in cls.COLUMNS))
+
+    @classmethod
+    def from_block(cls, block):
+        """Build from a (6, n) float64 block; every column is copied once into its own buffer."""
+        return cls(block[0].astype(np.int64), *(np.array(block[i]) for i in range(1, 6)))
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return Candles(*(getattr(self, col)[key] for col in self.COLUMNS))
+
+    def tail(self, n):
+        return self[-int(n):] if n else Candles.empty()
+
+    @property
+    def cv(self):
+        """(n, 2) float32 close/volume matrix used by the autoencoder windows."""
+        return np.column_stack([self.c, self.v]).astype(np.float32)
+
+    def timestamp(self, i=-1):
+        """Timestamp of bar `i` in display time (Europe/Kyiv)."""
+        return pd.Timestamp(int(self.ts[i]), unit='ms', tz='UTC').tz_convert('Europe/Kyiv')
+
+    def to_frame(self):
+        """Materialise as the legacy DataFrame (ts as tz-aware Europe/Kyiv datetimes)."""
+        df = pd.DataFrame({col: getattr(self, col) for col in self.COLUMNS})
+        df['ts'] = pd.to_datetime(df['ts'], unit='ms', utc=True).dt.tz_convert('Europe/Kyiv')
+        return df
+
+def _rows_to_frame(rows):
+    return Candles.from_rows(rows).to_frame()
+
+def _rows_to_block(raw):
+    """ccxt rows, a Candles or a (6, n) array -> (6, n) float64 block."""
+    if isinstance(raw, Candles):
+        return np.vstack([raw.ts.astype(np.float64), raw.o, raw.h, raw.l, raw.c, raw.v])
+    arr = np.asarray(raw, dtype=np.float64)
+    if arr.ndim == 2 and arr.shape[0] == 6 and arr.shape[1] != 6:
+        return arr
+    return arr.reshape(-1, 6).T
+
+@lru_cache(maxsize=64)
+def timeframe_ms(timeframe):
+    return int(ccxt.Exchange.parse_timeframe(timeframe) * 1000)
+
+class _CandleBuffer:
+    """Growable (6, capacity) float64 storage for one cached series.
+
+    Bars live in columns [lo, hi); appends are amortised O(1), dropping old bars just moves
+    `lo`, and the forming bar is overwritten in place.
+    """
+    __slots__ = ('data', 'lo', 'hi')
+
+    def __init__(self, capacity=256):
+        self.data = np.empty((6, max(16, int(capacity))), dtype=np.float64)
+        self.lo = self.hi = 0
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def last(self):
+        return self.data[:, self.hi - 1].tolist()
+
+    def last_ts(self):
+        return int(self.data[0, self.hi - 1])
+
+    def first_ts(self):
+        return int(self.data[0, self.lo])
+
+    def index_of(self, ts):
+        """Absolute column of the first bar with timestamp >= ts."""
+        return self.lo + int(np.searchsorted(self.data[0, self.lo:self.hi], ts, side='left'))
+
+    def _reserve(self, extra):
+        if self.hi + extra <= self.data.shape[1]:
+            return
+        n = len(self)
+        cap = self.data.shape[1]
+        if n + extra > cap // 2:
+            cap = max(2 * (n + extra), 16)
+        data = np.empty((6, cap), dtype=np.float64) if cap != self.data.shape[1] else self.data
+        data[:, :n] = self.data[:, self.lo:self.hi]
+        self.data, self.lo, self.hi = data, 0, n
+
+    def replace_from(self, block):
+        """Drop bars at or after block's first timestamp, then append the block."""
+        k = block.shape[1]
+        if not k:
+            return
+        self.hi = self.index_of(block[0, 0])
+        self._reserve(k)
+        self.data[:, self.hi:self.hi + k] = block
+        self.hi += k
+
+    def put(self, bar):
+        """Overwrite the last bar when `bar` has its timestamp, otherwise append."""
+        if len(self) and self.data[0, self.hi - 1] == bar[0]:
+            self.data[:, self.hi - 1] = bar
+            return
+        self._reserve(1)
+        self.data[:, self.hi] = bar
+        self.hi += 1
+
+    def trim(self, max_bars):
+        if max_bars and len(self) > max_bars:
+            self.lo = self.hi - int(max_bars)
+
+    def snapshot(self, limit):
+        lo = max(self.lo, self.hi - int(limit))
+        return Candles.from_block(self.data[:, lo:self.hi])
+
+class CandleCache:
+    """In-memory candle history per (symbol, timeframe).
+
+    The first request for a series downloads `limit` bars; later requests only ask the
+    exchange for bars from the last cached timestamp onwards. The last cached bar is the
+    one still forming, so it comes back in every incremental fetch and is replaced in place.
+    Bars are kept in columnar numpy buffers; candles() hands out array snapshots and frame()
+    builds a DataFrame only for the edges that still need one.
+    """
+    def __init__(self, max_series=256):
+        self.max_series = max_series
+        self._lock = threading.Lock()
+        self._series = collections.OrderedDict()
+
+    @staticmethod
+    def _changed(s):
+        s['version'] += 1
+        s['snap'] = None
+        s['df'] = None
+
+    def plan(self, symbol, timeframe, limit):
+        """Return (since, fetch_limit) for the next exchange call; since=None means full fetch."""
+        with self._lock:
+            s = self._series.get((symbol, timeframe))
+            if s is None or not len(s['buf']) or (len(s['buf']) < limit and not s['complete']):
+                return None, limit
+            last_ts = s['buf'].last_ts()
+        try:
+            missing = int((exchange_clock.time() * 1000 - last_ts) // timeframe_ms(timeframe)) + 2
+        except Exception:
+            return None, limit
+        if missing >= limit:
+            return None, limit
+        return last_ts, missing
+
+    def merge(self, symbol, timeframe, raw, limit, full=False):
+        """Merge exchange rows into the cached series (rows newer or equal to raw[0] are replaced)."""
+        key = (symbol, timeframe)
+        block = _rows_to_block(raw) if len(raw) else None
+        with self._lock:
+            s = self._series.get(key)
+            if s is None or full:
+                s = {'buf': _CandleBuffer(max(int(limit), 16) + 16), 'max_bars': 0, 'complete': False,
+                     'stream_ts': None, 'version': 0, 'snap': None, 'df': None}
+                self._series[key] = s
+            self._series.move_to_end(key)
+            while len(self._series) > self.max_series:
+                self._series.popitem(last=False)
+            s['max_bars'] = max(s['max_bars'], int(limit))
+            if full:
+                s['complete'] = len(raw) < limit
+            if block is None:
+                return
+            s['buf'].replace_from(block)
+            s['buf'].trim(s['max_bars'])
+            self._changed(s)
+
+    def candles(self, symbol, timeframe, limit):
+        """Return the last `limit` bars as a Candles snapshot (one memcpy per column, reused until the series changes)."""
+        with self._lock:
+            s = self._series.get((symbol, timeframe))
+            if s is None:
+                return Candles.empty()
+            snap = s['snap']
+            if snap is None or snap[0] != int(limit):
+                snap = s['snap'] = (int(limit), s['buf'].snapshot(limit))
+            return snap[1]
+
+    def frame(self, symbol, timeframe, limit):
+        """Return the last `limit` bars as a DataFrame (display/export edge; cached until the series changes)."""
+        candles = self.candles(symbol, timeframe, limit)
+        with self._lock:
+            s = self._series.get((symbol, timeframe))
+            cached = s['df'] if s is not None else None
+            if cached is not None and cached[0] is candles:
+                return cached[1].copy(deep=False)
+        df = candles.to_frame()
+        with self._lock:
+            s = self._series.get((symbol, timeframe))
+            if s is not None and s['snap'] is not None and s['snap'][1] is candles:
+                s['df'] = (candles, df)
+        return df.copy(deep=False)
+
+    def is_live(self, symbol, timeframe, limit):
+        """True when a push feed keeps this series current and it already covers `limit` bars."""
+        with self._lock:
+            s = self._series.get((symbol, timeframe))
+            if s is None or s['stream_ts'] is None:
+                return False
+            if time.monotonic() - s['stream_ts'] > settings.stream_stale_s:
+                return False
+            return len(s['buf']) >= limit or s['complete']
+
+    def tail_rows(self, symbol, timeframe, n):
+        """The newest `n` cached bars as [ts, o, h, l, c, v] rows (no snapshot churn)."""
+        with self._lock:
+            s = self._series.get((symbol, timeframe))
+            if s is None or not len(s['buf']):
+                return []
+            buf = s['buf']
+            rows = buf.data[:, max(buf.lo, buf.hi - int(n)):buf.hi].T.tolist()
+        return [[int(r[0])] + r[1:] for r in rows]
+
+    def last_bar(self, symbol, timeframe):
+        """The newest cached bar [ts, o, h, l, c, v] of a series, or None."""
+        with self._lock:
+            s = self._series.get((symbol, timeframe))
+            return list(s['buf'].last()) if s is not None and len(s['buf']) else None
+
+    def has(self, symbol, timeframe):
+        with self._lock:
+            s = self._series.get((symbol, timeframe))
+            return s is not None and len(s['buf']) > 0
+
+    def mark_streaming(self, symbol, timeframe):
+        with self._lock:
+            s = self._series.get((symbol, timeframe))
+            if s is not None and len(s['buf']):
+                s['stream_ts'] = time.monotonic()
+
+    def stop_streaming(self, symbol):
+        """Hand every series of `symbol` back to REST polling."""
+        with self._lock:
+            for (sym, _tf), s in self._series.items():
+                if sym == symbol:
+                    s['stream_ts'] = None
+
+    def _put_bar(self, s, bar, tf_ms):
+        buf = s['buf']
+        if not len(buf):
+            return False
+        last_ts = buf.last_ts()
+        if bar[0] == last_ts or bar[0] == last_ts + tf_ms:
+            buf.put(bar)
+            buf.trim(s['max_bars'])
+            self._changed(s)
+        elif bar[0] < last_ts:
+            # the exchange's final kline of the bar that just closed often lands after a trade already
+            # opened the next bucket: it replaces the trade-built bar in place; anything older is superseded
+            if len(buf) >= 2 and buf.data[0, buf.hi - 2] == bar[0]:
+                buf.data[:, buf.hi - 2] = bar
+                self._changed(s)
+            return True
+        else:
+            return False  # gap: REST has to fill it
+        return True
+
+    def apply_bar(self, symbol, timeframe, bar):
+        """Apply one pushed kline [ts, o, h, l, c, v]; the forming bar is replaced in place."""
+        with self._lock:
+            s = self._series.get((symbol, timeframe))
+            if s is None or not len(s['buf']):
+                return False
+            ok = self._put_bar(s, [int(bar[0])] + [float(x) for x in bar[1:6]], timeframe_ms(timeframe))
+            s['stream_ts'] = time.monotonic() if ok else None
+            return ok
+
+    def apply_trade(self, symbol, ts, price, amount=0.0):
+        """Move the forming bar of every cached timeframe of `symbol` to a traded price and add its volume."""
+        touched = False
+        with self._lock:
+            for (sym, tf), s in self._series.items():
+                if sym != symbol or not len(s['buf']) or s['stream_ts'] is None:
+                    continue
+                tf_ms = timeframe_ms(tf)
+                bucket = int(ts) // tf_ms * tf_ms
+                last = s['buf'].last()
+                if bucket == last[0]:
+                    bar = [last[0], last[1], max(last[2], price), min(last[3], price), price, last[5] + amount]
+                elif bucket > last[0]:
+                    bar = [bucket, price, price, price, price, amount]
+                else:
+                    continue
+                if self._put_bar(s, bar, tf_ms):
+                    s['stream_ts'] = time.monotonic()
+                    touched = True
+        return touched
+
+    def covers(self, symbol, timeframe, limit):
+        with self._lock:
+            s = self._series.get((symbol, timeframe))
+            return s is not None and len(s['buf']) > 0 and (len(s['buf']) >= limit or s['complete'])
+
+    def resample_into(self, symbol, base_tf, timeframe):
+        """Rebuild the forming (and any newer) bars of `timeframe` from the cached `base_tf` series.
+
+        Only base bars from the derived series' last bucket onwards are touched (from the one
+        before it when the base reaches back that far, so a late final kline of a just-closed
+        base bar reaches the closed derived bar too); each call costs O(bars per bucket).
+        Returns False when the base series does not reach back to the last bucket; the caller
+        then has to fetch the derived series itself.
+        """
+        with self._lock:
+            b = self._series.get((symbol, base_tf))
+            d = self._series.get((symbol, timeframe))
+            if b is None or d is None or not len(b['buf']) or not len(d['buf']):
+                return False
+            bbuf, dbuf = b['buf'], d['buf']
+            start = dbuf.last_ts()
+            if bbuf.first_ts() > start:
+                return False
+            if len(dbuf) >= 2 and bbuf.first_ts() <= int(dbuf.data[0, dbuf.hi - 2]):
+                start = int(dbuf.data[0, dbuf.hi - 2])
+            tf_ms = timeframe_ms(timeframe)
+            bar = None
+            for ts, o, h, l, c, v in bbuf.data[:, bbuf.index_of(start):bbuf.hi].T.tolist():
+                bucket = int(ts) // tf_ms * tf_ms
+                if bar is not None and bar[0] == bucket:
+                    bar[2] = max(bar[2], h); bar[3] = min(bar[3], l); bar[4] = c; bar[5] += v
+                    continue
+                if bar is not None and not self._put_bar(d, bar, tf_ms):
+                    return False
+                bar = [bucket, o, h, l, c, v]
+            if bar is not None and not self._put_bar(d, bar, tf_ms):
+                return False
+            d['stream_ts'] = b['stream_ts']
+            return True
+
+def derived_base_timeframe(timeframe):
+    """Base timeframe `timeframe` can be resampled from, or None if it has to be fetched directly."""
+    base = getattr(settings, 'base_timeframe', None)
+    if not getattr(settings, 'derive_timeframes', False) or not base or timeframe == base:
+        return None
+    if timeframe[-1] in ('w', 'M'):
+        return None  # week/month buckets are calendar-aligned, not epoch multiples
+    try:
+        tf_ms, base_ms = timeframe_ms(timeframe), timeframe_ms(base)
+    except Exception:
+        return None
+    if tf_ms <= base_ms or tf_ms % base_ms:
+        return None
+    return base
+
+# derived bars handed to the archive after each roll-up: the one that just closed plus slack;
+# anything older that was missed shows up as a gap and is backfilled from the exchange
+DERIVED_ARCHIVE_TAIL = 4
+
+def _base_window(timeframe, base):
+    return max(settings.chart_limit, 2 * (timeframe_ms(timeframe) // timeframe_ms(base)) + 2)
+
+candle_cache = CandleCache(max_series=settings.candle_cache_max_series)
+
 class OHLCV:
+    """Candle access. *_candles return array-backed Candles (hot paths); fetch/sync_fetch return DataFrames."""
     @staticmethod
     @retry(wait=wait_exponential(multiplier=1, min=2, max=10), stop=stop_after_attempt(3))
+    async def async_refresh(symbol, timeframe, limit):
+        """Bring the cached (symbol, timeframe) series up to date with as few exchange calls as possible."""
+        if candle_cache.is_live(symbol, timeframe, limit):
+            return
+        base = derived_base_timeframe(timeframe)
+        if base is not None and candle_cache.covers(symbol, timeframe, limit):
+            # refresh the shared base series and roll it up; no request for this timeframe
+            await OHLCV.async_refresh(symbol, base, _base_window(timeframe, base))
+            if candle_cache.resample_into(symbol, base, timeframe):
+                archive_closed_bars(symbol, timeframe, candle_cache.tail_rows(symbol, timeframe, DERIVED_ARCHIVE_TAIL))
+                return
+        seed_cache_from_archive(symbol, timeframe, limit)
+        since, fetch_limit = candle_cache.plan(symbol, timeframe, limit)
+        raw = await exchange_call_async('fetch_ohlcv', symbol, timeframe=timeframe, since=since, limit=fetch_limit)
+        candle_cache.merge(symbol, timeframe, raw, limit, full=since is None)
+        archive_closed_bars(symbol, timeframe, raw)
+
+    @staticmethod
+    def sync_refresh(symbol, timeframe, limit):
+        if candle_cache.is_live(symbol, timeframe, limit):
+            return
+        base = derived_base_timeframe(timeframe)
+        if base is not None and candle_cache.covers(symbol, timeframe, limit):
+            OHLCV.sync_refresh(symbol, base, _base_window(timeframe, base))
+            if candle_cache.resample_into(symbol, base, timeframe):
+                archive_closed_bars(symbol, timeframe, candle_cache.tail_rows(symbol, timeframe, DERIVED_ARCHIVE_TAIL))
+                return
+        seed_cache_from_archive(symbol, timeframe, limit)
+        since, fetch_limit = candle_cache.plan(symbol, timeframe, limit)
+        raw = exchange_call_sync('fetch_ohlcv', symbol, timeframe=timeframe, since=since, limit=fetch_limit)
+        candle_cache.merge(symbol, timeframe, raw, limit, full=since is None)
+        archive_closed_bars(symbol, timeframe, raw)
+
+    @staticmethod
+    async def async_fetch_candles(symbol, timeframe, limit):
+        await OHLCV.async_refresh(symbol, timeframe, limit)
+        return candle_cache.candles(symbol, timeframe, limit)
+
+    @staticmethod
+    def sync_fetch_candles(symbol, timeframe, limit):
+        OHLCV.sync_refresh(symbol, timeframe, limit)
+        return candle_cache.candles(symbol, timeframe, limit)
+
+    @staticmethod
     async def async_fetch(symbol, timeframe, limit):
-        raw = await async_ex.fetch_ohlcv(symbol, timeframe=timeframe, limit=limit)
-        df  = pd.DataFrame(raw, columns=['ts','o','h','l','c','v'])
-        df['ts'] = pd.to_datetime(df['ts'],unit='ms',utc=True).dt.tz_convert('Europe/Kyiv')
-        return df
+        await OHLCV.async_refresh(symbol, timeframe, limit)
+        return candle_cache.frame(symbol, timeframe, limit)
 
     @staticmethod
     def sync_fetch(symbol, timeframe, limit):
-        raw = sync_ex.fetch_ohlcv(symbol, timeframe=timeframe, limit=limit)
-        df  = pd.DataFrame(raw, columns=['ts','o','h','l','c','v'])
-        df['ts'] = pd.to_datetime(df['ts'],unit='ms',utc=True).dt.tz_convert('Europe/Kyiv')
-        return df
+        OHLCV.sync_refresh(symbol, timeframe, limit)
+        return candle_cache.frame(symbol, timeframe, limit)
+
+# ==================== 4a. STREAMING INGESTION ====================
+# Events passed from a transport to CandleStream are plain dicts:
+#   {'type': 'kline', 'symbol': 'BTC/USDT', 'timeframe': '1h', 'bar': [ts, o, h, l, c, v], 'E': event_ms}
+#   {'type': 'trade', 'symbol': 'BTC/USDT', 'ts': trade_ms, 'price': p, 'amount': a}
+class StreamTransport:
+    """Base push-feed transport. Subclasses deliver normalized events from next_event()."""
+    async def subscribe(self, symbol, timeframes):
+        pass
+
+    async def unsubscribe(self, symbol):
+        pass
+
+    async def next_event(self):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class QueueTransport(StreamTransport):
+    """Transport fed by push(); lets a local replay server or a test drive the stream."""
+    def __init__(self, maxsize=10000):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def push(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            log.warning("QueueTransport full, dropping %s event", event.get('type'))
+
+    async def next_event(self):
+        return await self.queue.get()
+
+class ReplayTransport(QueueTransport):
+    """Replays a JSONL (optionally gzipped) event file; speed=0 replays as fast as possible."""
+    def __init__(self, path, speed=0.0):
+        super().__init__()
+        self.path = path
+        self.speed = float(speed or 0.0)
+        self.symbols = set()
+        self._task = None
+
+    async def subscribe(self, symbol, timeframes):
+        self.symbols.add(symbol)
+        if self._task is None:
+            self._task = asyncio.create_task(self._feed())
+
+    async def unsubscribe(self, symbol):
+        self.symbols.discard(symbol)
+
+    async def _feed(self):
+        opener = gzip.open if str(self.path).endswith('.gz') else open
+        prev_t = None
+        with opener(self.path, 'rt', encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    ev = json.loads(line)
+                except Exception:
+                    continue
+                if ev.get('symbol') not in self.symbols:
+                    continue
+                t = ev.get('E') or ev.get('ts')
+                if self.speed > 0 and prev_t is not None and t is not None:
+                    await asyncio.sleep(max(0.0, (t - prev_t) / 1000.0 / self.speed))
+                prev_t = t if t is not None else prev_t
+                await self.queue.put(ev)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+class CcxtProTransport(QueueTransport):
+    """Binance kline/trade websockets through ccxt.pro watch_ohlcv / watch_trades."""
+    def __init__(self):
+        super().__init__()
+        self.ex = ccxt_pro.binance({'options': {'defaultType': 'future'}})
+        self._tasks = {}
+
+    async def subscribe(self, symbol, timeframes):
+        for tf in timeframes:
+            if (symbol, tf) not in self._tasks:
+                self._tasks[(symbol, tf)] = asyncio.create_task(self._watch_ohlcv(symbol, tf))
+        if (symbol, 'trades') not in self._tasks:
+            self._tasks[(symbol, 'trades')] = asyncio.create_task(self._watch_trades(symbol))
+
+    async def unsubscribe(self, symbol):
+        for key in [k for k in self._tasks if k[0] == symbol]:
+            self._tasks.pop(key).cancel()
+
+    async def _watch_ohlcv(self, symbol, timeframe):
+        while True:
+            try:
+                bars = await self.ex.watch_ohlcv(symbol, timeframe)
+                # the previous bar is re-sent so the exchange's final OHLCV of a just-closed bar
+                # replaces the trade-built one (CandleCache._put_bar overwrites it in place)
+                for bar in bars[-2:]:
+                    self.push({'type': 'kline', 'symbol': symbol, 'timeframe': timeframe, 'bar': list(bar)})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"watch_ohlcv {symbol} {timeframe} failed: {e}")
+                await asyncio.sleep(2)
+
+    async def _watch_trades(self, symbol):
+        while True:
+            try:
+                for t in await self.ex.watch_trades(symbol):
+                    self.push({'type': 'trade', 'symbol': symbol, 'ts': t.get('timestamp'),
+                               'price': t.get('price'), 'amount': t.get('amount')})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"watch_trades {symbol} failed: {e}")
+                await asyncio.sleep(2)
+
+    async def close(self):
+        for t in self._tasks.values():
+            t.cancel()
+        self._tasks.clear()
+        try:
+            await self.ex.close()
+        except Exception:
+            pass
+
+def make_stream_transport():
+    kind = getattr(settings, 'stream_transport', 'ccxtpro')
+    if kind == 'replay':
+        return ReplayTransport(settings.stream_replay_path, settings.stream_replay_speed)
+    if not _has_ccxtpro:
+        raise RuntimeError("stream_transport='ccxtpro' needs ccxt.pro")
+    return CcxtProTransport()
+
+class CandleStream:
+    """Keeps candle_cache series current from a push feed instead of fetch_ohlcv polling.
+
+    subscribe() seeds each series once over REST, after which OHLCV fetches for it are
+    served from memory. A detected gap drops the series back to REST until it is refilled.
+    Waiters (run_live) are woken only when a bar of settings.timeframes[0] closes or its
+    close moved by settings.stream_wake_move since the last wake, since every tick still
+    does REST work (order book) that must not follow the raw event rate.
+    """
+    def __init__(self, transport, cache=None):
+        self.transport = transport
+        self.cache = cache or candle_cache
+        self.subscribed = {}
+        self._events = {}
+        self._wake_ref = {}
+        self._task = None
+
+    def _event(self, symbol):
+        ev = self._events.get(symbol)
+        if ev is None:
+            ev = self._events[symbol] = asyncio.Event()
+        return ev
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def subscribe(self, symbol, timeframes, limit=None):
+        tfs = [tf for tf in timeframes if tf not in self.subscribed.get(symbol, ())]
+        if not tfs:
+            return
+        # derived timeframes are rolled up from their base feed, so only the base is pushed
+        wire = []
+        for tf in tfs:
+            base = derived_base_timeframe(tf)
+            if base is not None and base not in wire and base not in self.subscribed.get(symbol, ()):
+                await OHLCV.async_refresh(symbol, base, _base_window(tf, base))
+                self.cache.mark_streaming(symbol, base)
+                wire.append(base)
+            await OHLCV.async_refresh(symbol, tf, limit or settings.history_limit)
+            self.cache.mark_streaming(symbol, tf)
+            if base is None and tf not in wire:
+                wire.append(tf)
+        if wire:
+            await self.transport.subscribe(symbol, wire)
+        self.subscribed.setdefault(symbol, set()).update(tfs + wire)
+        log.info(f"CandleStream: subscribed {symbol} {tfs} (wire: {wire})")
+
+    async def unsubscribe(self, symbol):
+        if self.subscribed.pop(symbol, None) is not None:
+            self.cache.stop_streaming(symbol)
+            self._wake_ref.pop(symbol, None)
+            await self.transport.unsubscribe(symbol)
+
+    def apply(self, ev):
+        sym = ev.get('symbol')
+        if sym not in self.subscribed:
+            return False
+        if ev.get('type') == 'kline':
+            wire_tf = ev.get('timeframe')
+            prev = self.cache.last_bar(sym, wire_tf)
+            ok = self.cache.apply_bar(sym, wire_tf, ev.get('bar'))
+            if ok:
+                derived = [tf for tf in self.subscribed[sym] if derived_base_timeframe(tf) == wire_tf]
+                for tf in derived:
+                    self.cache.resample_into(sym, wire_tf, tf)
+                if prev is not None and int(ev['bar'][0]) != prev[0]:
+                    # a bar just closed (rollover, or its final kline after trades opened the next bucket):
+                    # stream-fed series never pass through the REST refresh that archives
+                    for tf in [wire_tf] + derived:
+                        archive_closed_bars(sym, tf, self.cache.tail_rows(sym, tf, DERIVED_ARCHIVE_TAIL))
+            return ok
+        if ev.get('type') == 'trade' and ev.get('price') is not None and ev.get('ts') is not None:
+            return self.cache.apply_trade(sym, ev['ts'], float(ev['price']), float(ev.get('amount') or 0.0))
+        return False
+
+    def _material(self, symbol):
+        """True when `symbol` closed a bar or moved enough since the last wake-up."""
+        bar = self.cache.last_bar(symbol, settings.timeframes[0])
+        if bar is None:
+            return True
+        ref = self._wake_ref.get(symbol)
+        if ref is None or bar[0] != ref[0] or ref[1] <= 0 or abs(bar[4] / ref[1] - 1) >= settings.stream_wake_move:
+            self._wake_ref[symbol] = (bar[0], bar[4])
+            return True
+        return False
+
+    async def run(self):
+        while True:
+            try:
+                ev = await self.transport.next_event()
+                if self.apply(ev) and self._material(ev['symbol']):
+                    self._event(ev['symbol']).set()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                log.debug(f"CandleStream event error: {e}")
+
+    async def wait_update(self, symbol, timeout):
+        """Wait until the next bar close / material move of `symbol` (True) or the timeout (False)."""
+        ev = self._event(symbol)
+        try:
+            await asyncio.wait_for(ev.wait(), timeout=max(0.0, timeout))
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            ev.clear()
+
+candle_stream = None
+
+# ==================== 4b. CANDLE ARCHIVE ====================
+class CandleArchive:
+    """Append-only columnar archive of closed bars for one (symbol, timeframe).
+
+    Every column is a raw little-endian file under <archive_dir>/<SYMBOL>/<timeframe>/
+    (ts.i8, o.f8, h.f8, l.f8, c.f8, v.f8) read through np.memmap, so read() returns
+    views into the page cache instead of copies and years of bars never sit in RAM at once.
+    Value columns are written before ts, so a torn append is ignored on the next open.
+    """
+    COLUMNS = (('ts', '<i8'), ('o', '<f8'), ('h', '<f8'), ('l', '<f8'), ('c', '<f8'), ('v', '<f8'))
+
+    def __init__(self, symbol, timeframe, root=None):
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self.dir = Path(root or settings.archive_dir) / symbol.replace('/', '_').replace(':', '_') / timeframe
+        self._lock = threading.Lock()
+        self._maps = None
+        self.gap_from = None        # ts the archive must be backfilled from before it grows again
+
+    def _path(self, col):
+        return self.dir / f"{col}.{'i8' if col == 'ts' else 'f8'}"
+
+    def __len__(self):
+        try:
+            return min(self._path(col).stat().st_size // 8 for col, _ in self.COLUMNS)
+        except FileNotFoundError:
+            return 0
+
+    def _columns(self):
+        n = len(self)
+        if self._maps is None or len(self._maps['ts']) != n:
+            if n == 0:
+                self._maps = {col: np.empty(0, dtype=dt) for col, dt in self.COLUMNS}
+            else:
+                self._maps = {col: np.memmap(self._path(col), dtype=dt, mode='r', shape=(n,)) for col, dt in self.COLUMNS}
+        return self._maps
+
+    def last_ts(self):
+        with self._lock:
+            ts = self._columns()['ts']
+            return int(ts[-1]) if len(ts) else None
+
+    def append(self, rows, allow_gap=False):
+        """Append closed bars [ts, o, h, l, c, v] that extend the archive contiguously.
+
+        Bars not newer than the last archived one are skipped. A bar more than one timeframe
+        after its predecessor would leave a hole read() can't show, so appending stops there
+        and `gap_from` records where backfill_archive has to resume. Backfill passes
+        allow_gap=True: a hole in a since-paged exchange response is real (e.g. maintenance).
+        """
+        if not rows:
+            return 0
+        tf_ms = timeframe_ms(self.timeframe)
+        with self._lock:
+            ts_col = self._columns()['ts']
+            last = int(ts_col[-1]) if len(ts_col) else None
+            new = sorted((r for r in rows if last is None or r[0] > last), key=lambda r: r[0])
+            prev = last
+            for j, r in enumerate(new):
+                if prev is not None and int(r[0]) - prev > tf_ms and not allow_gap:
+                    self.gap_from = prev + tf_ms
+                    new = new[:j]
+                    break
+                prev = int(r[0])
+            else:
+                self.gap_from = None
+            if not new:
+                return 0
+            self.dir.mkdir(parents=True, exist_ok=True)
+            n = len(ts_col)
+            for i, (col, dt) in reversed(list(enumerate(self.COLUMNS))):
+                with open(self._path(col), 'r+b' if self._path(col).exists() else 'wb') as fh:
+                    fh.seek(n * 8)
+                    fh.truncate()
+                    np.asarray([r[i] for r in new], dtype=dt).tofile(fh)
+            self._maps = None
+            return len(new)
+
+    def read(self, start_ts=None, end_ts=None, last_n=None):
+        """Zero-copy column views {'ts','o','h','l','c','v'} for [start_ts, end_ts) or the last `last_n` bars."""
+        with self._lock:
+            cols = self._columns()
+        ts = cols['ts']
+        lo = int(np.searchsorted(ts, start_ts, side='left')) if start_ts is not None else 0
+        hi = int(np.searchsorted(ts, end_ts, side='left')) if end_ts is not None else len(ts)
+        if last_n is not None:
+            lo = max(lo, hi - int(last_n))
+        return {col: cols[col][lo:hi] for col, _ in self.COLUMNS}
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+def candle_archive(symbol, timeframe):
+    with _archives_lock:
+        arc = _archives.get((symbol, timeframe))
+        if arc is None:
+            arc = _archives[(symbol, timeframe)] = CandleArchive(symbol, timeframe)
+        return arc
+
+_gap_backfills = set()
+
+def _backfill_gap(symbol, timeframe, since_ms):
+    """Fill an archive hole from the exchange in a background thread (one per series)."""
+    key = (symbol, timeframe)
+    with _archives_lock:
+        if key in _gap_backfills:
+            return
+        _gap_backfills.add(key)
+    def run():
+        exchange_priority.set('selector')
+        try:
+            added = backfill_archive(symbol, timeframe, since_ms)
+            log.info(f"Archive gap {symbol} {timeframe} from {pd.to_datetime(since_ms, unit='ms', utc=True)} filled: +{added} bars")
+        except Exception as e:
+            log.warning(f"Archive gap backfill failed for {symbol} {timeframe}: {e}")
+        finally:
+            with _archives_lock:
+                _gap_backfills.discard(key)
+    threading.Thread(target=run, daemon=True, name=f"archive-gap-{symbol}-{timeframe}").start()
+
+def archive_closed_bars(symbol, timeframe, rows):
+    """Append the closed bars among freshly fetched rows to the on-disk archive (best-effort).
+
+    Rows that don't continue the archive are held back and the hole is backfilled first.
+    """
+    if not getattr(settings, 'archive_enabled', False) or not len(rows):
+        return
+    try:
+        cutoff = exchange_clock.time() * 1000 - timeframe_ms(timeframe)
+        arc = candle_archive(symbol, timeframe)
+        arc.append([r for r in rows if r[0] <= cutoff])
+        if arc.gap_from is not None:
+            _backfill_gap(symbol, timeframe, arc.gap_from)
+    except Exception as e:
+        log.debug(f"archive append failed for {symbol} {timeframe}: {e}")
+
+def seed_cache_from_archive(symbol, timeframe, limit):
+    """Prime an empty cache series from the archive so a restart only fetches the missing tail."""
+    if not getattr(settings, 'archive_enabled', False) or candle_cache.has(symbol, timeframe):
+        return
+    try:
+        cols = candle_archive(symbol, timeframe).read(last_n=limit)
+        if len(cols['ts']):
+            candle_cache.merge(symbol, timeframe, Candles.from_columns(cols), limit)
+    except Exception as e:
+        log.debug(f"archive seed failed for {symbol} {timeframe}: {e}")
+
+def backfill_archive(symbol, timeframe, since_ms, page_limit=1000):
+    """Page through exchange history with `since` and append every closed bar to the archive."""
+    arc = candle_archive(symbol, timeframe)
+    tf_ms = timeframe_ms(timeframe)
+    cursor = max(int(since_ms), (arc.last_ts() or 0) + tf_ms)
+    total = 0
+    while cursor < exchange_clock.time() * 1000 - tf_ms:
+        raw = exchange_call_sync('fetch_ohlcv', symbol, timeframe=timeframe, since=cursor, limit=page_limit)
+        if not raw:
+            break
+        cutoff = exchange_clock.time() * 1000 - tf_ms
+        total += arc.append([r for r in raw if r[0] <= cutoff], allow_gap=True)
+        nxt = int(raw[-1][0]) + tf_ms
+        if nxt <= cursor:
+            break
+        cursor = nxt
+        log.info(f"Backfill {symbol} {timeframe}: {len(arc)} bars archived (up to {pd.to_datetime(raw[-1][0], unit='ms', utc=True)})")
+    return total
+
+# ==================== 4c. MARKET METADATA ====================
+class MarketCache:
+    """Market map persisted to disk with a TTL, plus the derived data the bot reads every cycle.
+
+    `universe()` is the selector's symbol list (USDT-only / leveraged-token / EXCLUDED_BASES
+    filters), computed once per market refresh and per filter setting instead of on every
+    scan. `meta(symbol)` has amount/price precision and limits for order sizing. Loading
+    also hands the markets to async_ex and the sync pool via set_markets, so neither
+    client downloads exchangeInfo on its own.
+    """
+    LEVERAGED_MARKERS = ('BULL', 'BEAR', 'UP', 'DOWN', '3L', '3S', '1D')
+
+    def __init__(self, path, ttl):
+        self.path = Path(path)
+        self.ttl = float(ttl)
+        self.markets = None
+        self.ts = 0.0
+        self._universe = {}
+        self._meta = {}
+        self._lock = threading.Lock()
+        self.tick_size = getattr(async_ex, 'precisionMode', None) == getattr(ccxt, 'TICK_SIZE', object())
+
+    def fresh(self):
+        return self.markets is not None and time.time() - self.ts < self.ttl
+
+    def _install(self, markets, ts):
+        meta = {}
+        for sym, m in markets.items():
+            try:
+                prec, lim = m.get('precision') or {}, m.get('limits') or {}
+                meta[sym] = {
+                    'id': m.get('id'),
+                    'amount_precision': prec.get('amount'),
+                    'price_precision': prec.get('price'),
+                    'min_amount': (lim.get('amount') or {}).get('min'),
+                    'max_amount': (lim.get('amount') or {}).get('max'),
+                    'min_cost': (lim.get('cost') or {}).get('min'),
+                    'contract_size': m.get('contractSize'),
+                }
+            except Exception:
+                continue
+        with self._lock:
+            self.markets, self.ts = markets, ts
+            self._universe, self._meta = {}, meta
+        for client in (async_ex,):
+            try:
+                client.set_markets(list(markets.values()))
+            except Exception as e:
+                log.debug(f"market cache: set_markets failed: {e}")
+        try:
+            sync_pool.set_markets(markets)
+        except Exception:
+            pass
+
+    def _load_disk(self):
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as fh:
+                blob = json.load(fh)
+            if time.time() - float(blob['ts']) < self.ttl and blob.get('markets'):
+                self._install(blob['markets'], float(blob['ts']))
+                log.info(f"Markets loaded from {self.path} ({len(self.markets)} markets)")
+                return True
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.debug(f"market cache: {self.path} unreadable: {e}")
+        return False
+
+    def _save_disk(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(self.path.suffix + '.tmp')
+            with gzip.open(tmp, 'wt', encoding='utf-8') as fh:
+                json.dump({'ts': self.ts, 'markets': self.markets}, fh, default=str)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            log.debug(f"market cache: save failed: {e}")
+
+    async def ensure_async(self):
+        """Fresh markets from memory, then disk, then one (budgeted) download."""
+        if self.fresh() or self._load_disk():
+            return self.markets
+        markets = await exchange_call_async('load_markets', reload=True)
+        self._install(_jsonable(markets), time.time())
+        self._save_disk()
+        return self.markets
+
+    def ensure_sync(self):
+        if self.fresh() or self._load_disk():
+            return self.markets
+        markets = exchange_call_sync('load_markets', reload=True)
+        self._install(_jsonable(markets), time.time())
+        self._save_disk()
+        return self.markets
+
+    def universe(self):
+        """Filtered scan universe for the current settings (cached until the markets or filters change)."""
+        key = (getattr(settings, 'scan_usdt_only', True), getattr(settings, 'skip_leveraged_tokens', True),
+               tuple(sorted(EXCLUDED_BASES)))
+        with self._lock:
+            cached = self._universe.get(key)
+            if cached is not None or self.markets is None:
+                return list(cached or [])
+            symbols = []
+            for s in self.markets:
+                if not isinstance(s, str):
+                    continue
+                if key[0] and not s.endswith('/USDT'):
+                    continue
+                if key[1] and any(x in s.upper() for x in self.LEVERAGED_MARKERS):
+                    continue
+                if s.split('/')[0].upper() in EXCLUDED_BASES:
+                    continue
+                symbols.append(s)
+            self._universe[key] = symbols
+            return list(symbols)
+
+    def meta(self, symbol):
+        with self._lock:
+            return self._meta.get(symbol) or self._meta.get(f"{symbol}:{symbol.split('/')[-1]}")
+
+    def _amount_step(self, m):
+        step = m.get('amount_precision')
+        if not step:
+            return None
+        # TICK_SIZE precision mode reports the step itself, DECIMAL_PLACES a digit count
+        return float(step) if self.tick_size else 10.0 ** -int(step)
+
+    def floor_amount(self, symbol, amount):
+        """Round `amount` down to the market's step."""
+        m = self.meta(symbol)
+        try:
+            step = self._amount_step(m) if m else None
+            return float(round(_math.floor(amount / step + 1e-9) * step, 12)) if step else amount
+        except Exception:
+            return amount
+
+    def min_order_amount(self, symbol, price):
+        """Smallest amount the market accepts at `price` (min amount / min notional, on the step grid)."""
+        m = self.meta(symbol)
+        if not m:
+            return 0.0
+        try:
+            need = m.get('min_amount') or 0.0
+            min_cost = m.get('min_cost') or 0.0
+            if price and min_cost:
+                step = self._amount_step(m)
+                by_cost = min_cost / price
+                if step:
+                    by_cost = _math.ceil(by_cost / step - 1e-9) * step
+                need = max(need, by_cost)
+            return float(round(need, 12))
+        except Exception:
+            return 0.0
+
+    def order_amount(self, symbol, amount, price):
+        """Round `amount` down to the market's step and lift it to the min amount / min notional."""
+        return max(self.floor_amount(symbol, amount), self.min_order_amount(symbol, price))
+
+market_cache = MarketCache(settings.market_cache_path, settings.market_cache_ttl)
+
+# ==================== 4d. LOCAL ORDER BOOK ====================
+# Depth-diff events share the stream event format:
+#   {'type': 'depth', 'symbol': 'BTC/USDT', 'E': event_ms, 'U': first_id, 'u': last_id, 'pu': prev_last_id,
+#    'bids': [[px, qty], ...], 'asks': [[px, qty], ...]}      (qty 0 removes the level)
+def _merge_levels(px, qty, levels):
+    """Apply [px, qty] updates to an ascending price-level array pair; qty 0 deletes the level."""
+    upd = np.asarray(levels, dtype=float).reshape(-1, 2)
+    if len(upd) == 0:
+        return px, qty
+    upd = upd[np.argsort(upd[:, 0], kind='stable')]
+    p, q = upd[:, 0], upd[:, 1]
+    idx = np.searchsorted(px, p)
+    if len(px):
+        hit = (idx < len(px)) & (px[np.minimum(idx, len(px) - 1)] == p)
+    else:
+        hit = np.zeros(len(p), dtype=bool)
+    qty = qty.copy()
+    qty[idx[hit]] = q[hit]
+    new = ~hit & (q > 0)
+    if new.any():
+        px = np.insert(px, idx[new], p[new])
+        qty = np.insert(qty, idx[new], q[new])
+    keep = qty > 0
+    if not keep.all():
+        px, qty = px[keep], qty[keep]
+    return px, qty
+
+class L2Book:
+    """Price-level book for one symbol kept current from depth diffs.
+
+    Both sides are stored as ascending (px, qty) arrays and swapped in as whole tuples, so
+    readers on other threads (Dash) always see a consistent side. Cumulative quantity and
+    notional are rebuilt lazily once per book version; depth, imbalance and VWAP-to-size
+    queries are then a searchsorted over them.
+
+    Sequencing follows Binance: after a snapshot with lastUpdateId L, diffs with u < L are
+    dropped, the first applied diff must span L (U <= L <= u) and every later one must
+    chain on the previous (pu == last u, or U == last u + 1 when pu is absent). A break
+    marks the book unsynced until the next snapshot.
+    """
+    def __init__(self, symbol, max_levels=1000):
+        self.symbol = symbol
+        self.max_levels = int(max_levels)
+        self._bids = (np.empty(0), np.empty(0))
+        self._asks = (np.empty(0), np.empty(0))
+        self._cum = None
+        self.last_id = None
+        self.synced = False
+        self._first = True
+        self.version = 0
+        self.updated = 0.0
+        self.gaps = 0
+
+    def load_snapshot(self, order_book):
+        """Reset from a REST book (ccxt fetch_order_book; its 'nonce' is lastUpdateId)."""
+        book = as_book_arrays(order_book, self.max_levels)
+        self._bids = (book.bid_px[::-1].copy(), book.bid_qty[::-1].copy())
+        self._asks = (book.ask_px.copy(), book.ask_qty.copy())
+        self.last_id = int(order_book['nonce'])
+        self.synced, self._first = True, True
+        self.version += 1
+        self.updated = exchange_clock.time()
+
+    def apply_diff(self, ev):
+        """Apply one depth event; False on a sequence gap (the book is then unsynced)."""
+        if not self.synced:
+            return False
+        U, u, pu = int(ev['U']), int(ev['u']), ev.get('pu')
+        if u < self.last_id:
+            return True
+        if self._first:
+            ok = U <= self.last_id + 1
+        else:
+            ok = int(pu) == self.last_id if pu is not None else U == self.last_id + 1
+        if not ok:
+            self.synced = False
+            self.gaps += 1
+            return False
+        bids = _merge_levels(*self._bids, ev.get('bids') or ())
+        asks = _merge_levels(*self._asks, ev.get('asks') or ())
+        n = self.max_levels
+        self._bids = (bids[0][-n:], bids[1][-n:])
+        self._asks = (asks[0][:n], asks[1][:n])
+        self.last_id, self._first = u, False
+        self.version += 1
+        self.updated = exchange_clock.time()
+        return True
+
+    def fresh(self, max_age=None):
+        max_age = getattr(settings, 'book_stale_s', 5.0) if max_age is None else max_age
+        return self.synced and exchange_clock.time() - self.updated <= max_age
+
+    def arrays(self):
+        (bpx, bq), (apx, aq) = self._bids, self._asks
+        return BookArrays(bpx[::-1], bq[::-1], apx, aq)
+
+    def _cums(self):
+        cum = self._cum
+        if cum is None or cum[0] != self.version:
+            version = self.version
+            b = self.arrays()
+            cum = (version, b,
+                   np.cumsum(b.bid_qty), np.cumsum(b.bid_px * b.bid_qty),
+                   np.cumsum(b.ask_qty), np.cumsum(b.ask_px * b.ask_qty))
+            self._cum = cum
+        return cum
+
+    def best_bid(self):
+        px = self._bids[0]
+        return float(px[-1]) if len(px) else None
+
+    def best_ask(self):
+        px = self._asks[0]
+        return float(px[0]) if len(px) else None
+
+    def mid(self):
+        bb, ba = self.best_bid(), self.best_ask()
+        if bb is None or ba is None:
+            return bb or ba
+        return (bb + ba) / 2.0
+
+    def depth(self, depth_pcts, mid=None):
+        """Quote notional within each of `depth_pcts` of `mid`: (bid_usd[], ask_usd[])."""
+        _, b, _, bid_n, _, ask_n = self._cums()
+        mid = self.mid() if mid is None else float(mid)
+        pcts = np.atleast_1d(np.asarray(depth_pcts, dtype=float))
+        if mid is None:
+            z = np.zeros(len(pcts))
+            return z, z
+        k_bid = np.searchsorted(-b.bid_px, -(mid * (1 - pcts)), side='right')
+        k_ask = np.searchsorted(b.ask_px, mid * (1 + pcts), side='right')
+        bid_usd = np.where(k_bid > 0, bid_n[np.maximum(k_bid - 1, 0)] if len(bid_n) else 0.0, 0.0)
+        ask_usd = np.where(k_ask > 0, ask_n[np.maximum(k_ask - 1, 0)] if len(ask_n) else 0.0, 0.0)
+        return bid_usd, ask_usd
+
+    def imbalance(self, depth_pct, mid=None):
+        """(bid - ask) / (bid + ask) notional within depth_pct of mid, in [-1, 1]."""
+        bid, ask = self.depth(depth_pct, mid)
+        tot = float(bid[0] + ask[0])
+        return float((bid[0] - ask[0]) / tot) if tot > 0 else 0.0
+
+    def vwap(self, side, amount):
+        """Average fill price of a market `side` ('buy' walks asks) for `amount`; None if the book is too thin."""
+        _, b, bid_q, bid_n, ask_q, ask_n = self._cums()
+        px, cq, cn = (b.ask_px, ask_q, ask_n) if side == 'buy' else (b.bid_px, bid_q, bid_n)
+        amount = float(amount)
+        if amount <= 0 or not len(cq):
+            return None
+        k = int(np.searchsorted(cq, amount, side='left'))
+        if k >= len(cq):
+            return None
+        prev_q = cq[k - 1] if k else 0.0
+        prev_n = cn[k - 1] if k else 0.0
+        return float((prev_n + (amount - prev_q) * px[k]) / amount)
+
+def _stream_id(symbol):
+    m = market_cache.meta(symbol) or {}
+    return str(m.get('id') or symbol.split(':')[0].replace('/', '')).lower()
+
+class BinanceDepthTransport(QueueTransport):
+    """Raw USD-M diff-depth websocket (<id>@depth@100ms); events keep Binance's U/u/pu ids."""
+    def __init__(self, url=None, speed=None):
+        super().__init__()
+        self.url = url or settings.book_ws_url
+        self.speed = speed or settings.book_ws_speed
+        self.streams = {}
+        self._ws = None
+        self._task = None
+        self._msg_id = 0
+
+    def _stream(self, symbol):
+        return f"{_stream_id(symbol)}@depth@{self.speed}"
+
+    async def _send(self, method, streams):
+        if self._ws is not None and streams:
+            self._msg_id += 1
+            try:
+                await self._ws.send_json({'method': method, 'params': list(streams), 'id': self._msg_id})
+            except Exception as e:
+                log.debug(f"depth ws {method} failed: {e}")
+
+    async def subscribe(self, symbol, timeframes=None):
+        stream = self._stream(symbol)
+        if stream in self.streams:
+            return
+        self.streams[stream] = symbol
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        else:
+            await self._send('SUBSCRIBE', [stream])
+
+    async def unsubscribe(self, symbol):
+        gone = [k for k, v in self.streams.items() if v == symbol]
+        for k in gone:
+            self.streams.pop(k, None)
+        await self._send('UNSUBSCRIBE', gone)
+
+    async def _run(self):
+        while True:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(self.url, heartbeat=30) as ws:
+                        self._ws = ws
+                        await self._send('SUBSCRIBE', list(self.streams))
+                        async for msg in ws:
+                            if msg.type != aiohttp.WSMsgType.TEXT:
+                                if msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                                    break
+                                continue
+                            data = json.loads(msg.data)
+                            sym = self.streams.get(data.get('stream'))
+                            d = data.get('data') or {}
+                            if sym is None or d.get('e') != 'depthUpdate':
+                                continue
+                            self.push({'type': 'depth', 'symbol': sym, 'E': d.get('E'), 'U': d.get('U'),
+                                       'u': d.get('u'), 'pu': d.get('pu'), 'bids': d.get('b'), 'asks': d.get('a')})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"depth websocket failed: {e}")
+            finally:
+                self._ws = None
+            # after a reconnect the first diff no longer chains on pu, so every book resyncs itself
+            await asyncio.sleep(2)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+def make_depth_transport():
+    kind = getattr(settings, 'book_transport', 'binance')
+    if kind == 'replay':
+        return ReplayTransport(settings.stream_replay_path, settings.stream_replay_speed)
+    if not _has_aiohttp:
+        raise RuntimeError("book_transport='binance' needs aiohttp")
+    return BinanceDepthTransport()
+
+class BookFeed:
+    """Local L2 books for the active and standby symbols.
+
+    Diffs that arrive while a book is (re)syncing are buffered and replayed on top of the
+    REST snapshot, so a gap costs one snapshot request rather than a stale book.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.books = {}
+        self._pending = {}
+        self._syncing = {}
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def track(self, symbols):
+        """Keep books for exactly `symbols`."""
+        want = [s for s in dict.fromkeys(symbols) if s]
+        for sym in [s for s in self.books if s not in want]:
+            self.books.pop(sym, None)
+            self._pending.pop(sym, None)
+            task = self._syncing.pop(sym, None)
+            if task is not None:
+                task.cancel()
+            await self.transport.unsubscribe(sym)
+        for sym in want:
+            if sym not in self.books:
+                self.books[sym] = L2Book(sym, settings.book_max_levels)
+                await self.transport.subscribe(sym, ['depth'])
+                self._resync(sym)
+
+    def book(self, symbol):
+        """The symbol's local book if it is synced and recently updated, else None."""
+        b = self.books.get(symbol)
+        return b if b is not None and b.fresh() else None
+
+    def _resync(self, sym):
+        if sym in self._syncing:
+            return
+        self._pending[sym] = collections.deque(maxlen=5000)
+        self._syncing[sym] = asyncio.create_task(self._snapshot(sym))
+
+    async def _snapshot(self, sym):
+        try:
+            ob = await exchange_call_async('fetch_order_book', sym, limit=settings.book_snapshot_limit)
+            book = self.books.get(sym)
+            if book is None:
+                return
+            book.load_snapshot(ob)
+            for ev in self._pending.pop(sym, ()):
+                if not book.apply_diff(ev):
+                    break
+            if not book.synced:
+                log.debug(f"BookFeed: {sym} snapshot did not chain on buffered diffs, retrying")
+                await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"BookFeed: snapshot for {sym} failed: {e}")
+            await asyncio.sleep(2)
+        finally:
+            self._syncing.pop(sym, None)
+        book = self.books.get(sym)
+        if book is not None and not book.synced:
+            self._resync(sym)
+
+    def apply(self, ev):
+        sym = ev.get('symbol')
+        book = self.books.get(sym)
+        if book is None or ev.get('type') != 'depth':
+            return False
+        if sym in self._syncing:
+            self._pending[sym].append(ev)
+            return False
+        if book.apply_diff(ev):
+            return True
+        log.info(f"BookFeed: sequence gap on {sym} (u={ev.get('u')}, last={book.last_id}), resyncing")
+        self._resync(sym)
+        self._pending[sym].append(ev)
+        return False
+
+    async def run(self):
+        exchange_priority.set('trading')
+        while True:
+            try:
+                self.apply(await self.transport.next_event())
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                log.debug(f"BookFeed event error: {e}")
+
+book_feed = None
+
+def local_order_book(symbol):
+    """Fresh local L2 book for `symbol` when book_mode='local', else None (callers fetch over REST)."""
+    feed = book_feed
+    return feed.book(symbol) if feed is not None else None
 
 # ==================== 5. UTILITY ====================
 
@@ -1360,6 +3481,7 @@ def execute_open_trade(sym, wallet, side, size, price, extra=None, dry=True):
         if not dry:
             async def _place():
                 try:
+                    await rate_budget.acquire_async(endpoint_weight('create_order'), 'order')
                     # prefer async_ex.create_order / create_market_buy/sell depending on exchange wrapper
                     if hasattr(async_ex, 'create_order') and asyncio.iscoroutinefunction(async_ex.create_order):
                         side_map = {'Long':'buy','Short':'sell'}
@@ -1496,107 +3618,812 @@ def execute_close_trade(sym, wallet, tr, exit_price, df_for_feat=None, reason=No
         log.exception(f"execute_close_trade failed: {e}")
         # Best-effort fallback: set wallet position to 0
         try:
-            wallet['position'] = 0.0
-        except Exception:
+            wallet['position'] = 0.0
+        except Exception:
+            pass
+        return None
+
+
+def compute_volatility(close, window):
+    close = np.asarray(close, dtype=float)
+    if len(close) < 2:
+        return 0.0
+    if len(close) < window + 1:
+        returns = np.diff(np.log(close + 1e-8))
+    else:
+        returns = np.diff(np.log(close[-(window+1):] + 1e-8))
+    return float(np.std(returns))
+
+def compute_atr(df, window=14):
+    high, low, close = (np.asarray(df[k], dtype=float) for k in ('h', 'l', 'c'))
+    if len(close) == 0:
+        return 1e-6
+    prev = np.concatenate([[np.nan], close[:-1]])
+    tr = np.fmax(high - low, np.fmax(np.abs(high - prev), np.abs(low - prev)))
+    val = tr[-window:].mean() if len(tr) >= window else np.nan
+    if np.isnan(val) or val <= 0:
+        return float(high[-1] - low[-1])
+    return float(val)
+
+def ema_last(values, span):
+    """Last value of pandas' ewm(span, adjust=False).mean() without building a Series.
+
+    Older bars carry weight (1 - alpha)^k, so only the tail that still matters at float64
+    precision is walked.
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return float('nan')
+    alpha = 2.0 / (span + 1.0)
+    tail = values[-max(64, int(40 / alpha)):]
+    ema = tail[0]
+    for x in tail[1:]:
+        ema = ema + alpha * (x - ema)
+    return float(ema)
+
+def safe_norm(value, lo, hi, eps=1e-8):
+    denom = hi - lo
+    if denom <= eps:
+        if value > hi:
+            return 1.0
+        if value < lo:
+            return 0.0
+        return 0.5
+    return float(np.clip((value - lo) / denom, 0.0, 1.0))
+
+# ==================== 5a. Incremental indicators ====================
+class IndicatorEngine:
+    """ATR / volatility / breakout channels / short EMA / volume mean for one (symbol, timeframe).
+
+    Closed bars are folded in once each: fixed-length deques with running sums for the
+    ATR, log-return and volume windows, monotonic deques for the channel extremes and the
+    EMA recurrence. The forming (last) bar is only combined in at query time, so values()
+    equals compute_atr / compute_volatility / the rolling(20) channels of closed bars /
+    ema_last(span=3) / the vol_window volume mean on the full series. If the series no
+    longer contains the last folded bar as a closed bar (gap, replaced history) the
+    state is rebuilt from the given arrays.
+    """
+    VERSION = 1
+    RESUM_EVERY = 1000   # recompute running sums from the deques to stop float drift
+
+    def __init__(self, atr_window=14, vol_window=60, chan_window=20, ema_span=3):
+        self.cfg = (int(atr_window), int(vol_window), int(chan_window), int(ema_span))
+        self.reset()
+
+    def reset(self):
+        atr_w, vol_w, chan_w, span = self.cfg
+        self.n = 0
+        self.last_ts = None
+        self.last_close = None
+        self.last_logc = None
+        self.tr = collections.deque(maxlen=atr_w - 1)
+        self.ret = collections.deque(maxlen=vol_w - 1)
+        self.vols = collections.deque(maxlen=vol_w - 1)
+        self.tr_sum = self.ret_sum = self.ret_sq = self.vol_sum = 0.0
+        self.hi = collections.deque()
+        self.lo = collections.deque()
+        self.ema = None
+        self.alpha = 2.0 / (span + 1.0)
+
+    @staticmethod
+    def _slide(dq, x):
+        """Append x; returns the value pushed out of a full deque (0.0 if none)."""
+        out = dq[0] if dq.maxlen and len(dq) == dq.maxlen else 0.0
+        dq.append(x)
+        return out
+
+    def _tr(self, h, l):
+        prev = self.last_close
+        return h - l if prev is None else max(h - l, abs(h - prev), abs(l - prev))
+
+    def fold(self, ts, h, l, c, v):
+        """Add one closed bar."""
+        tr = self._tr(h, l)
+        self.tr_sum += tr - self._slide(self.tr, tr)
+        logc = _math.log(c + 1e-8)
+        if self.last_logc is not None:
+            r = logc - self.last_logc
+            old = self._slide(self.ret, r)
+            self.ret_sum += r - old
+            self.ret_sq += r * r - old * old
+        self.vol_sum += v - self._slide(self.vols, v)
+        idx, chan_w = self.n, self.cfg[2]
+        while self.hi and self.hi[-1][1] <= h:
+            self.hi.pop()
+        self.hi.append((idx, h))
+        while self.lo and self.lo[-1][1] >= l:
+            self.lo.pop()
+        self.lo.append((idx, l))
+        while self.hi[0][0] <= idx - chan_w:
+            self.hi.popleft()
+        while self.lo[0][0] <= idx - chan_w:
+            self.lo.popleft()
+        self.ema = c if self.ema is None else self.ema + self.alpha * (c - self.ema)
+        self.n += 1
+        self.last_ts, self.last_close, self.last_logc = int(ts), c, logc
+        if self.n % self.RESUM_EVERY == 0:
+            self.tr_sum, self.vol_sum = float(sum(self.tr)), float(sum(self.vols))
+            self.ret_sum, self.ret_sq = float(sum(self.ret)), float(sum(r * r for r in self.ret))
+
+    def update(self, ts, h, l, c, v):
+        """Fold every closed bar of the arrays not seen yet; returns how many were folded."""
+        n = len(ts)
+        if n == 0:
+            return 0
+        start = 0
+        if self.last_ts is not None:
+            i = int(np.searchsorted(ts, self.last_ts))
+            if i < n - 1 and int(ts[i]) == self.last_ts:
+                start = i + 1
+            else:
+                self.reset()
+        for j in range(start, n - 1):
+            self.fold(ts[j], float(h[j]), float(l[j]), float(c[j]), float(v[j]))
+        return max(0, n - 1 - start)
+
+    def values(self, h, l, c, v):
+        """Indicator values with the forming bar (h, l, c, v) on top of the folded closed bars."""
+        atr_w, vol_w, chan_w, _ = self.cfg
+        bars = self.n + 1
+        tr = self._tr(h, l)
+        atr = (self.tr_sum + tr) / atr_w if bars >= atr_w else float('nan')
+        if not atr > 0:
+            atr = h - l
+        if self.last_logc is None:
+            vol = 0.0
+        else:
+            r = _math.log(c + 1e-8) - self.last_logc
+            k = len(self.ret) + 1
+            mean = (self.ret_sum + r) / k
+            vol = _math.sqrt(max(0.0, (self.ret_sq + r * r) / k - mean * mean))
+        if self.n >= chan_w:
+            chan_high, chan_low = self.hi[0][1], self.lo[0][1]
+        else:
+            chan_high = max(self.hi[0][1], h) if self.hi else h
+            chan_low = min(self.lo[0][1], l) if self.lo else l
+        ema = c if self.ema is None else self.ema + self.alpha * (c - self.ema)
+        vol_mean = (self.vol_sum + v) / (len(self.vols) + 1)
+        return {'bars': bars, 'atr': float(atr), 'vol': float(vol), 'chan_high': float(chan_high),
+                'chan_low': float(chan_low), 'ema': float(ema), 'vol_mean': float(vol_mean)}
+
+class IndicatorRegistry:
+    """IndicatorEngine per (symbol, timeframe), pickled to indicator_state_dir for warm restarts."""
+    def __init__(self, root):
+        self.root = Path(root) if root else None
+        self._engines = {}
+        self._saved = {}
+        self._lock = threading.Lock()
+
+    def _path(self, symbol, timeframe):
+        return self.root / f"{symbol.replace('/', '_').replace(':', '_')}_{timeframe}.pkl"
+
+    def _load(self, symbol, timeframe, cfg):
+        if self.root is None:
+            return None
+        try:
+            with open(self._path(symbol, timeframe), 'rb') as fh:
+                eng = _pickle.load(fh)
+            if isinstance(eng, IndicatorEngine) and getattr(eng, 'VERSION', None) == IndicatorEngine.VERSION and eng.cfg == cfg:
+                return eng
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.debug(f"indicator state for {symbol} {timeframe} unreadable: {e}")
+        return None
+
+    def _save(self, key, eng):
+        if self.root is None:
+            return
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            path = self._path(*key)
+            tmp = path.with_suffix('.tmp')
+            with open(tmp, 'wb') as fh:
+                _pickle.dump(eng, fh, protocol=_pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except Exception as e:
+            log.debug(f"indicator state save failed for {key}: {e}")
+
+    def compute(self, symbol, timeframe, ts, h, l, c, v):
+        cfg = (14, int(settings.vol_window), 20, 3)
+        key = (symbol, timeframe)
+        with self._lock:
+            ent = self._engines.get(key)
+            if ent is None:
+                ent = self._engines[key] = (self._load(symbol, timeframe, cfg) or IndicatorEngine(*cfg), threading.Lock())
+        eng, lock = ent
+        with lock:
+            if eng.cfg != cfg:
+                eng.__init__(*cfg)
+            folded = eng.update(ts, h, l, c, v)
+            vals = eng.values(float(h[-1]), float(l[-1]), float(c[-1]), float(v[-1]))
+            now = time.time()
+            if folded and now - self._saved.get(key, 0.0) >= getattr(settings, 'indicator_snapshot_interval', 60):
+                self._saved[key] = now
+                self._save(key, eng)
+        return vals
+
+    def candles(self, symbol, timeframe, candles):
+        return self.compute(symbol, timeframe, candles.ts, candles.h, candles.l, candles.c, candles.v)
+
+    def frame(self, symbol, timeframe, df):
+        """Same for a legacy frame indexed by tz-aware ts."""
+        ts = df.index.asi8 // 1_000_000
+        return self.compute(symbol, timeframe, ts, df['h'].values, df['l'].values, df['c'].values, df['v'].values)
+
+indicators = IndicatorRegistry(getattr(settings, 'indicator_state_dir', None))
+
+def weighted_quantiles(items, weights, qs):
+    """Quantiles of `items` where item i stands for weights[i] copies.
+
+    Linear interpolation between neighbouring copies, so with unit weights the result is
+    exactly np.percentile(items, 100 * q).
+    """
+    items = np.asarray(items, dtype=float)
+    if len(items) == 0:
+        return np.full(len(np.atleast_1d(qs)), np.nan)
+    order = np.argsort(items, kind='stable')
+    return _sorted_quantiles(items[order], np.cumsum(np.asarray(weights, dtype=float)[order]), qs)
+
+def _sorted_quantiles(items, cum, qs):
+    """weighted_quantiles for items already in ascending order with cumulative weights `cum`."""
+    qs = np.atleast_1d(np.asarray(qs, dtype=float))
+    if len(items) == 0:
+        return np.full(len(qs), np.nan)
+    pos = qs * (cum[-1] - 1.0)
+    lo = np.floor(pos)
+    i_lo = np.minimum(np.searchsorted(cum, lo, side='right'), len(items) - 1)
+    i_hi = np.minimum(np.searchsorted(cum, lo + 1.0, side='right'), len(items) - 1)
+    return items[i_lo] + (pos - lo) * (items[i_hi] - items[i_lo])
+
+class QuantileSketch:
+    """Mergeable KLL-style quantile sketch.
+
+    Values go into a level-0 buffer; a level that reaches k items is sorted and every other
+    item (random offset) moves up a level with twice the weight. add() is amortised O(1),
+    memory is O(k log(n/k)) and merging is concatenating levels. Until the first compaction
+    quantiles equal np.percentile.
+    """
+    def __init__(self, k=256):
+        self.k = int(k)
+        self.n = 0
+        self.levels = [[]]
+
+    def add(self, x):
+        self.levels[0].append(float(x))
+        self.n += 1
+        if len(self.levels[0]) >= self.k:
+            self._compact()
+
+    def _compact(self):
+        lvl = 0
+        while lvl < len(self.levels):
+            items = self.levels[lvl]
+            if len(items) >= self.k:
+                items.sort()
+                keep = [items.pop(random.randrange(len(items)))] if len(items) % 2 else []
+                promoted = items[random.getrandbits(1)::2]
+                self.levels[lvl] = keep
+                if lvl + 1 == len(self.levels):
+                    self.levels.append([])
+                self.levels[lvl + 1].extend(promoted)
+            lvl += 1
+
+    def merge(self, other):
+        for lvl, items in enumerate(other.levels):
+            if lvl == len(self.levels):
+                self.levels.append([])
+            self.levels[lvl].extend(items)
+        self.n += other.n
+        self._compact()
+        return self
+
+    def weighted(self):
+        items = np.fromiter(itertools.chain.from_iterable(self.levels), dtype=float)
+        weights = np.repeat([2.0 ** lvl for lvl in range(len(self.levels))], [len(x) for x in self.levels])
+        return items, weights
+
+    def quantiles(self, qs):
+        return weighted_quantiles(*self.weighted(), qs)
+
+    def to_dict(self):
+        return {'k': self.k, 'n': self.n, 'levels': self.levels}
+
+    @classmethod
+    def from_dict(cls, d):
+        sk = cls(d.get('k', 256))
+        sk.n = int(d.get('n', 0))
+        sk.levels = [list(map(float, lvl)) for lvl in d.get('levels') or [[]]]
+        return sk
+
+class WindowedQuantiles:
+    """Quantiles over roughly the last `window` observations, replacing np.percentile on a deque.
+
+    The window is a ring of `buckets` QuantileSketch instances; when the newest one has
+    seen window/buckets values the oldest is dropped, so a query covers between
+    (buckets-1)/buckets and all of the window. k defaults to half a bucket (32..256)
+    so every bucket compacts to O(k log) items whatever the window. The closed buckets
+    are kept sorted between rotations and a query only sorts the live bucket and merges it
+    in, so its cost is bounded by the sketch size, not the window.
+    """
+    def __init__(self, window, buckets=4, k=None):
+        self.window = int(window)
+        self.buckets = int(buckets)
+        self.size = max(1, self.window // self.buckets)
+        self.k = int(k) if k else int(np.clip(self.size // 2, 32, 256))
+        self.ring = collections.deque([QuantileSketch(self.k)], maxlen=self.buckets)
+        self.last = None
+        self._closed = None
+        self._lock = threading.Lock()
+
+    def add(self, x):
+        with self._lock:
+            if self.ring[-1].n >= self.size:
+                self.ring.append(QuantileSketch(self.k))
+                self._closed = None
+            self.ring[-1].add(x)
+            self.last = float(x)
+
+    def __len__(self):
+        return sum(s.n for s in self.ring)
+
+    def quantiles(self, qs):
+        with self._lock:
+            if self._closed is None:
+                # full buckets only change on rotation: keep their items sorted once
+                parts = [s.weighted() for s in list(self.ring)[:-1]] or [(np.empty(0), np.empty(0))]
+                items, weights = np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+                order = np.argsort(items, kind='stable')
+                self._closed = (items[order], weights[order])
+            live, live_w = self.ring[-1].weighted()
+            closed, closed_w = self._closed
+        order = np.argsort(live, kind='stable')
+        # live items go after equal closed ones, the same order a stable sort of closed+live gives
+        at = np.searchsorted(closed, live[order], side='right')
+        items = np.insert(closed, at, live[order])
+        return _sorted_quantiles(items, np.cumsum(np.insert(closed_w, at, live_w[order])), qs)
+
+    def merged(self):
+        """All buckets folded into one QuantileSketch."""
+        with self._lock:
+            out = QuantileSketch(self.k)
+            for s in self.ring:
+                out.merge(QuantileSketch.from_dict(s.to_dict()))
+        return out
+
+    def to_dict(self):
+        with self._lock:
+            return {'window': self.window, 'buckets': self.buckets, 'k': self.k, 'last': self.last,
+                    'ring': [s.to_dict() for s in self.ring]}
+
+    @classmethod
+    def from_dict(cls, d):
+        wq = cls(d['window'], d.get('buckets', 4))   # restored buckets keep their own k until they rotate out
+        ring = [QuantileSketch.from_dict(s) for s in d.get('ring') or []]
+        if ring:
+            wq.ring = collections.deque(ring, maxlen=wq.buckets)
+        wq.last = d.get('last')
+        return wq
+
+class SketchStore:
+    """Named WindowedQuantiles persisted as JSON in SQLite so adaptive thresholds survive restarts."""
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+        self._sketches = {}
+        self._saved = 0.0
+        try:
+            with self._lock:
+                conn.execute("""
+                  CREATE TABLE IF NOT EXISTS quantile_sketches (
+                    name TEXT PRIMARY KEY,
+                    state JSON,
+                    ts REAL
+                  )
+                """)
+                conn.commit()
+        except Exception as e:
+            log.warning(f"quantile sketch table unavailable, sketches will not persist: {e}")
+
+    def get(self, name, window):
+        """The persisted sketch `name` (a new one if missing or sized for another window); tracked for saving."""
+        sk = None
+        try:
+            with self._lock:
+                row = self._conn.execute("SELECT state FROM quantile_sketches WHERE name=?", (name,)).fetchone()
+            if row and row[0]:
+                sk = WindowedQuantiles.from_dict(json.loads(row[0]))
+                if sk.window != int(window):
+                    sk = None
+        except Exception as e:
+            log.debug(f"quantile sketch {name} unreadable: {e}")
+        sk = sk or WindowedQuantiles(window)
+        self._sketches[name] = sk
+        return sk
+
+    def flush(self, force=False):
+        now = time.time()
+        if not force and now - self._saved < getattr(settings, 'sketch_save_interval', 60):
+            return
+        self._saved = now
+        try:
+            rows = [(name, json.dumps(sk.to_dict()), now) for name, sk in list(self._sketches.items())]
+            with self._lock:
+                self._conn.executemany("INSERT OR REPLACE INTO quantile_sketches (name, state, ts) VALUES (?, ?, ?)", rows)
+                self._conn.commit()
+        except Exception as e:
+            log.debug(f"quantile sketch save failed: {e}")
+
+sketch_store = SketchStore(_db)
+atexit.register(sketch_store.flush, True)
+
+# ==================== 5b. Liquidity & MarketCap helpers ====================
+COINGECKO_IDS = {
+    'btc': 'bitcoin', 'eth': 'ethereum', 'xrp': 'ripple', 'ada':'cardano', 'bnb':'binancecoin',
+    'sol':'solana', 'doge':'dogecoin', 'ltc':'litecoin', 'link':'chainlink', 'matic':'polygon'
+}
+
+def _mcap_base(symbol):
+    return symbol.split('/')[0].lower()
+
+class MarketCapFetchError(Exception):
+    """A bulk fetch failed part-way: `partial` holds what was fetched, `failed` the bases still unanswered."""
+    def __init__(self, cause, partial, failed):
+        super().__init__(f"{cause} ({len(failed)} bases unanswered)")
+        self.partial = partial
+        self.failed = set(failed)
+
+class CoinGeckoProvider:
+    """Bulk market caps from /coins/markets, up to `batch` ids per request."""
+    url = "https://api.coingecko.com/api/v3/coins/markets"
+
+    def __init__(self, batch=250, timeout=10):
+        self.batch = int(batch)
+        self.timeout = timeout
+
+    def fetch(self, bases):
+        """{base: market_cap} for the bases CoinGecko knows.
+
+        Stops at the first failed chunk and raises MarketCapFetchError carrying the
+        chunks fetched so far and the bases left unanswered.
+        """
+        ids = {COINGECKO_IDS.get(b, b): b for b in bases}
+        out = {}
+        keys = list(ids)
+        for i in range(0, len(keys), self.batch):
+            chunk = keys[i:i + self.batch]
+            try:
+                r = requests.get(self.url, params={'vs_currency': 'usd', 'ids': ','.join(chunk), 'per_page': len(chunk)},
+                                 timeout=self.timeout)
+                r.raise_for_status()
+                rows = r.json() or []
+            except Exception as e:
+                raise MarketCapFetchError(e, out, [ids[k] for k in keys[i:]]) from e
+            for row in rows:
+                base = ids.get(row.get('id'))
+                if base is not None and row.get('market_cap') is not None:
+                    out[base] = float(row['market_cap'])
+        return out
+
+class StubMarketCapProvider:
+    """Offline provider: fixed {base: market_cap} values, optionally read from a JSON file."""
+    def __init__(self, values=None, path=None):
+        self.values = {k.lower(): float(v) for k, v in (values or {}).items()}
+        if path:
+            with open(path, 'r', encoding='utf-8') as fh:
+                self.values.update({k.lower(): float(v) for k, v in json.load(fh).items()})
+
+    def fetch(self, bases):
+        return {b: self.values[b] for b in bases if b in self.values}
+
+def make_marketcap_provider():
+    if getattr(settings, 'marketcap_provider', 'coingecko') == 'stub':
+        return StubMarketCapProvider(path=getattr(settings, 'marketcap_stub_path', None))
+    return CoinGeckoProvider(batch=getattr(settings, 'coingecko_batch', 250))
+
+class MarketCapCache:
+    """Per-symbol market caps with a TTL, refreshed in bulk by a background thread.
+
+    get() never blocks: it returns the cached value (stale ones too, so an offline
+    provider keeps serving the last known caps up to max_stale) and registers the symbol
+    so the refresher fetches it with the next batch. Bases nobody asked for within
+    max_stale drop out of the batch (and their entries out of the cache). The cache is
+    persisted for warm restarts the same way the market cache is.
+    """
+    def __init__(self, provider, path, ttl, max_stale):
+        self.provider = provider
+        self.path = Path(path) if path else None
+        self.ttl = float(ttl)
+        self.max_stale = float(max_stale)
+        self.entries = {}
+        self.wanted = set()
+        self.asked = {}   # base -> last time want()/get() asked for it
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._load_disk()
+
+    def _load_disk(self):
+        if self.path is None:
+            return
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as fh:
+                blob = json.load(fh)
+            with self._lock:
+                self.entries.update({k: (v[0], float(v[1])) for k, v in blob.get('entries', {}).items()})
+                self.wanted.update(self.entries)
+                self.asked.update({k: v[1] for k, v in self.entries.items()})
+        except FileNotFoundError:
             pass
-        return None
+        except Exception as e:
+            log.debug(f"marketcap cache: {self.path} unreadable: {e}")
 
+    def _save_disk(self):
+        if self.path is None:
+            return
+        try:
+            with self._lock:
+                blob = {'entries': {k: list(v) for k, v in self.entries.items()}}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(self.path.suffix + '.tmp')
+            with gzip.open(tmp, 'wt', encoding='utf-8') as fh:
+                json.dump(blob, fh)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            log.debug(f"marketcap cache: save failed: {e}")
 
-def compute_volatility(close, window):
-    close = np.asarray(close, dtype=float)
-    if len(close) < 2:
-        return 0.0
-    if len(close) < window + 1:
-        returns = np.diff(np.log(close + 1e-8))
-    else:
-        returns = np.diff(np.log(close[-(window+1):] + 1e-8))
-    return float(np.std(returns))
+    def want(self, symbols):
+        new = False
+        now = time.time()
+        with self._lock:
+            for sym in symbols:
+                base = _mcap_base(sym)
+                self.asked[base] = now
+                if base not in self.wanted:
+                    self.wanted.add(base)
+                    new = new or base not in self.entries
+        if new:
+            self._wake.set()
+
+    def get(self, symbol):
+        base = _mcap_base(symbol)
+        with self._lock:
+            ent = self.entries.get(base)
+            self.asked[base] = time.time()
+        if ent is None or time.time() - ent[1] >= self.ttl:
+            self.want([symbol])
+            self._wake.set()
+        if ent is None or time.time() - ent[1] > self.max_stale:
+            return None
+        return ent[0]
 
-def compute_atr(df, window=14):
-    high, low, close = df['h'], df['l'], df['c']
-    tr1 = high - low
-    tr2 = (high - close.shift()).abs()
-    tr3 = (low  - close.shift()).abs()
-    tr = pd.concat([tr1, tr2, tr3], axis=1).max(axis=1)
-    val = tr.rolling(window).mean().iloc[-1]
-    if np.isnan(val) or val <= 0:
-        return float((high - low).iloc[-1] if len(df) >= 1 else 1e-6)
-    return float(val)
+    def _prune(self, now):
+        """Forget bases not asked for within max_stale (caller holds the lock)."""
+        for base in [b for b in self.wanted if now - self.asked.get(b, 0.0) > self.max_stale]:
+            self.wanted.discard(base)
+            self.asked.pop(base, None)
+        for base in [b for b, ent in self.entries.items() if b not in self.wanted and now - ent[1] > self.max_stale]:
+            del self.entries[base]
 
-def safe_norm(value, lo, hi, eps=1e-8):
-    denom = hi - lo
-    if denom <= eps:
-        if value > hi:
-            return 1.0
-        if value < lo:
-            return 0.0
-        return 0.5
-    return float(np.clip((value - lo) / denom, 0.0, 1.0))
+    def due(self):
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            return sorted(b for b in self.wanted
+                          if b not in self.entries or now - self.entries[b][1] >= self.ttl)
+
+    def refresh(self):
+        """Fetch every due base in one bulk call; returns how many were updated.
+
+        On a partial failure the answered chunks are stored before the error propagates,
+        so the retry after the backoff only asks for the rest.
+        """
+        bases = self.due()
+        if not bases:
+            return 0
+        failed, err = set(), None
+        try:
+            got = self.provider.fetch(bases)
+        except MarketCapFetchError as e:
+            got, failed, err = e.partial, e.failed, e
+        now = time.time()
+        with self._lock:
+            for base in bases:
+                if base in failed:
+                    continue
+                # unknown ids are remembered as None so they are not re-queried every cycle
+                self.entries[base] = (got.get(base), now)
+        if len(failed) < len(bases):
+            self._save_disk()
+        if err is not None:
+            raise err
+        return len(got)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='marketcap-refresh', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                n = self.refresh()
+                self.failures = 0
+                if n:
+                    log.debug(f"marketcap cache: refreshed {n} symbols")
+            except Exception as e:
+                self.failures += 1
+                log.debug(f"marketcap refresh failed ({self.failures}x), serving cached values: {e}")
+                time.sleep(min(self.ttl, 15.0 * 2 ** min(self.failures, 6)))
+                continue
+            self._wake.wait(timeout=self.ttl)
 
-# ==================== 5b. Liquidity & MarketCap helpers ====================
-_coingecko_cache = {'ts': 0.0, 'symbol': None, 'market_cap': None}
+marketcap_cache = MarketCapCache(make_marketcap_provider(), settings.marketcap_cache_path,
+                                 settings.coingecko_ttl, settings.marketcap_max_stale)
 
 def fetch_marketcap_coingecko(symbol):
+    """Cached market cap for `symbol` (None until the background refresher has it)."""
     if not getattr(settings, 'coingecko_enabled', True):
         return None
     try:
-        now = time.time()
-        base = symbol.split('/')[0].lower()
-        if (_coingecko_cache.get('symbol') == base) and (now - _coingecko_cache.get('ts',0) < settings.coingecko_ttl):
-            return _coingecko_cache.get('market_cap')
-
-        cg_map = {
-            'btc': 'bitcoin', 'eth': 'ethereum', 'xrp': 'ripple', 'ada':'cardano', 'bnb':'binancecoin',
-            'sol':'solana', 'doge':'dogecoin', 'ltc':'litecoin', 'link':'chainlink', 'matic':'polygon'
-        }
-        cg_id = cg_map.get(base, base)
-        url = "https://api.coingecko.com/api/v3/coins/markets"
-        params = {'vs_currency':'usd', 'ids': cg_id}
-        r = requests.get(url, params=params, timeout=5)
-        if r.status_code == 200:
-            data = r.json()
-            if isinstance(data, list) and len(data)>0 and 'market_cap' in data[0]:
-                mc = float(data[0].get('market_cap') or 0.0)
-                _coingecko_cache.update({'ts': now, 'symbol': base, 'market_cap': mc})
-                return mc
+        marketcap_cache.start()
+        return marketcap_cache.get(symbol)
     except Exception as e:
-        log.debug(f"CoinGecko marketcap fetch failed for {symbol}: {e}")
+        log.debug(f"marketcap lookup failed for {symbol}: {e}")
     return None
 
 liq_state = {'hist': collections.deque(maxlen=settings.liq_hist_size)}
 
+def _observe_liquidity(value):
+    liq_state['hist'].append(value)
+
+BookArrays = collections.namedtuple('BookArrays', 'bid_px bid_qty ask_px ask_qty')
+
+def _book_side(levels, max_levels):
+    if levels is None or len(levels) == 0:
+        return np.empty(0), np.empty(0)
+    levels = levels[:max_levels]
+    n = len(levels)
+    if len(levels[0]) == 2:
+        arr = np.fromiter(itertools.chain.from_iterable(levels), dtype=float, count=2 * n).reshape(n, 2)
+    else:
+        arr = np.asarray([lvl[:2] for lvl in levels], dtype=float)  # [px, qty, count] rows
+    return arr[:, 0], arr[:, 1]
+
+def as_book_arrays(order_book, max_levels=500):
+    """ccxt order book dict -> BookArrays (bids best-first descending, asks ascending); arrays pass through."""
+    if isinstance(order_book, BookArrays):
+        return order_book
+    if hasattr(order_book, 'arrays'):
+        return order_book.arrays()
+    bid_px, bid_qty = _book_side(order_book.get('bids'), max_levels)
+    ask_px, ask_qty = _book_side(order_book.get('asks'), max_levels)
+    return BookArrays(bid_px, bid_qty, ask_px, ask_qty)
+
+def book_depth_usd(book, mid, depth_pcts):
+    """Quote notional resting within each of `depth_pcts` of `mid`: (bid_usd[], ask_usd[])."""
+    if isinstance(book, L2Book):
+        return book.depth(depth_pcts, mid)
+    book = as_book_arrays(book)
+    pcts = np.atleast_1d(np.asarray(depth_pcts, dtype=float))
+    bid_cum = np.concatenate([[0.0], np.cumsum(book.bid_px * book.bid_qty)])
+    ask_cum = np.concatenate([[0.0], np.cumsum(book.ask_px * book.ask_qty)])
+    # bids are descending: count levels with px >= low via the negated (ascending) prices
+    n_bid = np.searchsorted(-book.bid_px, -(mid * (1 - pcts)), side='right')
+    n_ask = np.searchsorted(book.ask_px, mid * (1 + pcts), side='right')
+    return bid_cum[n_bid], ask_cum[n_ask]
+
+def _liquidity_score(depth_usd):
+    lo = getattr(settings, 'liq_min_usd', 1000)
+    hi = getattr(settings, 'liq_max_usd', 200000)
+    if hi <= lo:
+        hi = lo * 10.0
+    return safe_norm(depth_usd, lo, hi)
+
+def compute_liquidity_profile(order_book, price, bands=None, depth_pct=None):
+    """Liquidity at settings.liq_depth_pct plus a depth profile over `bands`, from one book conversion.
+
+    Returns {'depth_usd', 'score', 'bands': {pct: {'bid_usd', 'ask_usd', 'depth_usd'}}}.
+    """
+    if depth_pct is None:
+        depth_pct = getattr(settings, 'liq_depth_pct', 0.005)
+    bands = tuple(bands if bands is not None else getattr(settings, 'liq_profile_bands', (0.001, 0.0025, 0.005, 0.01, 0.02)))
+    try:
+        pcts = (depth_pct,) + bands
+        bid_usd, ask_usd = book_depth_usd(order_book, float(price), pcts)
+        depth_usd = float(bid_usd[0] + ask_usd[0])
+        try:
+            _observe_liquidity(depth_usd)
+        except Exception:
+            pass
+        profile = {pct: {'bid_usd': float(b), 'ask_usd': float(a), 'depth_usd': float(b + a)}
+                   for pct, b, a in zip(bands, bid_usd[1:], ask_usd[1:])}
+        return {'depth_usd': depth_usd, 'score': float(_liquidity_score(depth_usd)), 'bands': profile}
+    except Exception as e:
+        log.debug(f"compute_liquidity_profile error: {e}")
+        return {'depth_usd': 0.0, 'score': 0.0, 'bands': {}}
+
 def compute_liquidity_score_from_orderbook(order_book, price, depth_pct=None):
     if depth_pct is None:
         depth_pct = getattr(settings, 'liq_depth_pct', 0.005)
     try:
-        mid = float(price)
-        low = mid * (1 - depth_pct)
-        high = mid * (1 + depth_pct)
-        bids = order_book.get('bids', [])[:500]
-        asks = order_book.get('asks', [])[:500]
-        depth_usd = 0.0
-        for p, amt in bids:
-            p_f = float(p); a_f = float(amt)
-            if p_f >= low:
-                depth_usd += p_f * a_f
-        for p, amt in asks:
-            p_f = float(p); a_f = float(amt)
-            if p_f <= high:
-                depth_usd += p_f * a_f
-        try:
-            liq_state['hist'].append(float(depth_usd))
+        bid_usd, ask_usd = book_depth_usd(order_book, float(price), depth_pct)
+        depth_usd = float(bid_usd[0] + ask_usd[0])
+        try:
+            _observe_liquidity(depth_usd)
         except Exception:
             pass
-        lo = getattr(settings, 'liq_min_usd', 1000)
-        hi = getattr(settings, 'liq_max_usd', 200000)
-        if hi <= lo:
-            hi = lo * 10.0
-        score = safe_norm(depth_usd, lo, hi)
-        return float(depth_usd), float(score)
+        return depth_usd, float(_liquidity_score(depth_usd))
     except Exception as e:
         log.debug(f"compute_liquidity_score error: {e}")
         return 0.0, 0.0
 
+def _order_side(side):
+    return 'buy' if str(side).lower() in ('buy', 'long') else 'sell'
+
+def _walk_arrays(order_book, side):
+    """(px, cum_qty, cum_notional) for the levels a market order on `side` consumes, best first."""
+    if isinstance(order_book, L2Book):
+        _, b, bid_q, bid_n, ask_q, ask_n = order_book._cums()
+        return (b.ask_px, ask_q, ask_n) if side == 'buy' else (b.bid_px, bid_q, bid_n)
+    b = as_book_arrays(order_book)
+    px, qty = (b.ask_px, b.ask_qty) if side == 'buy' else (b.bid_px, b.bid_qty)
+    return px, np.cumsum(qty), np.cumsum(px * qty)
+
+def _book_mid(order_book):
+    b = order_book.arrays() if isinstance(order_book, L2Book) else as_book_arrays(order_book)
+    if len(b.bid_px) and len(b.ask_px):
+        return float(b.bid_px[0] + b.ask_px[0]) / 2.0
+    return None
+
+def book_walk(order_book, side, amounts, ref_price=None):
+    """Walk the book for market orders of each size in `amounts`.
+
+    Returns (vwap[], slippage[]) where slippage is the adverse fraction of the fill VWAP
+    versus `ref_price` (the mid by default), so it includes the half-spread. Sizes deeper
+    than the book get NaN.
+    """
+    side = _order_side(side)
+    px, cq, cn = _walk_arrays(order_book, side)
+    q = np.atleast_1d(np.asarray(amounts, dtype=float))
+    vwap = np.full(len(q), np.nan)
+    if len(cq):
+        k = np.searchsorted(cq, q, side='left')
+        ok = (k < len(cq)) & (q > 0)
+        kk = k[ok]
+        prev_q = np.where(kk > 0, cq[np.maximum(kk - 1, 0)], 0.0)
+        prev_n = np.where(kk > 0, cn[np.maximum(kk - 1, 0)], 0.0)
+        vwap[ok] = (prev_n + (q[ok] - prev_q) * px[kk]) / q[ok]
+    ref = _book_mid(order_book) if ref_price is None else float(ref_price)
+    if not ref:
+        return vwap, np.full(len(q), np.nan)
+    slip = (vwap / ref - 1.0) if side == 'buy' else (1.0 - vwap / ref)
+    return vwap, slip
+
+def max_size_under_slippage(order_book, side, max_slippage, ref_price=None):
+    """Largest market-order size on `side` whose fill VWAP stays within `max_slippage` of ref (mid).
+
+    If the whole visible book fits under the cap the visible depth is returned.
+    """
+    side = _order_side(side)
+    px, cq, cn = _walk_arrays(order_book, side)
+    ref = _book_mid(order_book) if ref_price is None else float(ref_price)
+    if not len(cq) or not ref:
+        return 0.0
+    target = ref * (1.0 + max_slippage) if side == 'buy' else ref * (1.0 - max_slippage)
+    avg = cn / cq
+    # running VWAP rises level by level for buys and falls for sells
+    k = int(np.searchsorted(avg, target, side='right')) if side == 'buy' else int(np.searchsorted(-avg, -target, side='right'))
+    if k >= len(cq):
+        return float(cq[-1])
+    prev_q = cq[k - 1] if k else 0.0
+    prev_n = cn[k - 1] if k else 0.0
+    # part of level k that keeps (prev_n + x*px) / (prev_q + x) on the target
+    x = (target * prev_q - prev_n) / (px[k] - target)
+    return float(max(0.0, prev_q + x))
+
 # ==================== 6. AUTOENCODER & PATTERN MATCHER ====================
 class WinDS(Dataset):
     def __init__(self, arr, m):
@@ -1608,8 +4435,12 @@ class WinDS(Dataset):
         noise = torch.randn_like(torch.from_numpy(x)) * 0.01
         return torch.from_numpy(x) + noise, torch.from_numpy(x)
 
+def _cv_float32(data):
+    """(N, 2) float32 close/volume matrix from a DataFrame, Candles or an archive column dict."""
+    return np.stack([np.asarray(data['c']), np.asarray(data['v'])], axis=1).astype(np.float32)
+
 def make_online_dataloader(df, m, batch_size=64):
-    arr = df[['c','v']].values.astype(np.float32)
+    arr = _cv_float32(df)
     ds  = WinDS(arr,m) if len(arr) >= m else WinDS(np.zeros((m,2),dtype=np.float32).reshape(1,m,2), m)
     N   = len(ds)
     if N == 0:
@@ -1672,10 +4503,238 @@ def train_autoencoder(df, m, fp, epochs=10, base_lr=None):
         log.warning(f"Saving AE failed: {e}")
     return model
 
+def _series_ts(data):
+    """int64 epoch-ms bar timestamps of a Candles, archive column dict or ts-column DataFrame."""
+    ts = data.ts if isinstance(data, Candles) else data['ts']
+    a = np.asarray(ts)
+    if a.dtype.kind in 'iuf':
+        return a.astype(np.int64)
+    idx = pd.DatetimeIndex(pd.to_datetime(ts, utc=True))
+    return np.asarray((idx - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1), dtype=np.int64)
+
+def _norm_windows(wins):
+    """Per-window z-scored close and log1p volume of (n, m, 2) windows, as float32."""
+    prices = wins[..., 0]
+    vols   = wins[..., 1]
+    mean_p = prices.mean(axis=1, keepdims=True)
+    std_p  = prices.std(axis=1, keepdims=True) + 1e-8
+    norm_p = (prices - mean_p) / std_p
+    logv   = np.log1p(vols)
+    mean_v = logv.mean(axis=1, keepdims=True)
+    std_v  = logv.std(axis=1, keepdims=True) + 1e-8
+    norm_v = (logv - mean_v) / std_v
+    return np.stack([norm_p, norm_v], axis=2).astype(np.float32)
+
+LATENT_BACKENDS = ('exact', 'numpy', 'ivf', 'hnsw')
+
+class _FaissSearch:
+    """FAISS accelerator for a LatentIndex: flat (exact), IVF-flat or HNSW behind an IndexIDMap2.
+
+    Evicted ids are dropped in batches: flat and IVF remove them in place, HNSW (which can't
+    remove) is rebuilt from the ring. IVF trains its cells once enough vectors exist and is
+    retrained after every full turnover of the ring so the cells follow the regime.
+    """
+    def __init__(self, kind, dim, metric, capacity):
+        self.kind = kind
+        self.dim = dim
+        self.metric = metric
+        self.nlist = int(settings.matcher_ivf_nlist or 0) or int(np.clip(4 * np.sqrt(capacity), 1, 4096))
+        self.first = 0              # lowest id that may still sit in the index
+        self.trained_to = None      # next_id when IVF cells were last trained
+        self.index = self._new()
+
+    def _new(self):
+        mt = faiss.METRIC_INNER_PRODUCT if self.metric == 'ip' else faiss.METRIC_L2
+        if self.kind == 'hnsw':
+            inner = faiss.IndexHNSWFlat(self.dim, int(settings.matcher_hnsw_m), mt)
+            inner.hnsw.efSearch = int(settings.matcher_hnsw_ef)
+        elif self.kind == 'ivf':
+            self._quantizer = faiss.IndexFlatIP(self.dim) if self.metric == 'ip' else faiss.IndexFlatL2(self.dim)
+            inner = faiss.IndexIVFFlat(self._quantizer, self.dim, self.nlist, mt)
+            inner.nprobe = int(settings.matcher_ivf_nprobe)
+        else:
+            inner = faiss.IndexFlatIP(self.dim) if self.metric == 'ip' else faiss.IndexFlatL2(self.dim)
+        self._inner = inner
+        return faiss.IndexIDMap2(inner)
+
+    @property
+    def ready(self):
+        return self._inner.is_trained
+
+    def rebuild(self, ix):
+        """Re-create the index from the ring's live vectors (retraining IVF cells)."""
+        X, ids = ix.vectors(), np.arange(ix.first_id, ix.next_id, dtype=np.int64)
+        self.index = self._new()
+        self.first = ix.first_id
+        if not self.ready:
+            if len(X) < max(self.nlist, min(ix.capacity, 39 * self.nlist)):
+                return
+            self._inner.train(X)
+            self.trained_to = ix.next_id
+        if len(X):
+            self.index.add_with_ids(X, ids)
+
+    def add(self, ix, Z, ids):
+        if not self.ready:
+            self.rebuild(ix)
+        elif len(Z):
+            self.index.add_with_ids(Z, ids)
+
+    def evict(self, ix):
+        if self.kind == 'hnsw' or (self.kind == 'ivf' and self.trained_to is not None and ix.first_id >= self.trained_to):
+            self.rebuild(ix)
+        else:
+            self.index.remove_ids(faiss.IDSelectorRange(self.first, ix.first_id))
+            self.first = ix.first_id
+
+    def search(self, ix, q, k):
+        stale = ix.first_id - self.first
+        D, I = self.index.search(q, max(1, min(k + stale, self.index.ntotal)))
+        out_d, out_i = ix._empty_result(len(q), k)
+        for r in range(len(q)):
+            live = I[r] >= ix.first_id
+            d, i = D[r][live][:k], I[r][live][:k]
+            out_d[r, :len(d)], out_i[r, :len(i)] = d, i
+        return out_d, out_i
+
+class LatentIndex:
+    """Bounded nearest-neighbour store for window latents with stable ids.
+
+    Window ids are consecutive integers handed out by add(); only the newest `capacity` stay
+    searchable (ids in [first_id, next_id)) and older ones are evicted oldest-first. Vectors
+    live in a fixed (capacity, dim) ring, so add() is O(rows) and memory never grows.
+
+    `backend` (default settings.matcher_backend) picks the search: 'exact' uses a FAISS flat
+    index when FAISS is installed, 'ivf' / 'hnsw' the approximate FAISS indexes for long
+    archives, and 'numpy' (also the fallback for all of them without FAISS, or while IVF
+    cells are untrained) scans the ring with one matrix-vector product plus argpartition.
+    search() returns (D, I) like FAISS: squared L2 distances (metric='l2') or inner products
+    (metric='ip'), ids padded with -1.
+    """
+    def __init__(self, dim, capacity, metric='l2', start_id=0, backend=None):
+        self.dim = int(dim)
+        self.capacity = max(1, int(capacity))
+        self.metric = metric
+        self.next_id = int(start_id)
+        self._start = int(start_id)
+        self._ring = np.zeros((self.capacity, self.dim), dtype=np.float32)
+        # per-slot constant of the ranking cost: |x|^2 for L2, 0 for IP; +inf marks an empty slot
+        self._bias = np.full(self.capacity, np.inf, dtype=np.float32)
+        self._evict_batch = max(1, self.capacity // 8)
+        backend = backend or getattr(settings, 'matcher_backend', 'exact')
+        if backend not in LATENT_BACKENDS:
+            raise ValueError(f"Unknown latent backend {backend!r}; expected one of {LATENT_BACKENDS}")
+        self.backend = backend if _has_faiss else 'numpy'
+        self._ann = None
+        if self.backend != 'numpy':
+            self._ann = _FaissSearch('flat' if self.backend == 'exact' else self.backend, self.dim, metric, self.capacity)
+            self._ann.first = self.next_id
+
+    @property
+    def first_id(self):
+        return max(self._start, self.next_id - self.capacity)
+
+    def __len__(self):
+        return self.next_id - self.first_id
+
+    def add(self, Z):
+        """Append rows (oldest first); returns their ids."""
+        Z = np.ascontiguousarray(Z, dtype=np.float32).reshape(-1, self.dim)
+        ids = np.arange(self.next_id, self.next_id + len(Z), dtype=np.int64)
+        keep = slice(-self.capacity, None) if len(Z) > self.capacity else slice(None)
+        slots = ids[keep] % self.capacity
+        self._ring[slots] = Z[keep]
+        self._bias[slots] = (Z[keep] * Z[keep]).sum(axis=1) if self.metric == 'l2' else 0.0
+        self.next_id += len(Z)
+        if self._ann is not None:
+            self._ann.add(self, Z[keep], ids[keep])
+            if self.first_id - self._ann.first >= self._evict_batch:
+                self._ann.evict(self)
+        return ids
+
+    def vectors(self):
+        """Live vectors ordered by id (a copy)."""
+        ids = np.arange(self.first_id, self.next_id, dtype=np.int64)
+        return self._ring[ids % self.capacity]
+
+    def _empty_result(self, nq, k):
+        return (np.full((nq, k), np.inf if self.metric == 'l2' else -np.inf, dtype=np.float32),
+                np.full((nq, k), -1, dtype=np.int64))
+
+    def search(self, q, k):
+        q = np.ascontiguousarray(q, dtype=np.float32).reshape(-1, self.dim)
+        if self._ann is not None and self._ann.ready:
+            return self._ann.search(self, q, int(k))
+        return self.search_exact(q, k)
+
+    def search_exact(self, q, k):
+        """Exact search over the ring: cost = bias - c·(X·q), ranked with argpartition."""
+        q = np.ascontiguousarray(q, dtype=np.float32).reshape(-1, self.dim)
+        k = int(k)
+        D, I = self._empty_result(len(q), k)
+        kk = min(k, len(self))
+        if kk == 0:
+            return D, I
+        l2 = self.metric == 'l2'
+        cost = self._bias[None, :] - (2.0 if l2 else 1.0) * (self._ring @ q.T).T
+        part = np.argpartition(cost, kk - 1, axis=1)[:, :kk]
+        pc = np.take_along_axis(cost, part, axis=1)
+        order = np.argsort(pc, axis=1)
+        slots = np.take_along_axis(part, order, axis=1)
+        best = np.take_along_axis(pc, order, axis=1)
+        D[:, :kk] = np.maximum(best + (q * q).sum(axis=1, keepdims=True), 0.0) if l2 else -best
+        last = self.next_id - 1
+        I[:, :kk] = last - (last - slots) % self.capacity
+        return D, I
+
+def bench_latent_backends(X, queries, k, backends=LATENT_BACKENDS, metric='l2'):
+    """Recall@k against the exact ring search and per-query latency for each backend.
+
+    X are the latents (oldest first, all kept), queries an (nq, dim) matrix. Returns one
+    dict per backend that could be built: build_s, p50_ms, p99_ms, recall.
+    """
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    rows, truth = [], None
+    for name in backends:
+        try:
+            t0 = time.perf_counter()
+            ix = LatentIndex(X.shape[1], len(X), metric=metric, backend=name)
+            ix.add(X)
+            build_s = time.perf_counter() - t0
+        except Exception as e:
+            log.warning(f"bench: backend {name} unavailable: {e}")
+            continue
+        if truth is None:
+            truth = ix.search_exact(queries, k)[1]
+        lat, hits = [], 0
+        for r in range(len(queries)):
+            t0 = time.perf_counter()
+            _, I = ix.search(queries[r:r + 1], k)
+            lat.append(time.perf_counter() - t0)
+            hits += len(np.intersect1d(I[0][I[0] >= 0], truth[r]))
+        lat = np.asarray(lat) * 1e3
+        rows.append({'backend': name, 'effective': ix.backend, 'build_s': build_s,
+                     'p50_ms': float(np.percentile(lat, 50)), 'p99_ms': float(np.percentile(lat, 99)),
+                     'recall': hits / max(1, truth.size)})
+    return rows
+
 class PatternMatcherAE:
+    """Latent nearest-neighbour matcher over close/volume windows.
+
+    `df` may be an OHLCV DataFrame, Candles or the column dict returned by CandleArchive.read(),
+    so the index can span archived history; match(query=candles) then takes the current
+    window from the live series.
+
+    Only closed bars are indexed (the last row of `df` is treated as forming). The matcher
+    is meant to live across ticks: update(candles) encodes just the windows ending on bars
+    that closed since the last call. Latents sit in a LatentIndex capped at
+    settings.matcher_max_windows, where window id i starts at bar id i; the closes needed to
+    score those windows are kept from `_close0` on, so memory stays flat over long uptimes.
+    """
     def __init__(self, df, m):
         self.m = m
-        arr = df[['c','v']].values.astype(np.float32)
+        self._lock = threading.Lock()
         self.fp = f"conv_ae_m{m}.pth"
         if not os.path.isfile(self.fp):
             train_autoencoder(df, m, self.fp)
@@ -1688,92 +4747,113 @@ class PatternMatcherAE:
             ae.load_state_dict(torch.load(self.fp, map_location='cpu'))
         ae.eval()
         self.ae = ae
-
-        wins = np.lib.stride_tricks.sliding_window_view(arr, (m, 2)).reshape(-1, m, 2).copy()
-        prices = wins[..., 0]
-        vols   = wins[..., 1]
-        mean_p = prices.mean(axis=1, keepdims=True)
-        std_p  = prices.std(axis=1, keepdims=True) + 1e-8
-        norm_p = (prices - mean_p) / std_p
-        logv   = np.log1p(vols)
-        mean_v = logv.mean(axis=1, keepdims=True)
-        std_v  = logv.std(axis=1, keepdims=True) + 1e-8
-        norm_v = (logv - mean_v) / std_v
-        norm_wins = np.stack([norm_p, norm_v], axis=2).astype(np.float32)
-
+        self.ae_mtime = os.path.getmtime(self.fp)
+
+        arr = _cv_float32(df)
+        close = np.asarray(df['c'], dtype=float)
+        ts = _series_ts(df)
+        if len(arr) > m:
+            arr, close, ts = arr[:-1], close[:-1], ts[:-1]
+        self.last_ts = int(ts[-1]) if len(ts) else None
+
+        wins = np.lib.stride_tricks.sliding_window_view(arr, (m, 2)).reshape(-1, m, 2)
+        capacity = int(settings.matcher_max_windows or 0) or max(1, len(wins))
+        first = max(0, len(wins) - capacity)
+        Z = self._encode(_norm_windows(wins[first:]))
+        self.cosine = bool(settings.use_cosine_latent and _has_faiss)
+        self.index = LatentIndex(Z.shape[1], capacity, 'ip' if self.cosine else 'l2', start_id=first)
+        self._add(Z)
+
+        self.arr = arr[-self._tail_rows():]
+        self.close = close[first:]
+        self._close0 = first
+
+    def _tail_rows(self):
+        # enough rows to encode the next window and to serve match()'s momentum fallback
+        return self.m + settings.adx_window + 1
+
+    def _encode(self, norm_wins):
         with torch.no_grad():
-            x = torch.from_numpy(norm_wins).float()
-            _, Z = ae(x)
-        Z = Z.numpy()
-
-        if settings.use_cosine_latent and _has_faiss:
-            norms = np.linalg.norm(Z, axis=1, keepdims=True) + 1e-8
-            Zn = Z / norms
-            self.index = faiss.IndexFlatIP(Zn.shape[1])
-            self.index.add(Zn)
-            self.Z = Zn
-            self.cosine = True
-        else:
-            # fallback to L2 index or plain storage
-            if _has_faiss:
-                self.index = faiss.IndexFlatL2(Z.shape[1])
-                self.index.add(Z)
-            else:
-                # fallback: store Z and do brute force search
-                self.index = None
-            self.Z = Z
-            self.cosine = False
+            return np.concatenate([self.ae(torch.from_numpy(norm_wins[i:i + 4096]).float())[1].numpy()
+                                   for i in range(0, max(1, len(norm_wins)), 4096)], axis=0)
+
+    def _add(self, Z):
+        if self.cosine:
+            Z = Z / (np.linalg.norm(Z, axis=1, keepdims=True) + 1e-8)
+        self.index.add(Z)
 
-        self.df = df.reset_index(drop=True)
+    def update(self, candles):
+        """Fold the bars that closed since the last call into the index.
 
-    def match(self):
-        arr = self.df[['c','v']].values.astype(np.float32)
+        Returns False when the matcher cannot be extended (the series no longer overlaps the
+        indexed one, or the autoencoder was retrained) and the caller should rebuild it.
+        """
+        try:
+            if os.path.getmtime(self.fp) != self.ae_mtime:
+                return False
+        except OSError:
+            return False
+        ts = _series_ts(candles)
+        if self.last_ts is None or len(ts) < 2:
+            return False
+        pos = int(np.searchsorted(ts, self.last_ts))
+        if pos >= len(ts) or ts[pos] != self.last_ts:
+            return False
+        new = slice(pos + 1, len(ts) - 1)          # closed bars after last_ts; the last row is still forming
+        n_new = len(ts) - 1 - (pos + 1)
+        if n_new <= 0:
+            return True
+        rows = _cv_float32(candles)[new]
+        closes = np.asarray(candles['c'], dtype=float)[new]
+        with self._lock:
+            arr = np.concatenate([self.arr, rows], axis=0)
+            tail = arr[-(self.m - 1 + n_new):]
+            wins = np.lib.stride_tricks.sliding_window_view(tail, (self.m, 2)).reshape(-1, self.m, 2)
+            self._add(self._encode(_norm_windows(wins)))
+            self.arr = arr[-self._tail_rows():]
+            self.close = np.concatenate([self.close, closes])
+            # drop closes of evicted windows in batches so trimming stays amortised O(1)
+            stale = self.index.first_id - self._close0
+            if stale > self.index.capacity // 8:
+                self.close = self.close[stale:]
+                self._close0 += stale
+            self.last_ts = int(ts[-2])
+        return True
+
+    def match(self, query=None):
+        arr = _cv_float32(query) if query is not None else self.arr
         if len(arr) < self.m + 1:
             prices = arr[:, 0]
             fallback = float(prices[-1] / prices[-(settings.adx_window + 1)] - 1) if len(prices) > settings.adx_window else 0.0
             return fallback, 0.05
 
-        cur = arr[-self.m:].reshape(1, self.m, 2).copy()
-        prices = cur[..., 0]
-        vols   = cur[..., 1]
-        mean_p = prices.mean(axis=1, keepdims=True)
-        std_p  = prices.std(axis=1, keepdims=True) + 1e-8
-        norm_p = (prices - mean_p) / std_p
-        logv   = np.log1p(vols)
-        mean_v = logv.mean(axis=1, keepdims=True)
-        std_v  = logv.std(axis=1, keepdims=True) + 1e-8
-        norm_v = (logv - mean_v) / std_v
-        cur_norm = np.stack([norm_p, norm_v], axis=2).astype(np.float32)
-
+        cur_norm = _norm_windows(arr[-self.m:].reshape(1, self.m, 2))
         with torch.no_grad():
             _, zc = self.ae(torch.from_numpy(cur_norm).float())
         zc = zc.numpy()
 
-        if self.cosine and _has_faiss and self.index is not None:
-            zcn = zc / (np.linalg.norm(zc, axis=1, keepdims=True) + 1e-8)
-            D, I = self.index.search(zcn, settings.k_neighbors)
-            sims = D[0]
-            weights = np.exp(sims / (sims.max()+1e-8))
-        elif _has_faiss and self.index is not None:
-            D, I = self.index.search(zc, settings.k_neighbors)
-            d = D[0]
-            thr = np.median(d) + 1e-8
-            weights = np.exp(-d / (thr + 1e-8))
-        else:
-            # brute-force fallback: L2 distances
-            dists = np.linalg.norm(self.Z - zc, axis=1)
-            idxs = np.argsort(dists)[:settings.k_neighbors]
-            d = dists[idxs]
-            thr = np.median(d) + 1e-8
-            weights = np.exp(-d / (thr + 1e-8))
-            I = np.array([idxs])
+        with self._lock:
+            close, close0 = self.close, self._close0
+            if self.cosine:
+                zcn = zc / (np.linalg.norm(zc, axis=1, keepdims=True) + 1e-8)
+                D, I = self.index.search(zcn, settings.k_neighbors)
+                found = I[0] >= 0
+                sims = D[0][found]
+                weights = np.exp(sims / (sims.max()+1e-8)) if len(sims) else sims
+            else:
+                D, I = self.index.search(zc, settings.k_neighbors)
+                found = I[0] >= 0
+                d = D[0][found]
+                thr = (np.median(d) if len(d) else 0.0) + 1e-8
+                weights = np.exp(-d / (thr + 1e-8))
 
         rets, ws = [], []
-        for wgt, idx in zip(weights, I[0]):
+        for wgt, wid in zip(weights, I[0][found]):
+            idx = wid - close0
             fut = idx + self.m + settings.adx_window
-            if fut < len(self.df):
-                price_match  = self.df.loc[idx + self.m, 'c']
-                price_future = self.df.loc[fut, 'c']
+            if 0 <= idx and fut < len(close):
+                price_match  = close[idx + self.m]
+                price_future = close[fut]
                 rets.append(float(price_future / price_match - 1))
                 ws.append(float(wgt))
         if rets:
@@ -1796,10 +4876,9 @@ last_retrain_ts   = None
 
 def make_exit_feature(df, trade, er, ae_conf=0.0):
     m = min(settings.wnd_min, len(df)-1)
-    sub = df[['c','v']].iloc[-m:] if m>0 else pd.DataFrame({'c':[0.0],'v':[0.0]})
     bars = (len(df)-1) - trade.get('open_idx', max(0,len(df)-1))
-    cvals = sub.c.values if 'c' in sub else np.zeros(m)
-    vvals = sub.v.values if 'v' in sub else np.zeros(m)
+    cvals = np.asarray(df['c'], dtype=float)[-m:] if m>0 else np.zeros(1)
+    vvals = np.asarray(df['v'], dtype=float)[-m:] if m>0 else np.zeros(1)
     f = np.concatenate([cvals, vvals, [er, ae_conf, bars]])
     return f.reshape(1, -1)
 
@@ -1973,11 +5052,13 @@ def ensure_trade_timestamps(trades):
 vol_state = {
     'ema': None,
     'alpha': 0.12,
-    'hist': collections.deque(maxlen=1000)
+    'hist': collections.deque(maxlen=1000),
+    'sketch': sketch_store.get('vol', 1000)
 }
 
 def compute_adaptive_params(current_vol, liquidity_score=0.0, market_cap=None):
     vol_state['hist'].append(float(current_vol))
+    vol_state['sketch'].add(float(current_vol))
     if vol_state['ema'] is None:
         vol_state['ema'] = float(current_vol)
     else:
@@ -1985,9 +5066,9 @@ def compute_adaptive_params(current_vol, liquidity_score=0.0, market_cap=None):
         vol_state['ema'] = a * float(current_vol) + (1 - a) * vol_state['ema']
 
     vol_val = vol_state['ema']
-    if len(vol_state['hist']) >= 20:
-        lo = np.percentile(vol_state['hist'], 10)
-        hi = np.percentile(vol_state['hist'], 90)
+    if len(vol_state['sketch']) >= 20:
+        lo, hi = vol_state['sketch'].quantiles((0.1, 0.9))
+        sketch_store.flush()
     else:
         lo = min(vol_state['hist']) if vol_state['hist'] else vol_val * 0.5
         hi = max(vol_state['hist']) if vol_state['hist'] else vol_val * 1.5
@@ -2035,46 +5116,340 @@ def compute_adaptive_params(current_vol, liquidity_score=0.0, market_cap=None):
     }
 
 # ==================== 9. Selector (market scanner) — покращений ====================
-async def quick_score_for_symbol(sym, sem):
-    """Швидкий метрик: orderbook liquidity + 24h volume + price momentum"""
-    async with sem:
+def snapshot_ticker(tickers, sym):
+    """Entry for `sym` in a fetch_tickers snapshot (futures tickers may be keyed 'BASE/USDT:USDT')."""
+    if not tickers or not sym:
+        return None
+    return tickers.get(sym) or tickers.get(f"{sym}:{sym.split('/')[-1]}")
+
+def prefilter_universe(symbols, tickers, books=None, top_n=24):
+    """Stage one of the selector: rank every symbol from bulk snapshots with numpy.
+
+    Uses 24h quote volume, 24h change and (when a bulk bid/ask snapshot is available) the
+    relative spread, weighted like quick_score_for_symbol's liquidity / volume / momentum
+    terms. Symbols below selector_min_quote_volume or above selector_max_spread are
+    dropped. Returns the best `top_n` as [(symbol, prescore), ...], best first.
+    """
+    syms, rows = [], []
+    for sym in symbols:
+        t = snapshot_ticker(tickers, sym)
+        if not t:
+            continue
+        b = snapshot_ticker(books, sym) or t
+        syms.append(sym)
+        rows.append((t.get('last'), t.get('quoteVolume'), t.get('percentage'), b.get('bid'), b.get('ask')))
+    if not syms:
+        return []
+    arr = np.array(rows, dtype=float)  # None -> nan
+    last, qv, pct, bid, ask = arr.T
+    qv = np.nan_to_num(qv, nan=0.0)
+    chg = np.abs(np.nan_to_num(pct, nan=0.0)) / 100.0
+    mid = (bid + ask) / 2.0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        spread = np.where((bid > 0) & (ask >= bid), (ask - bid) / mid, np.nan)
+    max_spread = float(getattr(settings, 'selector_max_spread', 0.002))
+    ok = (np.nan_to_num(last, nan=0.0) > 0) & (qv >= float(getattr(settings, 'selector_min_quote_volume', 0.0)))
+    ok &= ~(spread > max_spread)  # unknown spread passes
+    spread_pen = np.clip(np.nan_to_num(spread, nan=max_spread / 2) / max(max_spread, 1e-12), 0.0, 1.0)
+    logqv = np.log10(np.maximum(qv, 1.0))
+    liq = np.clip((logqv - 5.0) / 4.0, 0.0, 1.0) * (1.0 - 0.5 * spread_pen)
+    vol = np.clip((qv - 1e3) / (1e8 - 1e3), 0.0, 1.0)
+    mom = np.clip(chg / 0.1, 0.0, 1.0)
+    score = np.where(ok, 0.55 * liq + 0.25 * vol + 0.2 * mom, -np.inf)
+    n = int(min(top_n, int(ok.sum())))
+    if n <= 0:
+        return []
+    idx = np.argpartition(-score, n - 1)[:n]
+    idx = idx[np.argsort(-score[idx])]
+    return [(syms[i], float(score[i])) for i in idx]
+
+class SymbolScoreTable:
+    """Persistent per-symbol selector scores with staleness-driven rescans.
+
+    Rows live in memory and in the `selector_scores` SQLite table, so a restart keeps the
+    ranking. Each update schedules the symbol's next probe (`due_ts`) between
+    selector_score_min_age and selector_score_max_age seconds: volatile symbols and
+    symbols whose score sits close to the switch cutoff (or drifts towards it) come back
+    soon, quiet or clearly out-of-contention markets rarely. A failed probe keeps the old
+    score and only pushes `due_ts` back, doubling from min_age per consecutive failure.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._dirty = set()
+        self._failures = {}   # symbol -> (consecutive failed probes, retry ts); in memory only
+        try:
+            conn.execute("""
+              CREATE TABLE IF NOT EXISTS selector_scores (
+                symbol TEXT PRIMARY KEY,
+                score REAL,
+                prev_score REAL,
+                components JSON,
+                volatility REAL,
+                ts REAL,
+                due_ts REAL
+              )
+            """)
+            conn.commit()
+            for sym, score, prev, comp, vol, ts, due in conn.execute(
+                    "SELECT symbol, score, prev_score, components, volatility, ts, due_ts FROM selector_scores"):
+                try:
+                    comp = json.loads(comp) if comp else {}
+                except Exception:
+                    comp = {}
+                self._rows[sym] = {'score': score, 'prev_score': prev, 'components': comp,
+                                   'volatility': vol, 'ts': ts, 'due_ts': due}
+        except Exception as e:
+            log.warning(f"selector score table unavailable, keeping scores in memory only: {e}")
+
+    def get(self, symbol, max_age=None):
+        with self._lock:
+            row = self._rows.get(symbol)
+            if row is None or (max_age is not None and time.time() - row['ts'] > max_age):
+                return None
+            return dict(row)
+
+    @staticmethod
+    def _interval(score, prev_score, prev_ts, vol, cutoff, now):
+        lo = float(getattr(settings, 'selector_score_min_age', 60))
+        hi = float(getattr(settings, 'selector_score_max_age', 3600))
+        ref = float(getattr(settings, 'selector_score_ref_vol', 0.15))
+        # volatility: ref-sized moves rescan at the minimum age, flat markets at the maximum
+        wait = hi / (1.0 + (vol / max(ref, 1e-9)) * (hi / lo))
+        if cutoff is not None:
+            gap = abs(score - cutoff)
+            if gap < 0.02:
+                wait = lo
+            elif prev_score is not None and prev_ts and now > prev_ts:
+                drift = abs(score - prev_score) / (now - prev_ts)
+                if drift > 0:
+                    wait = min(wait, gap / drift)   # time until the observed drift could cross the cutoff
+        return float(np.clip(wait, lo, hi))
+
+    def update(self, symbol, score, components, ticker=None, cutoff=None):
+        now = time.time()
+        comps = dict(components or {})
+        vol = abs(float(comps.get('mom') or 0.0))
+        try:
+            if ticker and ticker.get('percentage') is not None:
+                vol = max(vol, abs(float(ticker['percentage'])) / 100.0)
+        except Exception:
+            pass
+        with self._lock:
+            old = self._rows.get(symbol)
+            prev_score, prev_ts = (old['score'], old['ts']) if old else (None, None)
+            due = now + self._interval(float(score), prev_score, prev_ts, vol, cutoff, now)
+            self._rows[symbol] = {'score': float(score), 'prev_score': prev_score, 'components': comps,
+                                  'volatility': vol, 'ts': now, 'due_ts': due}
+            self._failures.pop(symbol, None)
+            self._dirty.add(symbol)
+
+    def backoff(self, symbol):
+        """Record a failed probe: keep the score, retry after min_age * 2^(failures - 1) (capped at max_age)."""
+        now = time.time()
+        lo = float(getattr(settings, 'selector_score_min_age', 60))
+        hi = float(getattr(settings, 'selector_score_max_age', 3600))
+        with self._lock:
+            n = self._failures.get(symbol, (0, 0.0))[0] + 1
+            due = now + min(lo * 2 ** min(n - 1, 16), hi)
+            self._failures[symbol] = (n, due)
+            row = self._rows.get(symbol)
+            if row is not None:
+                row['due_ts'] = due
+                self._dirty.add(symbol)
+
+    def due(self, symbols, now=None):
+        """Symbols that need a probe (never scored or past due), most overdue first."""
+        now = now or time.time()
+        with self._lock:
+            keyed = [(max(self._rows[s]['due_ts'] if s in self._rows else float('-inf'),
+                          self._failures.get(s, (0, float('-inf')))[1]), s) for s in symbols]
+        return [s for d, s in sorted(keyed, key=lambda x: x[0]) if d <= now]
+
+    def ranked(self, symbols, max_age=None):
+        """[(symbol, score, components)] for known symbols, best first."""
+        max_age = max_age if max_age is not None else getattr(settings, 'selector_score_max_age', 3600)
+        now = time.time()
+        with self._lock:
+            rows = [(s, self._rows[s]['score'], self._rows[s]['components']) for s in symbols
+                    if s in self._rows and now - self._rows[s]['ts'] <= 2 * max_age]
+        rows.sort(key=lambda x: x[1], reverse=True)
+        return rows
+
+    def flush(self):
+        with self._lock:
+            batch = [(s, r['score'], r['prev_score'], json.dumps(r['components'], default=str), r['volatility'], r['ts'], r['due_ts'])
+                     for s, r in ((s, self._rows[s]) for s in self._dirty)]
+            self._dirty.clear()
+        if not batch:
+            return
+        try:
+            self._conn.executemany("""
+              INSERT INTO selector_scores (symbol, score, prev_score, components, volatility, ts, due_ts)
+              VALUES (?, ?, ?, ?, ?, ?, ?)
+              ON CONFLICT(symbol) DO UPDATE SET score=excluded.score, prev_score=excluded.prev_score,
+                components=excluded.components, volatility=excluded.volatility, ts=excluded.ts, due_ts=excluded.due_ts
+            """, batch)
+            self._conn.commit()
+        except Exception as e:
+            log.warning(f"selector score flush failed: {e}")
+
+score_table = SymbolScoreTable(_db)
+
+def _is_congestion_error(e):
+    """True for errors that mean "slow down": HTTP 418/429, DDoS protection, timeouts, exchange unavailable."""
+    try:
+        last = getattr(e, 'last_attempt', None)   # tenacity.RetryError around the real error
+        if last is not None and last.exception() is not None:
+            e = last.exception()
+    except Exception:
+        pass
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+        return True
+    for name in ('DDoSProtection', 'RateLimitExceeded', 'RequestTimeout', 'ExchangeNotAvailable'):
+        cls = getattr(ccxt, name, None)
+        if isinstance(cls, type) and isinstance(e, cls):
+            return True
+    msg = str(e)
+    return ' 429 ' in f" {msg} " or ' 418 ' in f" {msg} "
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for selector probes.
+
+    `async with limiter.slot() as probe:` waits for a free slot; the probe's latency and
+    the errors reported through probe.error(e) then adjust the limit on exit. Each clean
+    probe under target_latency adds 1/limit (about +1 per round of probes); congestion
+    (429/418, timeouts, a probe slower than target_latency) halves it, at most once per
+    target_latency so one burst of failures counts as one signal.
+    """
+    def __init__(self, initial=6, lo=2, hi=32, target_latency=1.5):
+        self.lo, self.hi = max(1, int(lo)), max(int(lo), int(hi))
+        self.limit = float(min(max(initial, self.lo), self.hi))
+        self.target_latency = float(target_latency)
+        self.inflight = 0
+        self._cond = None
+        self._last_decrease = 0.0
+        self.stats = {'probes': 0, 'errors': 0, 'congested': 0, 'decreases': 0, 'latency_ewma': None}
+
+    def slot(self):
+        return _LimiterSlot(self)
+
+    async def _acquire(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+
+    async def _release(self, probe, exc=None):
+        self._record(probe, exc)
+        async with self._cond:
+            self.inflight -= 1
+            self._cond.notify_all()
+
+    def _record(self, probe, exc=None):
+        latency = time.monotonic() - probe.t0
+        if exc is not None:
+            if isinstance(exc, asyncio.CancelledError):
+                return  # scan timeout cancelled it: says nothing about the exchange
+            probe.error(exc)
+        st = self.stats
+        st['probes'] += 1
+        st['errors'] += probe.errors
+        st['latency_ewma'] = latency if st['latency_ewma'] is None else 0.8 * st['latency_ewma'] + 0.2 * latency
+        now = time.monotonic()
+        if probe.congested or latency > self.target_latency:
+            st['congested'] += int(probe.congested)
+            if now - self._last_decrease >= self.target_latency:
+                self.limit = max(self.lo, self.limit * 0.5)
+                self._last_decrease = now
+                st['decreases'] += 1
+        elif not probe.errors:
+            self.limit = min(self.hi, self.limit + 1.0 / self.limit)
+
+class _Probe:
+    __slots__ = ('t0', 'errors', 'congested')
+
+    def __init__(self):
+        self.t0 = time.monotonic()
+        self.errors = 0
+        self.congested = False
+
+    def error(self, e):
+        self.errors += 1
+        self.congested = self.congested or _is_congestion_error(e)
+
+class _LimiterSlot:
+    __slots__ = ('limiter', 'probe')
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.probe = None
+
+    async def __aenter__(self):
+        await self.limiter._acquire()
+        self.probe = _Probe()
+        return self.probe
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.limiter._release(self.probe, exc)
+        return False
+
+selector_limiter = AdaptiveLimiter(initial=settings.selector_concurrency, lo=settings.selector_concurrency_min,
+                                   hi=settings.selector_concurrency_max, target_latency=settings.selector_target_latency)
+
+async def quick_score_for_symbol(sym, sem, ticker=None):
+    """Швидкий метрик: orderbook liquidity + 24h volume + price momentum
+
+    `ticker` is this symbol's entry from the cycle's bulk fetch_tickers snapshot; without it
+    the ticker is fetched individually. `sem` is an AdaptiveLimiter (errors and latency feed
+    its concurrency) or a plain asyncio.Semaphore.
+    """
+    async with (sem.slot() if isinstance(sem, AdaptiveLimiter) else sem) as probe:
+        probe = probe or _Probe()
         try:
-            tick = await async_ex.fetch_ticker(sym)
+            tick = ticker or await exchange_call_async('fetch_ticker', sym)
             price = float(tick.get('last') or tick.get('info',{}).get('lastPrice', 0.0))
             vol24 = float(tick.get('quoteVolume') or tick.get('baseVolume') or 0.0)
-        except Exception:
+        except Exception as e:
+            probe.error(e)
             price = 0.0
             vol24 = 0.0
 
-        liq_usd, liq_score = 0.0, 0.0
+        liq_usd, liq_score, liq_profile = 0.0, 0.0, {}
         try:
-            ob = await async_ex.fetch_order_book(sym, limit=getattr(settings,'selector_orderbook_depth',200))
-            liq_usd, liq_score = compute_liquidity_score_from_orderbook(ob, price)
+            ob = local_order_book(sym) or await exchange_call_async('fetch_order_book', sym, limit=getattr(settings,'selector_orderbook_depth',200))
+            liq = compute_liquidity_profile(ob, price)
+            liq_usd, liq_score, liq_profile = liq['depth_usd'], liq['score'], liq['bands']
         except Exception as e:
+            probe.error(e)
             log.debug(f"Selector OB failed {sym}: {e}")
 
         # simple momentum: last/6h (attempt fetch small ohlcv)
         mom = 0.0
         try:
-            df = await OHLCV.async_fetch(sym, '1h', 50)
-            if len(df)>1:
-                mom = float(df['c'].iloc[-1] / df['c'].iloc[-6] - 1) if len(df)>6 else 0.0
-        except Exception:
+            closes = (await OHLCV.async_fetch_candles(sym, '1h', 50)).c
+            if len(closes)>1:
+                mom = float(closes[-1] / closes[-6] - 1) if len(closes)>6 else 0.0
+        except Exception as e:
+            probe.error(e)
             mom = 0.0
 
         # normalized score combine
         score = 0.55 * liq_score + 0.25 * safe_norm(vol24, 1e3, 1e8) + 0.2 * safe_norm(abs(mom), 0, 0.1)
-        return sym, score, {'liq_usd': liq_usd, 'liq_score': liq_score, 'vol24': vol24, 'mom': mom}
+        return sym, score, {'liq_usd': liq_usd, 'liq_score': liq_score, 'liq_profile': liq_profile, 'vol24': vol24, 'mom': mom,
+                            'errors': probe.errors}
 
-async def get_current_quick_score(sym):
+async def get_current_quick_score(sym, ticker=None):
     """Helper — quick score for current symbol (sequential)"""
     try:
-        tick = await async_ex.fetch_ticker(sym)
+        tick = ticker or await exchange_call_async('fetch_ticker', sym)
         price = float(tick.get('last') or 0.0)
-        ob = await async_ex.fetch_order_book(sym, limit=getattr(settings,'selector_orderbook_depth',200))
+        ob = local_order_book(sym) or await exchange_call_async('fetch_order_book', sym, limit=getattr(settings,'selector_orderbook_depth',200))
         liq_usd, liq_score = compute_liquidity_score_from_orderbook(ob, price)
-        df = await OHLCV.async_fetch(sym, '1h', 24)
-        mom = float(df['c'].iloc[-1] / df['c'].iloc[-6] - 1) if len(df)>6 else 0.0
+        closes = (await OHLCV.async_fetch_candles(sym, '1h', 24)).c
+        mom = float(closes[-1] / closes[-6] - 1) if len(closes)>6 else 0.0
         score = 0.55 * liq_score + 0.25 * safe_norm(0, 1e3, 1e8) + 0.2 * safe_norm(abs(mom), 0, 0.1)
         # NOTE: earlier this had a bug using 0 instead of vol24; left intentionally minimal here for quick check
         return score
@@ -2084,9 +5459,237 @@ async def get_current_quick_score(sym):
 # ==================== Globals for matchers, histories ====================
 tick = 0
 er_history = collections.deque(maxlen=settings.er_hist_size)
-matcher_cache = {'timestamp': None, 'matcher': None}
+er_sketch = sketch_store.get('er', settings.er_hist_size)   # 10/90% ER bounds for the Dash score normalisation
+matcher_cache = {'timestamp': None, 'matcher': None, 'key': None}   # run_live's latest; key = (symbol, timeframe, m)
+chart_matchers = {}   # (symbol, timeframe, m) -> {'matcher', 'timestamp'}: the Dash chart's own, extended per bar
 matcher_executor = ThreadPoolExecutor(max_workers=1)
 
+# ==================== 9a. Hot standby ====================
+def matcher_source(sym, candles):
+    """Series the latent index is built from: the fetched window, or a longer archive slice."""
+    try:
+        if settings.archive_enabled and settings.matcher_history_bars > len(candles):
+            hist = Candles.from_columns(candle_archive(sym, settings.timeframes[0]).read(last_n=settings.matcher_history_bars))
+            if len(hist) > len(candles):
+                return hist
+    except Exception as e:
+        log.debug(f"matcher_source: archive read failed for {sym}: {e}")
+    return candles
+
+class StandbyWarmer:
+    """Keeps the selector's top candidates ready to trade so a switch costs one normal tick.
+
+    For every candidate it refreshes the candle cache for all settings.timeframes, keeps
+    the PatternMatcherAE for the window length run_live would pick up to date, primes
+    the indicator cache (ATR/volatility) and loads the symbol's wallet from the DB. Matchers live per (symbol, m)
+    for as long as the symbol stays a candidate; each new bar only folds the closed bars
+    into the existing index (PatternMatcherAE.update) instead of rebuilding it.
+    """
+    def __init__(self):
+        self.candidates = []
+        self._matchers = {}
+        self._lock = threading.Lock()
+
+    def set_candidates(self, symbols):
+        self.candidates = [s for s in symbols if s][:max(0, int(getattr(settings, 'selector_top_k', 8)))]
+
+    def put_matcher(self, sym, m, bar_ts, pm):
+        with self._lock:
+            self._matchers[(sym, m)] = {'pm': pm, 'bar_ts': bar_ts}
+
+    async def ensure_matcher(self, sym, m, candles):
+        """The (sym, m) matcher brought up to `candles`: extended in place when possible, else rebuilt."""
+        bar_ts = int(candles.ts[-1])
+        with self._lock:
+            ent = self._matchers.get((sym, m))
+        if ent is not None and ent['bar_ts'] == bar_ts:
+            return ent['pm']
+        loop = asyncio.get_running_loop()
+        pm = ent['pm'] if ent is not None else None
+        if pm is not None:
+            try:
+                if not await loop.run_in_executor(matcher_executor, pm.update, candles):
+                    pm = None
+            except Exception as e:
+                log.debug(f"Matcher update failed for {sym} m={m}: {e}")
+                pm = None
+        if pm is None:
+            pm = await loop.run_in_executor(matcher_executor, PatternMatcherAE, matcher_source(sym, candles), m)
+        self.put_matcher(sym, m, bar_ts, pm)
+        return pm
+
+    def _evict(self, keep):
+        with self._lock:
+            for key in [k for k in self._matchers if k[0] not in keep]:
+                self._matchers.pop(key, None)
+
+    async def warm(self, sym):
+        candles = await OHLCV.async_fetch_candles(sym, settings.timeframes[0], settings.history_limit)
+        for tf in settings.timeframes[1:]:
+            await OHLCV.async_refresh(sym, tf, settings.history_limit)
+        if candles is None or len(candles) < 2:
+            return
+        ind = indicators.candles(sym, settings.timeframes[0], candles)
+        m = settings.wnd_min + (0 if ind['vol'] < settings.target_vol else settings.wnd_step)
+        await self.ensure_matcher(sym, m, candles)
+        with state_lock:
+            have_wallet = sym in active_state.get('wallets', {})
+        if not have_wallet:
+            loaded = await asyncio.get_running_loop().run_in_executor(None, load_trades_from_db, sym)
+            with state_lock:
+                active_state.setdefault('wallets', {}).setdefault(sym, loaded or {'position': 0.0, 'trades': []})
+
+    async def run(self):
+        exchange_priority.set('selector')
+        while True:
+            try:
+                active = active_state.get('active_symbol', settings.symbol)
+                self._evict(set(self.candidates) | {active})
+                for sym in list(self.candidates):
+                    if sym == active:
+                        continue
+                    try:
+                        await self.warm(sym)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        log.debug(f"Standby warm failed for {sym}: {e}")
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                log.debug(f"Standby warmer error: {e}")
+            await loop_sleep(getattr(settings, 'standby_interval', 60))
+
+standby = StandbyWarmer()
+
+# ==================== 9b. Signal engine ====================
+SIGNAL_CHANNEL_BARS = 20
+SIGNAL_ATR_BARS = 14
+
+def _norm_arr(x, lo, hi, eps=1e-8):
+    """Vector safe_norm."""
+    x = np.asarray(x, dtype=float)
+    lo, hi = np.asarray(lo, dtype=float), np.asarray(hi, dtype=float)
+    denom = hi - lo
+    flat = np.where(x > hi, 1.0, np.where(x < lo, 0.0, 0.5))
+    return np.where(denom <= eps, flat, np.clip((x - lo) / np.where(denom <= eps, 1.0, denom), 0.0, 1.0))
+
+def blended_er(er_raw, ae_conf, mom):
+    """Matcher ER weighted by its confidence, blended with momentum."""
+    return 0.75 * np.asarray(er_raw, dtype=float) * np.maximum(ae_conf, settings.min_ae_confidence) + 0.25 * np.asarray(mom, dtype=float)
+
+def signal_features(high, low, close, volume, start=0):
+    """Open-signal inputs for bars start..n-1, each bar evaluated as if it were the forming bar.
+
+    Same definitions as the live tick: ATR over the last 14 true ranges, the 20-bar channel
+    of the bars before it, the vol_window volume mean, ema(span=3), momentum over
+    adx_window bars and the one-bar price change. Only the lookback the windows need
+    before `start` is read, so a tail evaluation costs O(n - start).
+    """
+    n = len(close)
+    vol_w, adx = int(settings.vol_window), int(settings.adx_window)
+    lb = max(SIGNAL_ATR_BARS, vol_w, SIGNAL_CHANNEL_BARS + 1, adx + 1, 64)   # 64: EMA warm-up, as in ema_last
+    s0 = max(0, int(start) - lb)
+    h, l, c, v = (np.asarray(x, dtype=float)[s0:] for x in (high, low, close, volume))
+    m = len(c)
+    j = np.arange(m)
+    prev = np.concatenate([[np.nan], c[:-1]])
+
+    tr = np.fmax(h - l, np.fmax(np.abs(h - prev), np.abs(l - prev)))
+    cs = np.concatenate([[0.0], np.cumsum(tr)])
+    atr = np.where(j + 1 >= SIGNAL_ATR_BARS,
+                   (cs[j + 1] - cs[np.maximum(j + 1 - SIGNAL_ATR_BARS, 0)]) / SIGNAL_ATR_BARS, np.nan)
+    atr = np.where(atr > 0, atr, h - l)
+
+    N = SIGNAL_CHANNEL_BARS
+    if m > N:
+        win_hi = np.lib.stride_tricks.sliding_window_view(h, N).max(axis=1)
+        win_lo = np.lib.stride_tricks.sliding_window_view(l, N).min(axis=1)
+        k = np.maximum(j - N, 0)
+        chan_high = np.where(j >= N, win_hi[k], np.maximum.accumulate(h))
+        chan_low = np.where(j >= N, win_lo[k], np.minimum.accumulate(l))
+    else:
+        chan_high, chan_low = np.maximum.accumulate(h), np.minimum.accumulate(l)
+
+    cv = np.concatenate([[0.0], np.cumsum(v)])
+    kv = np.minimum(j + 1, vol_w)
+    vol_mean = (cv[j + 1] - cv[j + 1 - kv]) / kv
+
+    ema = pd.Series(c).ewm(span=3, adjust=False).mean().to_numpy()
+    mom = np.where(j >= adx, c / c[np.maximum(j - adx, 0)] - 1.0, 0.0)
+    price_change = np.where(prev > 0, c / np.where(prev > 0, prev, 1.0) - 1.0, 0.0)
+
+    off = int(start) - s0
+    feat = {'close': c, 'volume': v, 'atr': atr, 'chan_high': chan_high, 'chan_low': chan_low,
+            'vol_mean': vol_mean, 'ema': ema, 'mom': mom, 'price_change': price_change, 'bars': j + s0 + 1}
+    return {key: arr[off:] for key, arr in feat.items()}
+
+def signal_features_live(ind, close, volume):
+    """One-bar signal_features() for the forming bar, from IndicatorEngine values (no array pass)."""
+    n = len(close)
+    adx = int(settings.adx_window)
+    price, prev = float(close[-1]), (float(close[-2]) if n > 1 else 0.0)
+    mom = price / float(close[-(adx + 1)]) - 1.0 if n > adx else 0.0
+    return {'close': np.array([price]), 'volume': np.array([float(volume[-1])]), 'atr': np.array([ind['atr']]),
+            'chan_high': np.array([ind['chan_high']]), 'chan_low': np.array([ind['chan_low']]),
+            'vol_mean': np.array([ind['vol_mean']]), 'ema': np.array([ind['ema']]), 'mom': np.array([mom]),
+            'price_change': np.array([price / prev - 1.0 if prev > 0 else 0.0]), 'bars': np.array([n])}
+
+def score_signals(feat, er_raw=0.0, ae_conf=0.0, thr=None, atr_mult=None, min_ae=None,
+                  er_lo=-0.1, er_hi=0.1, vol_factor=0.0, early=True):
+    """Per-bar open scores and decisions from signal_features() output.
+
+    er_raw / ae_conf are the pattern matcher's outputs (scalars or per-bar arrays; bars
+    without a match count as 0). `early` adds run_live's early-entry rule: a one-bar move
+    with a 1.35x volume spike on the right side of the short EMA opens at 70% of the
+    vol-adjusted threshold. signal is +1 (long), -1 (short) or 0; long wins a tie.
+    """
+    thr = settings.score_threshold if thr is None else thr
+    atr_mult = settings.atr_multiplier_open if atr_mult is None else atr_mult
+    min_ae = settings.min_ae_confidence if min_ae is None else min_ae
+    c, v, atr, mom = feat['close'], feat['volume'], feat['atr'], feat['mom']
+    er_raw = np.broadcast_to(np.asarray(er_raw, dtype=float), c.shape)
+    ae_conf = np.broadcast_to(np.asarray(ae_conf, dtype=float), c.shape)
+
+    er = blended_er(er_raw, ae_conf, mom)
+    buf = atr_mult * atr
+    breakout_long = c > feat['chan_high'] + buf
+    breakout_short = c < feat['chan_low'] - buf
+    f_vol = (v > feat['vol_mean'] * 1.1) & (feat['bars'] >= settings.vol_window)
+    mom_norm = np.tanh(mom * 50) * 0.5 + 0.5
+
+    score_long = (settings.w_breakout * breakout_long +
+                  settings.w_er * _norm_arr(er, er_lo, er_hi) +
+                  settings.w_mom * np.where(mom > 0, mom_norm, 0.0) +
+                  settings.w_vol * f_vol)
+    score_short = (settings.w_breakout * breakout_short +
+                   settings.w_er * _norm_arr(-er, -er_hi, -er_lo) +
+                   settings.w_mom * np.where(mom < 0, 1.0 - mom_norm, 0.0) +
+                   settings.w_vol * f_vol)
+    penal = np.where(ae_conf < min_ae, 0.15 * (min_ae - ae_conf), 0.0)
+    score_long = np.maximum(0.0, score_long - penal)
+    score_short = np.maximum(0.0, score_short - penal)
+
+    thr = np.broadcast_to(np.asarray(thr, dtype=float), c.shape)
+    go_long, go_short = score_long >= thr, score_short >= thr
+    early_long = early_short = np.zeros(c.shape, dtype=bool)
+    if early:
+        move = np.maximum(0.002, 0.25 * (atr / np.maximum(c, 1e-8)))
+        spike = v > feat['vol_mean'] * 1.35
+        early_long = (feat['price_change'] > move) & spike & (c > feat['ema'])
+        early_short = (feat['price_change'] < -move) & spike & (c < feat['ema'])
+        eased = thr * (1.0 - 0.25 * np.asarray(vol_factor, dtype=float)) * 0.7
+        go_long = go_long | (early_long & (score_long >= eased))
+        go_short = go_short | (early_short & (score_short >= eased))
+    return {'er': er, 'score_long': score_long, 'score_short': score_short, 'thr': thr,
+            'breakout_long': breakout_long, 'breakout_short': breakout_short, 'f_vol': f_vol,
+            'early_long': early_long, 'early_short': early_short,
+            'signal': np.where(go_long, 1, np.where(go_short, -1, 0))}
+
+def signal_history(candles, **params):
+    """score_signals() over a whole Candles series (backtests, chart overlays)."""
+    return score_signals(signal_features(candles.h, candles.l, candles.c, candles.v), **params)
+
 # ==================== 10. LIVE TRADING (динамічний символ + per-symbol wallet) ====================
 matcher_executor   = matcher_executor  # already defined
 # X_history, y_history declared above
@@ -2098,70 +5701,114 @@ async def selector_task_loop():
     to honor selector_concurrency and selector_switch_margin settings and obtains switch_lock
     before mutating active_state to avoid races with run_live.
     """
+    exchange_priority.set('selector')
     try:
         interval = getattr(settings, 'selector_interval', 60)
         while True:
             try:
                 if not getattr(settings, 'selector_enabled', False):
-                    await asyncio.sleep(interval)
+                    await loop_sleep(interval)
                     continue
 
-                # load markets once per cycle (async CCXT)
+                # scan universe from the persisted market cache (downloads only when the TTL expired)
                 try:
-                    markets = await async_ex.load_markets()
+                    await market_cache.ensure_async()
+                    symbols = market_cache.universe()
+                except Exception as e:
+                    log.warning(f"Selector: market metadata unavailable: {e}")
                     symbols = []
-                    for s, m in markets.items():
-                        if not isinstance(s, str):
-                            continue
-                        if getattr(settings, 'scan_usdt_only', True) and not s.endswith('/USDT'):
-                            continue
-                        if getattr(settings, 'skip_leveraged_tokens', True):
-                            name = s.upper()
-                            if any(x in name for x in ('BULL', 'BEAR', 'UP', 'DOWN', '3L', '3S', '1D')):
-                                continue
-                        symbols.append(s)
-                except Exception:
-                    symbols = list(await async_ex.fetch_markets()) if hasattr(async_ex, 'fetch_markets') else []
-                # filter out excluded bases (e.g., WAVES)
-                try:
-                    symbols = [s for s in symbols if isinstance(s, str) and s.split('/')[0].upper() not in EXCLUDED_BASES]
-                except Exception:
-                    pass
 
                 if not symbols:
-                    await asyncio.sleep(interval)
+                    await loop_sleep(interval)
                     continue
 
-                sem = asyncio.Semaphore(getattr(settings, 'selector_concurrency', 6))
-                tasks = [asyncio.create_task(quick_score_for_symbol(sym, sem)) for sym in symbols]
-                results = []
-                # gather as they complete but with a timeout per whole batch
-                done, pending = await asyncio.wait(tasks, timeout=30)
-                for d in done:
-                    try:
-                        res = d.result()
-                        if res:
-                            results.append(res)
-                    except Exception:
-                        pass
-                for p in pending:
+                # one bulk ticker snapshot per cycle instead of a fetch_ticker per symbol
+                try:
+                    tickers = await exchange_call_async('fetch_tickers') or {}
+                except Exception as e:
+                    log.debug(f"Selector: fetch_tickers failed, falling back to per-symbol tickers: {e}")
+                    tickers = {}
+
+                # stage one: rank the whole universe from bulk data; stage two probes finalists only.
+                # Only a missing snapshot falls back to probing the universe; an empty ranking means
+                # nothing passed the volume / spread filters and there is nothing to probe.
+                finalists = symbols
+                if tickers and any(snapshot_ticker(tickers, sym) for sym in symbols):
                     try:
-                        p.cancel()
-                    except Exception:
-                        pass
+                        books = await exchange_call_async('fetch_bids_asks') or {}
+                    except Exception as e:
+                        log.debug(f"Selector: fetch_bids_asks failed, ranking without spread: {e}")
+                        books = {}
+                    ranked = prefilter_universe(symbols, tickers, books, top_n=getattr(settings, 'selector_finalists', 24))
+                    finalists = [sym for sym, _ in ranked]
+                    if finalists:
+                        log.debug(f"Selector prefilter: {len(symbols)} symbols -> {len(finalists)} finalists")
+                    else:
+                        log.info(f"Selector prefilter: none of {len(symbols)} symbols passed the volume/spread filters")
 
+                # stage two: probe only finalists whose table entry is due (stale, volatile or near the cutoff)
+                cur_sym = active_state.get('active_symbol', settings.symbol)
+                cur_entry = score_table.get(cur_sym)
+                cutoff = cur_entry['score'] * (1.0 + getattr(settings, 'selector_switch_margin', 0.05)) if cur_entry else None
+                due = score_table.due(finalists)
+                scan_t0 = time.monotonic()
+                tasks = [asyncio.create_task(quick_score_for_symbol(sym, selector_limiter, ticker=snapshot_ticker(tickers, sym))) for sym in due]
+                results = []
+                # gather as they complete but with a timeout per whole batch
+                if tasks:
+                    done, pending = await asyncio.wait(tasks, timeout=30)
+                    for d in done:
+                        try:
+                            res = d.result()
+                            if res:
+                                results.append(res)
+                        except Exception:
+                            pass
+                    for p in pending:
+                        try:
+                            p.cancel()
+                        except Exception:
+                            pass
+                for sym, score, meta in results:
+                    if meta.get('errors'):   # a failed probe keeps the old score and backs off before the retry
+                        score_table.backoff(sym)
+                    else:
+                        score_table.update(sym, score, meta, ticker=snapshot_ticker(tickers, sym), cutoff=cutoff)
+                probed = {sym for sym, _, _ in results}
+                for sym in due:
+                    if sym not in probed:   # probe timed out or raised: same backoff
+                        score_table.backoff(sym)
+                score_table.flush()
+                if tasks:
+                    scan_s = max(time.monotonic() - scan_t0, 1e-9)
+                    active_state['selector_stats'] = {
+                        'probed': len(tasks), 'completed': len(results),
+                        'failed': sum(1 for _, _, meta in results if meta.get('errors')),
+                        'seconds': round(scan_s, 3), 'throughput': round(len(results) / scan_s, 3),
+                        'concurrency': int(selector_limiter.limit), **selector_limiter.stats,
+                    }
+                    log.info(f"Selector scan: {len(results)}/{len(tasks)} probes in {scan_s:.1f}s "
+                             f"({len(results) / scan_s:.2f}/s), concurrency={int(selector_limiter.limit)}")
+
+                # rank from the table: fresh probes plus entries that were not due this cycle
+                results = score_table.ranked(finalists)
                 if not results:
-                    await asyncio.sleep(interval)
+                    await loop_sleep(interval)
                     continue
 
-                # choose top candidate by quick score
-                results.sort(key=lambda x: x[1], reverse=True)
+                # choose top candidate by quick score; keep the leaders warm for a fast switch
                 best_sym, best_score, best_meta = results[0]
-                # compute current symbol quick score (best-effort)
-                cur_sym = active_state.get('active_symbol', settings.symbol)
+                standby.set_candidates([sym for sym, _, _ in results])
+                if getattr(settings, 'coingecko_enabled', True):
+                    marketcap_cache.want(standby.candidates)
+                # current symbol score: read from the table when known, otherwise probe it (best-effort)
                 current_score = 0.0
                 try:
-                    current_score = await get_current_quick_score(cur_sym)
+                    cur_entry = score_table.get(cur_sym, max_age=getattr(settings, 'selector_score_max_age', 3600))
+                    if cur_entry:
+                        current_score = cur_entry['score']
+                    else:
+                        current_score = await get_current_quick_score(cur_sym, ticker=snapshot_ticker(tickers, cur_sym))
                 except Exception:
                     current_score = 0.0
 
@@ -2263,12 +5910,12 @@ async def selector_task_loop():
                     except Exception as e:
                         log.debug(f"Selector switch block error: {e}")
                 # heartbeat sleep
-                await asyncio.sleep(interval)
+                await loop_sleep(interval)
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 log.exception("Selector task error: %s", e)
-                await asyncio.sleep(5)
+                await loop_sleep(5)
     except Exception:
         return
 
@@ -2278,7 +5925,9 @@ async def run_live():
     This version is defensive: it logs errors, keeps wallets in active_state, and uses existing helpers for opens/closes.
     """
     global last_retrain_ts, retrain_interval, X_history, y_history
-    global matcher_cache, matcher_executor, er_history
+    global matcher_cache, matcher_executor, er_history, candle_stream, book_feed
+
+    exchange_priority.set('trading')
 
     # ensure async lock for selector / switching exists
     if active_state.get('switch_lock') is None:
@@ -2292,6 +5941,33 @@ async def run_live():
         except Exception as e:
             log.warning(f"Could not start selector task: {e}")
 
+    # hot-standby warmer for the selector's top candidates
+    if active_state.get('standby_task') is None and settings.selector_enabled and getattr(settings, 'standby_enabled', False):
+        try:
+            active_state['standby_task'] = asyncio.create_task(standby.run())
+        except Exception as e:
+            log.warning(f"Could not start standby warmer: {e}")
+
+    # streaming data mode: klines/trades are pushed into candle_cache instead of REST polling
+    if getattr(settings, 'data_mode', 'rest') == 'stream' and candle_stream is None:
+        try:
+            candle_stream = CandleStream(make_stream_transport())
+            candle_stream.start()
+            log.info(f"Candle stream started ({settings.stream_transport})")
+        except Exception as e:
+            candle_stream = None
+            log.warning(f"Could not start candle stream, polling REST instead: {e}")
+
+    # local order books: depth diffs for the active/standby symbols replace per-check REST books
+    if getattr(settings, 'book_mode', 'rest') == 'local' and book_feed is None:
+        try:
+            book_feed = BookFeed(make_depth_transport())
+            book_feed.start()
+            log.info(f"Local order books started ({settings.book_transport})")
+        except Exception as e:
+            book_feed = None
+            log.warning(f"Could not start local order books, fetching REST books instead: {e}")
+
     if not hasattr(run_live, 'pos'):
         run_live.pos   = 0.0
         run_live.trade = None
@@ -2309,29 +5985,45 @@ async def run_live():
             ensure_wallet(sym)
             wallet = active_state['wallets'][sym]
 
+            if candle_stream is not None:
+                try:
+                    for old in [s for s in candle_stream.subscribed if s != sym]:
+                        await candle_stream.unsubscribe(old)
+                    await candle_stream.subscribe(sym, settings.timeframes)
+                except Exception as e:
+                    log.warning(f"run_live: stream subscribe failed for {sym}: {e}")
+
+            if book_feed is not None:
+                try:
+                    await book_feed.track([sym] + list(standby.candidates))
+                except Exception as e:
+                    log.warning(f"run_live: order book tracking failed for {sym}: {e}")
+
             # fetch OHLCV and basic metrics (robust fetch)
             try:
-                df = await OHLCV.async_fetch(sym, settings.timeframes[0], settings.history_limit)
+                candles = await OHLCV.async_fetch_candles(sym, settings.timeframes[0], settings.history_limit)
             except Exception as e:
                 log.warning(f"run_live: OHLCV fetch failed for {sym}: {e}")
                 await asyncio.sleep(1)
                 continue
 
-            if df is None or len(df) < 2:
+            if candles is None or len(candles) < 2:
                 await asyncio.sleep(1)
                 continue
 
-            price = float(df['c'].iloc[-1])
-            prev_price = float(df['c'].iloc[-2])
-            vol = compute_volatility(df['c'].values, settings.vol_window)
+            close, high, low, volume = candles.c, candles.h, candles.l, candles.v
+            price = float(close[-1])
+            ind = indicators.candles(sym, settings.timeframes[0], candles)
+            vol = ind['vol']
             m = settings.wnd_min + (0 if vol < settings.target_vol else settings.wnd_step)
-            mom = float(df['c'].iloc[-1] / df['c'].iloc[-(settings.adx_window+1)] - 1) if len(df) > settings.adx_window else 0.0
+            mom = float(close[-1] / close[-(settings.adx_window+1)] - 1) if len(candles) > settings.adx_window else 0.0
 
             # liquidity and marketcap (best-effort)
             liquidity_usd, liquidity_score = 0.0, 0.0
             market_cap = None
+            ob = None
             try:
-                ob = await async_ex.fetch_order_book(sym, 200)
+                ob = local_order_book(sym) or await exchange_call_async('fetch_order_book', sym, limit=200)
                 liquidity_usd, liquidity_score = compute_liquidity_score_from_orderbook(ob, price)
             except Exception:
                 pass
@@ -2340,71 +6032,63 @@ async def run_live():
             except Exception:
                 market_cap = None
 
-            # pattern matcher (constructed safely)
-            pm = None
+            # pattern matcher: long-lived per (symbol, m), extended by the bars closed since the last tick
             try:
-                loop = asyncio.get_running_loop()
-                pm = await loop.run_in_executor(matcher_executor, PatternMatcherAE, df, m)
-                matcher_cache.update({'matcher': pm, 'timestamp': df['ts'].iloc[-1] if 'ts' in df.columns else pd.Timestamp.now(tz='Europe/Kyiv')})
-            except Exception:
-                try:
-                    pm = PatternMatcherAE(df, m)
-                except Exception:
-                    pm = None
+                pm = await standby.ensure_matcher(sym, m, candles)
+            except Exception as e:
+                log.debug(f"run_live: matcher unavailable for {sym} m={m}: {e}")
+                pm = None
+            if pm is not None:
+                matcher_cache.update({'matcher': pm, 'timestamp': candles.timestamp(-1), 'key': (sym, settings.timeframes[0], m)})
 
             er_raw, ae_conf = 0.0, 0.0
             try:
                 if pm:
-                    er_raw, ae_conf = pm.match()
+                    er_raw, ae_conf = pm.match(query=candles)
             except Exception:
                 er_raw, ae_conf = 0.0, 0.0
 
-            # blended ER
-            alpha, beta = 0.75, 0.25
-            er = alpha * er_raw * max(ae_conf, settings.min_ae_confidence) + beta * mom
-            er_history.append(er)
-
-            # breakout detection
-            N = 20
-            chan_high = df['h'].rolling(N).max().iloc[-2] if len(df) >= N+1 else df['h'].max()
-            chan_low  = df['l'].rolling(N).min().iloc[-2] if len(df) >= N+1 else df['l'].min()
-            atr = compute_atr(df, window=14)
-            buf = settings.atr_multiplier_open * atr
-            breakout_long  = price > chan_high + buf
-            breakout_short = price < chan_low  - buf
-
             # adaptive parameters and thresholds
             adaptive = compute_adaptive_params(vol, liquidity_score=liquidity_score, market_cap=market_cap)
             thr = adaptive['score_threshold']
             local_min_time_between = adaptive['min_time_between_trades']
             local_stop_loss_atr_mult = adaptive['stop_loss_atr_mult']
 
-            # scoring
-            f_er_long  = safe_norm(er, -0.1, 0.1)
-            f_er_short = safe_norm(-er, -0.1, 0.1)
-            f_breakout_long  = float(breakout_long)
-            f_breakout_short = float(breakout_short)
-            f_vol = float(df['v'].iloc[-1] > df['v'].iloc[-settings.vol_window:].mean() * 1.1) if len(df) >= settings.vol_window else 0.0
-            mom_norm = np.tanh(mom * 50) * 0.5 + 0.5
-
-            score_long  = (settings.w_breakout * f_breakout_long +
-                           settings.w_er * f_er_long +
-                           settings.w_mom * (mom_norm if mom>0 else 0) +
-                           settings.w_vol * f_vol)
-
-            score_short = (settings.w_breakout * f_breakout_short +
-                           settings.w_er * f_er_short +
-                           settings.w_mom * (1-mom_norm if mom<0 else 0) +
-                           settings.w_vol * f_vol)
-
-            if ae_conf < adaptive['min_ae_confidence']:
-                penal = 0.15 * (adaptive['min_ae_confidence'] - ae_conf)
-                score_long  = max(0.0, score_long - penal)
-                score_short = max(0.0, score_short - penal)
+            # scoring: the shared signal engine, evaluated for the forming bar from the incremental indicators
+            atr = ind['atr']
+            sig = score_signals(signal_features_live(ind, close, volume), er_raw=er_raw, ae_conf=ae_conf, thr=thr,
+                                atr_mult=settings.atr_multiplier_open, min_ae=adaptive['min_ae_confidence'],
+                                vol_factor=adaptive.get('vol_factor', 0.0))
+            er = float(sig['er'][0])
+            er_history.append(er)
+            er_sketch.add(er)
+            score_long, score_short = float(sig['score_long'][0]), float(sig['score_short'][0])
+            early_long, early_short = bool(sig['early_long'][0]), bool(sig['early_short'][0])
+            signal = int(sig['signal'][0])
 
             # sizing (simple)
             f = 0.02
             amt = max(0.000001, round(settings.base_usd * f / max(price, 1e-8), 6))
+            amt = market_cache.order_amount(sym, amt, price)
+            if ob is not None:
+                # keep the fill within max_slippage_pct on whichever side we end up taking; applied after
+                # exchange rounding so the minimums can't lift it again (too small to trade -> no open)
+                try:
+                    cap = min(max_size_under_slippage(ob, s, settings.max_slippage_pct) for s in ('buy', 'sell'))
+                    if cap <= 0:
+                        # even the best level is past the cap (half-spread > max_slippage_pct): no safe size
+                        log.info(f"run_live: {sym} book too wide/thin for max_slippage_pct={settings.max_slippage_pct}, not opening")
+                        amt = 0.0
+                    elif cap < amt:
+                        capped = market_cache.floor_amount(sym, cap)
+                        if capped <= 0 or capped < market_cache.min_order_amount(sym, price):
+                            log.info(f"run_live: {sym} slippage cap {cap:.6f} is below the market minimum, not opening")
+                            amt = 0.0
+                        else:
+                            log.info(f"run_live: {sym} size {amt} capped to {capped} by book slippage")
+                            amt = capped
+                except Exception as e:
+                    log.debug(f"run_live: slippage cap failed for {sym}: {e}")
 
             # last open guard
             last_open_ok = True
@@ -2417,52 +6101,31 @@ async def run_live():
                 last_open_ok = True
 
             # OPEN logic (dry-run support)
-            if wallet.get('position', 0.0) == 0.0 and last_open_ok:
-                # compute vol spike & very short-term EMA to detect start of move
-                vol_spike = False
-                try:
-                    recent_v_mean = df['v'].iloc[-settings.vol_window:].mean() if len(df) >= settings.vol_window else df['v'].mean()
-                    vol_spike = df['v'].iloc[-1] > recent_v_mean * 1.35
-                except Exception:
-                    vol_spike = False
-
-                # small-window EMA for early detection
-                try:
-                    ema_short = df['c'].ewm(span=3, adjust=False).mean().iloc[-1]
-                except Exception:
-                    ema_short = price
-
-                # immediate price change over last candle (fast momentum)
-                price_change = (price / prev_price - 1.0) if prev_price and prev_price > 0 else 0.0
-
-                # early-entry heuristic: noticeable one-bar momentum + volume spike + price above ema_short
-                early_long = (price_change > max(0.002, 0.25 * (atr / max(price, 1e-8)))) and vol_spike and (price > ema_short)
-                early_short = (price_change < -max(0.002, 0.25 * (atr / max(price, 1e-8)))) and vol_spike and (price < ema_short)
-
-                # apply adaptive threshold adjustments (easier opens when vol low)
-                effective_thr = thr * (1.0 - 0.25 * adaptive.get('vol_factor', 0.0))
-
-                # final open decision: accept breakouts OR early-entry if score reasonably high
-                if score_long >= thr or (early_long and score_long >= (effective_thr * 0.7)):
+            if wallet.get('position', 0.0) == 0.0 and last_open_ok and amt > 0:
+                # final open decision: breakouts OR early entry at an eased threshold (see score_signals),
+                # then the EV gate with costs priced from a walk of the fetched book
+                if signal > 0:
                     notional_open = float(round(amt * price))
-                    tr = execute_open_trade(sym, wallet, 'Long', amt, price,
-                                            extra={'open_idx': len(df)-1, 'atr': atr, 'er_raw': er_raw, 'ae_conf': ae_conf, 'notional_usd': notional_open},
-                                            dry=settings.dry_run)
-                    run_live.pos = amt
-                    log.info(f"OPEN Long {sym} size={amt} price={price} early={early_long} score={score_long:.3f} thr={thr:.3f}")
-                elif score_short >= thr or (early_short and score_short >= (effective_thr * 0.7)):
+                    tr = decide_and_open(sym, wallet, 'Long', amt, price, score_long, df=candles,
+                                         extra={'open_idx': len(candles)-1, 'atr': atr, 'er_raw': er_raw, 'ae_conf': ae_conf, 'notional_usd': notional_open},
+                                         dry=settings.dry_run, book=ob)
+                    if tr is not None:
+                        run_live.pos = amt
+                        log.info(f"OPEN Long {sym} size={amt} price={price} early={early_long} score={score_long:.3f} thr={thr:.3f}")
+                elif signal < 0:
                     notional_open = float(round(amt * price))
-                    tr = execute_open_trade(sym, wallet, 'Short', amt, price,
-                                            extra={'open_idx': len(df)-1, 'atr': atr, 'er_raw': er_raw, 'ae_conf': ae_conf, 'notional_usd': notional_open},
-                                            dry=settings.dry_run)
-                    run_live.pos = -amt
-                    log.info(f"OPEN Short {sym} size={amt} price={price} early={early_short} score={score_short:.3f} thr={thr:.3f}")
+                    tr = decide_and_open(sym, wallet, 'Short', amt, price, score_short, df=candles,
+                                         extra={'open_idx': len(candles)-1, 'atr': atr, 'er_raw': er_raw, 'ae_conf': ae_conf, 'notional_usd': notional_open},
+                                         dry=settings.dry_run, book=ob)
+                    if tr is not None:
+                        run_live.pos = -amt
+                        log.info(f"OPEN Short {sym} size={amt} price={price} early={early_short} score={score_short:.3f} thr={thr:.3f}")
 
             # CLOSE logic
             if wallet.get('trades'):
                 tr = wallet['trades'][-1]
-                price_now = float(df['c'].iloc[-1])
-                atr = tr.get('atr', compute_atr(df, window=14))
+                price_now = float(close[-1])
+                atr = tr.get('atr', ind['atr'])
                 trailing_triggered = False
                 stop_triggered = False
                 try:
@@ -2536,7 +6199,7 @@ async def run_live():
 
                 model_exit = False
                 try:
-                    feat = make_exit_feature(df.reset_index(), tr, er, ae_conf)
+                    feat = make_exit_feature(candles, tr, er, ae_conf)
                     if last_retrain_ts and len(X_history) >= 1:
                         p_stop = float(exit_model.predict_proba(feat)[0,1])
                         if p_stop > settings.exit_prob_thr:
@@ -2547,7 +6210,7 @@ async def run_live():
                 should_exit = trailing_triggered or stop_triggered or model_exit or time_exit
                 if should_exit:
                     try:
-                        pnl_scaled = execute_close_trade(sym, wallet, tr, price_now, df_for_feat=df, reason=('trailing' if trailing_triggered else ('stop' if stop_triggered else ('model' if model_exit else 'timeout'))), dry=settings.dry_run)
+                        pnl_scaled = execute_close_trade(sym, wallet, tr, price_now, df_for_feat=candles, reason=('trailing' if trailing_triggered else ('stop' if stop_triggered else ('model' if model_exit else 'timeout'))), dry=settings.dry_run)
                         log.info(f"CLOSE {sym} pnl_scaled={pnl_scaled}")
                     except Exception as e:
                         log.warning(f"Close failed: {e}")
@@ -2555,10 +6218,15 @@ async def run_live():
         except Exception as e:
             log.warning(f"run_live loop error: {e}", exc_info=True)
 
-        # sleep to maintain ~60s loop cadence
+        # sleep to maintain ~60s loop cadence (stream mode: wake early on a bar close or material move)
         try:
             elapsed = asyncio.get_event_loop().time() - t0
-            await asyncio.sleep(max(0, 60 - elapsed))
+            if candle_stream is not None:
+                await asyncio.sleep(max(0, exchange_clock.scale(settings.stream_min_interval) - elapsed))
+                elapsed = asyncio.get_event_loop().time() - t0
+                await candle_stream.wait_update(active_state.get('active_symbol', settings.symbol), exchange_clock.scale(60) - elapsed)
+            else:
+                await asyncio.sleep(max(0, exchange_clock.scale(60) - elapsed))
         except Exception:
             await asyncio.sleep(1)
 BOT_TOKEN  = os.getenv('BOT_TOKEN',"7769105003:AAG5NwNm9cOodvF3gNSrx43hpaVNEqFufiI")
@@ -2700,7 +6368,7 @@ def update(n, store):
      - improves metrics table content and visualized fields
     """
     global tick, exit_model, last_retrain_ts, retrain_interval, X_history, y_history
-    global er_history, matcher_cache, matcher_executor
+    global er_history, chart_matchers, matcher_executor
 
     # --- BEGIN: non-destructive store/wallet merge (inserted by assistant) ---
     # This block merges server-side wallets into client store without overwriting existing history.
@@ -2804,7 +6472,11 @@ def update(n, store):
     # Periodic AE retrain (non-blocking best-effort)
     if tick % settings.dash_train_interval == 0:
         try:
-            dfh = OHLCV.sync_fetch(active_symbol, settings.timeframes[0], settings.history_limit)
+            dfh = OHLCV.sync_fetch_candles(active_symbol, settings.timeframes[0], settings.history_limit)
+            if settings.archive_enabled and settings.train_history_bars > len(dfh):
+                hist = Candles.from_columns(candle_archive(active_symbol, settings.timeframes[0]).read(last_n=settings.train_history_bars))
+                if len(hist) > len(dfh):
+                    dfh = hist
             # cooldown guard to avoid frequent retrains (seconds)
             try:
                 now_ts = time.time()
@@ -2900,24 +6572,26 @@ def update(n, store):
     ft, lt = df.index[0], df.index[-1]
     price = float(df['c'].iloc[-1])
 
-    # build / refresh pattern matcher if needed
-    pm = None
-    need_rebuild = matcher_cache.get('timestamp') is None or pd.to_datetime(lt) > pd.to_datetime(matcher_cache.get('timestamp'))
-    if need_rebuild:
+    # extend the chart's own pattern matcher with the newly closed bars, rebuilding only when it can't be
+    # extended (kept apart from run_live's, which runs on another timeframe / window length)
+    key = (active_symbol, TF, settings.wnd_min)
+    ent = chart_matchers.get(key) or {'matcher': None, 'timestamp': None}
+    pm = ent['matcher']
+    if ent['timestamp'] is None or pd.to_datetime(lt) > pd.to_datetime(ent['timestamp']):
         try:
-            fut = matcher_executor.submit(PatternMatcherAE, df.reset_index(), settings.wnd_min)
-            pm = fut.result(timeout=10)
-            matcher_cache.update({'matcher': pm, 'timestamp': lt})
+            src = df.reset_index()
+            if pm is None or not matcher_executor.submit(pm.update, src).result(timeout=10):
+                pm = matcher_executor.submit(PatternMatcherAE, src, settings.wnd_min).result(timeout=10)
+            for k in [k for k in chart_matchers if k != key]:
+                chart_matchers.pop(k, None)
+            chart_matchers[key] = {'matcher': pm, 'timestamp': lt}
         except Exception as e:
             log.debug(f"Callback PatternMatcherAE build failed or timed out: {e}")
-            pm = matcher_cache.get('matcher')
-    else:
-        pm = matcher_cache.get('matcher')
 
     # compute ER and AE confidence
     try:
         if pm is not None:
-            match_res = pm.match()
+            match_res = pm.match(query=df)
             if isinstance(match_res, tuple) and len(match_res) == 2:
                 er_raw, ae_conf = match_res
             else:
@@ -2928,17 +6602,18 @@ def update(n, store):
         er_raw, ae_conf = 0.0, 0.0
 
     mom = float(df['c'].iloc[-1] / df['c'].iloc[-(settings.adx_window+1)] - 1) if len(df) > settings.adx_window else 0.0
-    alpha, beta = 0.75, 0.25
-    er = alpha * er_raw * max(ae_conf, settings.min_ae_confidence) + beta * mom
+    er = float(blended_er(er_raw, ae_conf, mom))
     er_history.append(er)
+    er_sketch.add(er)
 
-    vol = compute_volatility(df['c'].values, settings.vol_window)
+    ind = indicators.frame(active_symbol, TF, df)
+    vol = ind['vol']
     m = settings.wnd_min + (0 if vol < settings.target_vol else settings.wnd_step)
 
     # liquidity & marketcap
     liquidity_usd, liquidity_score = 0.0, 0.0
     try:
-        ob = sync_ex.fetch_order_book(active_symbol, 200)
+        ob = local_order_book(active_symbol) or exchange_call_sync('fetch_order_book', active_symbol, limit=200)
         liquidity_usd, liquidity_score = compute_liquidity_score_from_orderbook(ob, price)
     except Exception as e:
         log.debug(f"Order book fetch failed (dash): {e}")
@@ -2956,40 +6631,17 @@ def update(n, store):
     local_stop_loss_atr_mult = adaptive['stop_loss_atr_mult']
     thr = local_score_thr
 
-    # breakout / signals
-    N = 20
-    chan_high = df['h'].rolling(N).max().iloc[-2] if len(df) >= N+1 else df['h'].max()
-    chan_low  = df['l'].rolling(N).min().iloc[-2] if len(df) >= N+1 else df['l'].min()
-    atr = compute_atr(df, window=14)
-    buf = local_atr_open * atr
-    breakout_long  = price > chan_high + buf
-    breakout_short = price < chan_low - buf
-
-    # score components
-    if len(er_history) >= 20:
-        er_hi = np.percentile(er_history, 90)
-        er_lo = np.percentile(er_history, 10)
+    # breakout / signals: the shared signal engine on the forming bar (no early-entry rule in the UI path)
+    atr = ind['atr']
+    if len(er_sketch) >= 20:
+        er_lo, er_hi = er_sketch.quantiles((0.1, 0.9))
     else:
         er_hi, er_lo = max(er, 1e-6), min(er, -1e-6)
-    f_er_long  = safe_norm(er, er_lo, er_hi)
-    f_er_short = safe_norm(-er, -er_hi, -er_lo)
-    mom_norm = np.tanh(mom * 50) * 0.5 + 0.5
-    vol_spike = df['v'].iloc[-1] > df['v'].iloc[-settings.vol_window:].mean() * 1.1 if len(df) >= settings.vol_window else False
-
-    score_long  = (settings.w_breakout * float(breakout_long) +
-                   settings.w_er * f_er_long +
-                   settings.w_mom * (mom_norm if mom>0 else 0) +
-                   settings.w_vol * float(vol_spike))
-
-    score_short = (settings.w_breakout * float(breakout_short) +
-                   settings.w_er * f_er_short +
-                   settings.w_mom * (1-mom_norm if mom<0 else 0) +
-                   settings.w_vol * float(vol_spike))
-
-    if ae_conf < local_min_ae:
-        penal = 0.15 * (local_min_ae - ae_conf)
-        score_long  = max(0.0, score_long - penal)
-        score_short = max(0.0, score_short - penal)
+    sig = score_signals(signal_features_live(ind, df['c'].values, df['v'].values), er_raw=er_raw, ae_conf=ae_conf,
+                        thr=thr, atr_mult=local_atr_open, min_ae=local_min_ae, er_lo=er_lo, er_hi=er_hi, early=False)
+    score_long, score_short = float(sig['score_long'][0]), float(sig['score_short'][0])
+    signal = int(sig['signal'][0])
+    vol_spike = bool(sig['f_vol'][0])
 
     # sizing (simplified)
     f = 1.0
@@ -3026,7 +6678,7 @@ def update(n, store):
     # simulate opens for UI only (do not send orders here)
     with state_lock:
         if wallet.get('position', 0.0) == 0.0 and last_open_ok:
-            if score_long >= thr:
+            if signal > 0:
                 tr = {
                     'time': lt,
                     'time_ts': time.time(),
@@ -3049,7 +6701,7 @@ def update(n, store):
                     send_telegram(format_open_signal(active_symbol,'LONG',price,amt,er,vol_spike,True,vol_spike))
                 except Exception:
                     pass
-            elif score_short >= thr:
+            elif signal < 0:
                 tr = {
                     'time': lt,
                     'time_ts': time.time(),
@@ -3078,7 +6730,7 @@ def update(n, store):
         if wallet.get('trades'):
             tr = wallet['trades'][-1]
             price_now = float(df['c'].iloc[-1])
-            atr = tr.get('atr', compute_atr(df, window=14))
+            atr = tr.get('atr', ind['atr'])
             if wallet.get('position',0.0) > 0:
                 tr['trail_base'] = max(tr.get('trail_base', tr['price']), price_now)
                 trigger = tr['trail_base'] - settings.trailing_atr_mult * atr
@@ -3878,7 +7530,13 @@ def update(n, store):
 cli = typer.Typer()
 
 @cli.callback(invoke_without_command=True)
-def main(ctx: typer.Context):
+def main(ctx: typer.Context,
+         exchange_mode: str = typer.Option(settings.exchange_mode, help="live | record | replay (запис / відтворення викликів біржі)"),
+         replay_path: str = typer.Option(None, help="Файл або тека із записом для replay"),
+         replay_speed: float = typer.Option(settings.replay_speed, help="Прискорення годинника під час replay")):
+    if exchange_mode != settings.exchange_mode or replay_path or (exchange_mode == 'replay' and replay_speed != settings.replay_speed):
+        settings.replay_speed = replay_speed
+        install_exchange_mode(exchange_mode, replay_path)
     if ctx.invoked_subcommand is None:
         threading.Thread(target=lambda: asyncio.run(run_live()), daemon=True).start()
         app.run(host="0.0.0.0", port=8050, debug=False)
@@ -3893,11 +7551,36 @@ def chart():
     """Запустити тільки Dash-інтерфейс"""
     app.run(host="0.0.0.0", port=8050, debug=False)
 
+@cli.command()
+def backfill(symbol: str = settings.symbol, timeframe: str = settings.timeframes[0], days: int = 365):
+    """Докачати історію свічок у локальний архів"""
+    since = int((time.time() - days * 86400) * 1000)
+    added = backfill_archive(symbol, timeframe, since)
+    log.info(f"Backfill done: {symbol} {timeframe} +{added} bars, {len(candle_archive(symbol, timeframe))} total")
+
+@cli.command()
+def bench_matcher(symbol: str = None, timeframe: str = settings.timeframes[0], bars: int = 20000,
+                  queries: int = 200, k: int = settings.k_neighbors):
+    """Порівняти бекенди пошуку сусідів (recall@k і затримка)"""
+    rng = np.random.default_rng(0)
+    if symbol:
+        hist = Candles.from_columns(candle_archive(symbol, timeframe).read(last_n=bars))
+        pm = PatternMatcherAE(hist, settings.wnd_min)
+        X, metric = pm.index.vectors(), pm.index.metric
+    else:
+        X, metric = rng.standard_normal((bars, settings.latent_dim)).astype(np.float32), 'l2'
+    Q = X[rng.integers(0, len(X), queries)] + 0.05 * rng.standard_normal((queries, X.shape[1])).astype(np.float32)
+    for row in bench_latent_backends(X, Q, k, metric=metric):
+        log.info(f"bench {row['backend']:>5} ({row['effective']}): n={len(X)} build {row['build_s']:.3f}s "
+                 f"p50 {row['p50_ms']:.3f}ms p99 {row['p99_ms']:.3f}ms recall@{k} {row['recall']:.3f}")
+
 if __name__ == "__main__":
     cli()
 
 # Adaptive volatility helper (appended)
-vol_state = {'ema': None, 'alpha': 0.12, 'hist': collections.deque(maxlen=2000)}
+# the persisted vol sketch is shared with the definition above: asking sketch_store for the same
+# name with another window would discard the saved state and re-register an empty sketch
+vol_state = {'ema': None, 'alpha': 0.12, 'hist': collections.deque(maxlen=2000), 'sketch': vol_state['sketch']}
 liq_state = {'hist': collections.deque(maxlen=2000)}
 
 def safe_norm(x, lo, hi):
@@ -3912,17 +7595,19 @@ def safe_norm(x, lo, hi):
 def compute_adaptive_params(current_vol, liquidity_score=0.0, market_cap=None):
     try:
         vol_state['hist'].append(float(current_vol))
+        vol_state['sketch'].add(float(current_vol))
     except Exception:
         vol_state['hist'].append(0.0)
+        vol_state['sketch'].add(0.0)
     if vol_state['ema'] is None:
         vol_state['ema'] = float(current_vol) if current_vol is not None else 0.0
     else:
         a = vol_state['alpha']
         vol_state['ema'] = a * (float(current_vol) if current_vol is not None else 0.0) + (1 - a) * vol_state['ema']
     vol_val = vol_state['ema'] or 0.0
-    if len(vol_state['hist']) >= 20:
-        lo = float(np.percentile(list(vol_state['hist']), 10))
-        hi = float(np.percentile(list(vol_state['hist']), 90))
+    if len(vol_state['sketch']) >= 20:
+        lo, hi = (float(q) for q in vol_state['sketch'].quantiles((0.1, 0.9)))
+        sketch_store.flush()
     else:
         lo = float(min(list(vol_state['hist'])) if vol_state['hist'] else vol_val * 0.5)
         hi = float(max(list(vol_state['hist'])) if vol_state['hist'] else vol_val * 1.5)
@@ -3949,7 +7634,7 @@ def compute_adaptive_params(current_vol, liquidity_score=0.0, market_cap=None):
     kelly_cap = float(np.clip(0.08 * (1.0 + 0.7 * vol_factor) + 0.01 + 0.04 * combined_liq, 0.01, 0.30))
     stop_loss_atr = float(np.clip(settings.stop_loss_atr_mult * (1.0 - 0.25 * vol_factor), 0.2, 3.0))
     try:
-        liq_state['hist'].append(float(liquidity_score))
+        _observe_liquidity(float(liquidity_score))
     except Exception:
         pass
     return {